@@ -0,0 +1,128 @@
+""" Shared setup for the benchmark scripts. Each script builds an app with a
+    fresh SQLite database in a temporary directory and deterministic data so
+    that results are comparable between runs and between commits. Run from
+    the repository root, eg python benchmarks/list_paging.py.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.dialects.postgresql import JSONB
+
+import limscore
+from limscore import models
+
+
+# users.last_session is postgres JSONB, which SQLite can store as JSON.
+@compiles(JSONB, "sqlite")
+def _jsonb_sqlite(element, compiler, **kw):
+    return "JSON"
+
+
+
+CONFIG = """import datetime
+DB_URL = "sqlite:///bench.db"
+SECRET_KEY = b"0123456789abcdef"
+NAME = "Benchmark"
+STYLE = "bulma"
+"""
+
+
+
+def arguments(description, repeat=5, number=200):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--repeat", type=int, default=repeat,
+                        help="number of timed runs, the median is reported")
+    parser.add_argument("--number", type=int, default=number,
+                        help="number of calls per timed run")
+    return parser.parse_args()
+
+
+
+def make_app(**config):
+    """ Returns an app with the admin and auth blueprints registered, the
+        given extra config and empty tables.
+    """
+    instance = tempfile.mkdtemp(prefix="limscore-bench-")
+    lines = [CONFIG] + [f"{k} = {v!r}\n" for k, v in config.items()]
+    with open(os.path.join(instance, "app.cfg"), "w") as f:
+        f.write("".join(lines))
+    app = Flask(__name__, instance_path=instance)
+    limscore.init_app(app)
+    from limscore.admin import app as admin
+    app.register_blueprint(admin)
+    app.extensions["locales"] = {"en_GB": {}}
+    models.metadata.create_all(app.extensions["engine"])
+    return app
+
+
+
+def seed(app, users=100, editlogs=0):
+    """ Adds two groups, sites and projects, users who all hold the first
+        group and alternate sites and editlogs spread over the users.
+    """
+    base = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    with app.extensions["engine"].begin() as conn:
+        conn.execute(models.groups.insert(), [{"name": "Admin.Administrator"}, {"name": "Lab.Tech"}])
+        conn.execute(models.sites.insert(), [{"name": "SiteA"}, {"name": "SiteB"}])
+        conn.execute(models.projects.insert(), [{"name": "P1"}, {"name": "P2"}])
+        conn.execute(models.users.insert(),
+                     [{"email": f"u{i}@example.com", "name": f"U{i}", "forename": "F",
+                       "surname": f"S{i % 7}", "last_session": {}} for i in range(users)])
+        conn.execute(models.users_groups.insert(),
+                     [{"user_id": i + 1, "group_id": 1} for i in range(users)])
+        conn.execute(models.users_sites.insert(),
+                     [{"user_id": i + 1, "site_id": 1 + i % 2} for i in range(users)])
+        if editlogs:
+            conn.execute(models.editlogs.insert(),
+                         [{"tablename": "users", "row_id": 1 + i % users, "action": "Edited",
+                           "details": {"name": f"U{i}", "surname": f"S{i % 7}"},
+                           "user_id": 1, "datetime": base + timedelta(minutes=i)}
+                          for i in range(editlogs)])
+
+
+
+def login(client, user_id=1, group="Admin.Administrator"):
+    """ Logs client in as user_id without going through the login form.
+    """
+    with client.session_transaction() as session:
+        session["id"] = user_id
+        session["group"] = group
+        session["section"] = group.split(".")[0]
+        session["locale"] = "en_GB"
+        session["timezone"] = "UTC"
+        session["site"] = "SiteA"
+        session["project"] = "P1"
+
+
+
+def bench(name, function, args):
+    """ Calls function once to warm any caches then prints the median time
+        per call over args.repeat runs of args.number calls.
+    """
+    function()
+    times = []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        for j in range(args.number):
+            function()
+        times += [(time.perf_counter() - start) / args.number]
+    print(f"{name:<40} {statistics.median(times) * 1000:8.3f} ms")
+
+
+
+def get(client, url, status=200):
+    """ Returns a function that requests url and checks the status code.
+    """
+    def request():
+        response = client.get(url)
+        assert response.status_code == status, (url, response.status_code)
+    return request
@@ -0,0 +1,13 @@
+""" Times the audit trail of a single row with many editlogs.
+"""
+from common import arguments, make_app, seed, login, bench, get
+
+
+args = arguments(__doc__, number=20)
+app = make_app()
+seed(app, users=10, editlogs=20000)
+client = app.test_client()
+login(client)
+
+bench("/audit/users/2", get(client, "/audit/users/2"), args)
+bench("/audit/users/2/json", get(client, "/audit/users/2/json"), args)
@@ -0,0 +1,20 @@
+""" Times the users list, its keyset paged pages and the users edit form.
+"""
+import re
+import html
+
+from common import arguments, make_app, seed, login, bench, get
+
+
+args = arguments(__doc__)
+app = make_app(PAGE_SIZE=50)
+seed(app, users=2000)
+client = app.test_client()
+login(client)
+
+bench("/users", get(client, "/users"), args)
+page = client.get("/users?page=1").data.decode()
+next_page = html.unescape(re.search(r'href="([^"]*)">Next', page).group(1))
+bench("/users?page=1", get(client, "/users?page=1"), args)
+bench("/users next page", get(client, next_page), args)
+bench("/users/1000", get(client, "/users/1000"), args)
@@ -0,0 +1,20 @@
+""" Times the logout and site dropdown menus, with and without a matching
+    ETag.
+"""
+from common import arguments, make_app, seed, login, bench, get
+
+
+args = arguments(__doc__)
+app = make_app()
+seed(app, users=10)
+
+client = app.test_client()
+login(client)
+for path in ("/logoutmenu", "/sitemenu"):
+    bench(path, get(client, path), args)
+    etag = client.get(path).headers.get("ETag")
+    if etag:
+        def revalidate(path=path, etag=etag):
+            response = client.get(path, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+        bench(f"{path} 304", revalidate, args)
@@ -0,0 +1,18 @@
+""" Times a page rendered by render_page with a 24 item navbar.
+"""
+from common import arguments, make_app, seed, login, bench, get
+from limscore import utils
+
+
+args = arguments(__doc__)
+app = make_app()
+seed(app, users=10)
+
+@utils.navbar("Admin")
+def admin_navbar():
+    return [{"text": text, "href": utils.url_fwrd("admin.users_list")}
+            for text in ("Users", "Groups", "Sites", "Projects", "Audit", "Status") * 4]
+
+client = app.test_client()
+login(client)
+bench("/users (navbar)", get(client, "/users"), args)
@@ -0,0 +1,30 @@
+""" Times list_view with and without the plan and compiled statement caches,
+    crud._plans and crud._compiled. Without them every request rebuilds the
+    joins and recompiles the SQL as it did before the caches were added.
+"""
+from common import arguments, make_app, seed, login, bench, get
+from limscore import crud
+
+
+
+class NoCache(dict):
+    def __setitem__(self, key, value):
+        pass
+
+
+
+args = arguments(__doc__)
+app = make_app(PAGE_SIZE=50)
+seed(app, users=500)
+client = app.test_client()
+login(client)
+
+for url in ("/users", "/users?page=1"):
+    bench(f"{url} cached", get(client, url), args)
+    
+    plan, compiled = crud._plan, crud._compiled
+    crud._plan, crud._compiled = crud._ListPlan, NoCache()
+    try:
+        bench(f"{url} uncached", get(client, url), args)
+    finally:
+        crud._plan, crud._compiled = plan, compiled
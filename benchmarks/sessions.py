@@ -0,0 +1,17 @@
+""" Times a request that reads the session with each server side session
+    backend and with the default cookie session.
+"""
+from flask import session
+
+from common import arguments, make_app, seed, login, bench, get
+
+
+args = arguments(__doc__)
+for backend in (None, "memory", "database"):
+    config = {} if backend is None else {"SESSION_BACKEND": backend}
+    app = make_app(**config)
+    seed(app, users=10)
+    app.add_url_rule("/bench/session", "bench_session", lambda: session.get("locale", ""))
+    client = app.test_client()
+    login(client)
+    bench(f"session {backend or 'cookie'}", get(client, "/bench/session"), args)
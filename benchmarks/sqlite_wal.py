@@ -0,0 +1,82 @@
+""" Concurrency benchmark for the SQLite WAL profile. Reader threads run read
+    only transactions as the GET path of a view would, while writer threads
+    run write transactions, for a fixed time with the default rollback
+    journal and with DB_SQLITE_WAL. Reports transactions and errors per
+    second.
+"""
+import os
+import time
+import argparse
+import tempfile
+import threading
+
+from flask import Flask
+from sqlalchemy import MetaData, Table, Column, Integer, String, select, func
+
+import common # Puts the repository on sys.path.
+from limscore.models import create_engine
+
+
+metadata = MetaData()
+
+items = Table("items", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String))
+
+
+
+def run(config, seconds, readers=4, writers=2):
+    path = os.path.join(tempfile.mkdtemp(prefix="limscore-bench-"), "wal.db")
+    engine = create_engine(f"sqlite:///{path}", config=config)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(items.insert(), [{"name": f"n{i}"} for i in range(5000)])
+    app = Flask(__name__)
+    
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    stop = time.monotonic() + seconds
+    
+    def count(name):
+        with lock:
+            counts[name] += 1
+    
+    def reader():
+        with app.test_request_context(method="GET"):
+            while time.monotonic() < stop:
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(select([items]).order_by(items.c.name).limit(100)).fetchall()
+                    count("reads")
+                except Exception:
+                    count("errors")
+    
+    def writer():
+        with app.test_request_context(method="POST"):
+            while time.monotonic() < stop:
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(select([func.count()]).select_from(items)).scalar()
+                        conn.execute(items.update().where(items.c.id == 1).values(name="x"))
+                        # Work done inside the transaction.
+                        time.sleep(0.002)
+                        conn.execute(items.insert(), [{"name": "y"}] * 200)
+                    count("writes")
+                except Exception:
+                    count("errors")
+    
+    threads = [threading.Thread(target=reader) for i in range(readers)] + \
+              [threading.Thread(target=writer) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return ", ".join(f"{name} {total / seconds:.0f}/s" for name, total in counts.items())
+
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--seconds", type=float, default=5, help="duration of each run")
+args = parser.parse_args()
+print(f"{'rollback journal':<20} {run({}, args.seconds)}")
+print(f"{'wal profile':<20} {run({'DB_SQLITE_WAL': True}, args.seconds)}")
@@ -0,0 +1,65 @@
+""" Times logic.upsert of 10000 rows, half of which conflict, with
+    INSERT .. ON CONFLICT and with the savepoint per row fallback. ON
+    CONFLICT is only used with postgres, so pass --db-url with the url of a
+    scratch postgres database to compare the two, by default only the
+    fallback is timed on SQLite. The reference table is dropped and
+    recreated for every run.
+"""
+import os
+import time
+import argparse
+import tempfile
+
+import sqlalchemy
+from sqlalchemy import MetaData, Table, Column, Integer, String
+
+import common # Puts the repository on sys.path.
+from limscore import logic
+
+
+metadata = MetaData()
+
+reference = Table("bench_reference", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("code", String, unique=True),
+    Column("label", String))
+
+
+
+def run(engine, fallback):
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        logic.upsert(reference, [{"code": f"c{i}"} for i in range(0, 10000, 2)], {"label": "old"}, conn)
+    
+    unique_keys = logic._unique_keys
+    if fallback:
+        # No unique keys means no row can use ON CONFLICT.
+        logic._unique_keys = lambda table: set()
+    try:
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            logic.upsert(reference, [{"code": f"c{i}"} for i in range(10000)], {"label": "new"}, conn)
+        return time.perf_counter() - start
+    finally:
+        logic._unique_keys = unique_keys
+
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--db-url", help="postgres database to use instead of SQLite")
+parser.add_argument("--repeat", type=int, default=3, help="number of timed runs, the median is reported")
+args = parser.parse_args()
+
+if args.db_url:
+    engine = sqlalchemy.create_engine(args.db_url)
+    modes = (("on conflict", False), ("savepoint per row", True))
+else:
+    path = os.path.join(tempfile.mkdtemp(prefix="limscore-bench-"), "upsert.db")
+    engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+    modes = (("savepoint per row", True),)
+
+for name, fallback in modes:
+    times = sorted(run(engine, fallback) for i in range(args.repeat))
+    print(f"{name:<40} {times[len(times) // 2] * 1000:8.3f} ms")
+metadata.drop_all(engine)
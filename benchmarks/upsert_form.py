@@ -0,0 +1,63 @@
+""" Times upsert_view for a form with many select fields whose choices come
+    from tables that are not in DB_CACHED_TABLES, and counts the SELECTs of
+    one request.
+"""
+from flask import g
+from sqlalchemy import MetaData, Table, Column, Integer, String, Boolean, ForeignKey
+
+from common import arguments, make_app, seed, login, bench, get
+from limscore import crud
+from limscore.forms import Form, TextInput, SelectInput
+
+
+SELECTS = 6
+
+metadata = MetaData()
+
+lookups = [Table(f"lookup{i}", metadata,
+               Column("id", Integer, primary_key=True),
+               Column("name", String),
+               Column("deleted", Boolean(name="bool"), default=False, nullable=False))
+           for i in range(SELECTS)]
+
+widgets = Table("widgets", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String),
+    *[Column(f"lookup{i}_id", Integer, ForeignKey(f"lookup{i}.id")) for i in range(SELECTS)])
+
+
+
+class WidgetForm(Form):
+    def definition(self):
+        self.name = TextInput("Name")
+        for i in range(SELECTS):
+            setattr(self, f"lookup{i}_id", SelectInput(f"Lookup {i}"))
+
+
+
+args = arguments(__doc__)
+app = make_app(DB_QUERY_STATS=True)
+seed(app, users=10)
+engine = app.extensions["engine"]
+metadata.create_all(engine)
+with engine.begin() as conn:
+    for lookup in lookups:
+        conn.execute(lookup.insert(), [{"name": f"v{j}", "deleted": j == 3} for j in range(20)])
+    conn.execute(widgets.insert(), [{"name": "w", **{f"lookup{i}_id": 4 for i in range(SELECTS)}}])
+
+selects = []
+def widgets_upsert(row_id=None):
+    return crud.upsert_view(row_id, widgets, WidgetForm)
+app.add_url_rule("/widgets/<int:row_id>", "admin.widgets_upsert", widgets_upsert)
+
+@app.after_request
+def count_selects(response):
+    selects[:] = [query for query in g.get("queries", ())
+                  if query["statement"].lstrip().upper().startswith("SELECT")]
+    return response
+
+client = app.test_client()
+login(client)
+client.get("/widgets/1")
+print(f"{len(selects)} SELECTs per GET with {SELECTS} select fields")
+bench("/widgets/1", get(client, "/widgets/1"), args)
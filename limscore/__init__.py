@@ -6,9 +6,10 @@ from flask import (Flask,
                    Blueprint)
 from flask.json.tag import JSONTag
 
-from .models import create_engine
+from .models import create_engine, create_read_engine
 from .admin import app as admin
 from .utils import (engine,
+                    read_engine,
                     url_fwrd,
                     url_back,
                     login_required,
@@ -23,16 +24,22 @@ from .utils import (engine,
                     tablerow,
                     sign_cookie,
                     unique_violation_or_reraise,
-                    iso8601_to_utc)
+                    iso8601_to_utc,
+                    HistoryStore)
 from .wrappers import (Local,
                        Attr)
 from .i18n import i18n_init
+from .profiling import query_check_init
+from .requestlog import request_log_init
+from .sessions import session_init
+from . import cache, partitions
 
 __all__ = ["utcnow",
            "Local",
            "Attr",
            "login_required",
            "engine",
+           "read_engine",
            "abort",
            "tablerow",
            "url_fwrd",
@@ -82,10 +89,25 @@ def init_app(app):
         app.config["DB_URL"] = db_url
         os.chdir(cwd)
     
-    #with app.app_context():
-        #logger.initialise()
+    app.extensions["engine"] = create_engine(db_url, config=app.config)
+    app.extensions["read_engine"] = \
+        create_read_engine(app.extensions["engine"],
+                           config.get("DB_REPLICA_URLS", ()),
+                           config=app.config)
+    app.extensions["history"] = HistoryStore(config.get("HISTORY_LENGTH", 20))
+    app.extensions["navbars"] = cache.LRUCache(config.get("NAVBAR_CACHE_SIZE", 256))
+    app.extensions["menus"] = cache.LRUCache(config.get("MENU_CACHE_SIZE", 1024))
+    cache.configure(config.get("DB_CACHED_TABLES", ()), config.get("DB_CACHE_TTL", 300))
+    cache.invalidate()
+    if config.get("DB_CACHE_NOTIFY", False):
+        cache.start_listener(app.extensions["engine"])
+    if config.get("LOG_MAINTENANCE", False):
+        partitions.start_maintenance(app.extensions["engine"], app.config)
+    if config.get("LOG_URL", None) is not None:
+        from .dev import _logger
+        _logger.initialise(app)
     
-    app.extensions["engine"] = create_engine(db_url)
+    session_init(app)
     
     class TagDate(JSONTag):
         __slots__ = ('serializer',)
@@ -131,6 +153,8 @@ def init_app(app):
             return response
     
     i18n_init(app)
+    query_check_init(app)
+    request_log_init(app)
 
 
 
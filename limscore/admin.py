@@ -1,5 +1,9 @@
 import pdb
+import json
 from html import escape
+from datetime import timezone
+
+from dateutil import parser
 
 from sqlalchemy import (select,
                         join,
@@ -13,7 +17,8 @@ from flask import (session,
                    request,
                    abort,
                    Blueprint,
-                   current_app)
+                   current_app,
+                   jsonify)
 from werkzeug.exceptions import (Conflict,
                                  Forbidden,
                                  BadRequest,
@@ -27,9 +32,7 @@ from .models import (editlogs,
                      groups,
                      sites,
                      projects,
-                     users_sites,
-                     users_projects,
-                     users_groups)
+                     pool_status)
 from .forms import UserForm
 from .utils import (render_page,
                     tablerow,
@@ -38,14 +41,15 @@ from .utils import (render_page,
                     store_history,
                     url_fwrd,
                     url_back,
-                    engine, navbar,
+                    engine, read_engine, navbar,
                     login_required,
                     valid_groups,
                     abort,
                     unique_violation_or_reraise)
 from .wrappers import Local
-from . import logic
-from .crud import list_view
+from .profiling import query_stats
+from . import logic, cache
+from .crud import list_view, _seek, _decode_key
 from .auth import send_setpassword_email
 from .i18n import _
 
@@ -54,108 +58,218 @@ app = Blueprint("admin", __name__)
 
 
 
+def _details_value(value):
+    if isinstance(value, list):
+        return ", ".join(str(item) for item in value)
+    return str(value)
+
+
+
+def _utc(dt):
+    """ Returns dt in UTC. SQLite returns naive datetimes, which were stored
+        as UTC, so naive datetimes are taken to already be UTC rather than
+        local time.
+    """
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+
+def _editlog_key(row):
+    return json.dumps([_utc(row[editlogs.c.datetime]).isoformat(), row[editlogs.c.id]])
+
+
+
+def _editlog_page(tablename, row_id):
+    """ Returns (rows, newer, older) for one page of the audit trail of a row,
+        newest first. Rows can be filtered by the action, user, field, since
+        and until request arguments, where since and until are iso8601 dates
+        or datetimes, UTC unless they include an offset, and until is
+        exclusive. Pages are selected by keyset
+        pagination on (datetime, id) using the after or before argument,
+        newer and older are the arguments for the adjacent pages or None if
+        there is no such page.
+    """
+    args = dict(request.args)
+    after = args.pop("after", None)
+    before = args.pop("before", None)
+    page_size = current_app.config.get("PAGE_SIZE", 100)
+    
+    sql = select([users.c.forename,
+                  users.c.surname,
+                  editlogs.c.id,
+                  editlogs.c.action,
+                  editlogs.c.details,
+                  editlogs.c.datetime]). \
+            select_from(join(editlogs, users,
+                             editlogs.c.user_id == users.c.id)). \
+            where(and_(editlogs.c.tablename == tablename,
+                       editlogs.c.row_id == row_id))
+    try:
+        if "action" in args:
+            sql = sql.where(editlogs.c.action == args["action"])
+        if "user" in args:
+            sql = sql.where(editlogs.c.user_id == int(args["user"]))
+        if "field" in args:
+            sql = sql.where(logic.details_has_field(args["field"], read_engine.dialect))
+        if "since" in args:
+            sql = sql.where(editlogs.c.datetime >= _utc(parser.isoparse(args["since"])))
+        if "until" in args:
+            sql = sql.where(editlogs.c.datetime < _utc(parser.isoparse(args["until"])))
+        
+        keyset = [editlogs.c.datetime, editlogs.c.id]
+        key = before or after
+        if key is not None:
+            key = _decode_key(key, 2)
+            key = [_utc(parser.isoparse(key[0])), int(key[1])]
+    except (ValueError, TypeError):
+        abort(BadRequest)
+    
+    if before is not None:
+        sql = sql.where(_seek(keyset, key)). \
+                order_by(*keyset)
+    else:
+        if after is not None:
+            sql = sql.where(_seek(keyset, key, reverse=True))
+        sql = sql.order_by(*(column.desc() for column in keyset))
+    sql = sql.limit(page_size + 1)
+    
+    with read_engine.connect() as conn:
+        rows = conn.execute(sql).fetchall()
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if before is not None:
+        rows.reverse()
+    
+    newer = older = None
+    if rows:
+        first = _editlog_key(rows[0])
+        last = _editlog_key(rows[-1])
+        if before is not None:
+            older = dict(args, after=last)
+            if more:
+                newer = dict(args, before=first)
+        else:
+            if more:
+                older = dict(args, after=last)
+            if after is not None:
+                newer = dict(args, before=first)
+    return rows, newer, older
+
+
+
 @app.route("/audit/<string:tablename>/<int:row_id>")
 @login_required("Admin.Administrator", "Admin.")
 def editlog(tablename, row_id):
-    with engine.connect() as conn:
-        sql = select([users.c.forename,
-                      users.c.surname,
-                      editlogs.c.action,
-                      editlogs.c.details,
-                      editlogs.c.datetime]). \
-                select_from(join(editlogs, users,
-                                 editlogs.c.user_id == users.c.id)). \
-                where(and_(editlogs.c.tablename == tablename,
-                           editlogs.c.row_id == row_id)). \
-                order_by(editlogs.c.datetime, editlogs.c.id)
-        rows = []
-        for row in conn.execute(sql):
-            name = initial_surname(row[users.c.forename], row[users.c.surname])
-            html = escape(row[editlogs.c.details]).replace("\t", "<br>")
-            details = Markup(html)
-            rows += [tablerow(_(row[editlogs.c.action]),
-                              details,
-                              name,
-                              Local(row[editlogs.c.datetime]))]
+    rows, newer, older = _editlog_page(tablename, row_id)
+    body = []
+    for row in rows:
+        name = initial_surname(row[users.c.forename], row[users.c.surname])
+        details = Markup("<br>".join(f"{escape(k)}={escape(_details_value(v))}" for k, v
+                                     in sorted(row[editlogs.c.details].items())))
+        body += [tablerow(_(row[editlogs.c.action]),
+                          details,
+                          name,
+                          Local(row[editlogs.c.datetime]))]
+    
+    buttons = {"back": (_("Back"),  url_back())}
+    if newer is not None:
+        url = url_for(".editlog", tablename=tablename, row_id=row_id, **newer)
+        buttons["previous"] = (_("Newer"), url)
+    if older is not None:
+        url = url_for(".editlog", tablename=tablename, row_id=row_id, **older)
+        buttons["next"] = (_("Older"), url)
     
     table = {"head": (_("Action"), _("Details"), _("User"), _("Date")),
-             "body": rows}
+             "body": body}
     return render_page("table.html",
                        table=table,
-                       buttons={"back": (_("Back"),  url_back())},
+                       buttons=buttons,
                        title=_("Audit Trail"))
-        
-        
+
+
+
+@app.route("/audit/<string:tablename>/<int:row_id>/json")
+@login_required("Admin.Administrator", "Admin.", history=False)
+def editlog_json(tablename, row_id):
+    """ JSON variant of editlog for lazy loading. Takes the same arguments
+        and returns the page of rows plus the urls of the adjacent pages.
+    """
+    rows, newer, older = _editlog_page(tablename, row_id)
+    data = [{"action": _(row[editlogs.c.action]),
+             "details": row[editlogs.c.details],
+             "user": initial_surname(row[users.c.forename], row[users.c.surname]),
+             "datetime": _utc(row[editlogs.c.datetime]).isoformat()}
+            for row in rows]
+    urls = {}
+    for name, args in (("newer", newer), ("older", older)):
+        urls[name] = args and url_for(".editlog_json", tablename=tablename, row_id=row_id, **args)
+    return jsonify({"rows": data, **urls})
+
+
+
+@app.route("/status/pool")
+@login_required("Admin.Administrator", "Admin.", history=False)
+def pool():
+    return jsonify(pool_status(engine))
+
+
+
+@app.route("/status/queries")
+@login_required("Admin.Administrator", "Admin.", history=False)
+def queries():
+    stats = query_stats.snapshot()
+    if request.args.get("reset", None):
+        query_stats.reset()
+    return jsonify(stats)
+
+
+
+@app.route("/status/requestlog")
+@login_required("Admin.Administrator", "Admin.", history=False)
+def requestlog():
+    request_logger = current_app.extensions.get("request_logger", None)
+    return jsonify(request_logger.stats() if request_logger is not None else {})
+
+
 
 @app.route("/users/new", methods=["GET", "POST"])
 @app.route("/users/<int:row_id>", methods=["GET", "POST"])
 @login_required("Admin.Administrator", "Admin.")
 def users_upsert(row_id=None):
     with engine.begin() as conn:
+        memberships = ("groups", "sites", "projects")
         if row_id is not None:
-            sql = select([users.c.id,
-                          users.c.forename,
-                          users.c.surname,
-                          users.c.email,
-                          users.c.restricted,
-                          users.c.deleted]). \
-                    where(users.c.id == row_id)
-            old = dict(conn.execute(sql).first() or abort(BadRequest))
+            old = logic.select_row(users, [users.c.id,
+                                           users.c.forename,
+                                           users.c.surname,
+                                           users.c.email,
+                                           users.c.restricted,
+                                           users.c.deleted],
+                                   row_id, memberships, conn) or abort(BadRequest)
         else:
-            old = {}
-        
+            old = {name: set() for name in memberships}
         
-        where = and_(groups.c.id == users_groups.c.group_id,
-                      users_groups.c.user_id == row_id)
-        sql = select([groups.c.name,
-                      groups.c.id,
-                      users_groups.c.user_id]). \
-                select_from(join(groups, users_groups, where, isouter=True)). \
-                where(groups.c.name.in_(valid_groups)). \
-                order_by(groups.c.name)
-        old["groups"] = []
+        reference = cache.reference_choices_for((groups, sites, projects), conn)
         group_id_choices = []
         my_group_id = None
-        for row in conn.execute(sql):
-            group_id_choices += [(row[groups.c.id], row[groups.c.name])]
-            if row[users_groups.c.user_id] is not None:
-                old["groups"] += [row[groups.c.id]]
-                if row[users_groups.c.user_id] == session["id"] and \
-                                        row[groups.c.name] == session["group"]:
+        for group_id, name, deleted in reference["groups"]:
+            if name in valid_groups:
+                group_id_choices += [(group_id, name)]
+                if row_id == session["id"] and name == session["group"] and \
+                                                    group_id in old["groups"]:
                     group_id_choices[-1] += ("disabled",)
-                    my_group_id = row[groups.c.id]
-                    
-
-        where = and_(sites.c.id == users_sites.c.site_id,
-                      users_sites.c.user_id == row_id)
-        sql = select([sites.c.name,
-                      sites.c.id,
-                      users_sites.c.user_id]). \
-                select_from(join(sites, users_sites, where, isouter=True)). \
-                where(sites.c.deleted == False). \
-                order_by(sites.c.name)
-        old["sites"] = []
-        site_id_choices = []
-        for row in conn.execute(sql):
-            site_id_choices += [(row[sites.c.id], row[sites.c.name])]
-            if row[users_sites.c.user_id] is not None:
-                old["sites"] += [row[sites.c.id]]
+                    my_group_id = group_id
         
+        site_id_choices = [choice[:2] for choice in reference["sites"] if not choice[2]]
+        project_id_choices = [choice[:2] for choice in reference["projects"] if not choice[2]]
         
-        where = and_(projects.c.id == users_projects.c.project_id,
-                      users_projects.c.user_id == row_id)
-        sql = select([projects.c.name,
-                      projects.c.id,
-                      users_projects.c.user_id]). \
-                select_from(join(projects, users_projects, where, isouter=True)). \
-                where(projects.c.deleted == False). \
-                order_by(projects.c.name)
-        old["projects"] = []
-        project_id_choices = []
-        for row in conn.execute(sql):
-            project_id_choices += [(row[projects.c.id], row[projects.c.name])]
-            if row[users_projects.c.user_id] is not None:
-                old["projects"] += [row[projects.c.id]]
+        # Links to deleted sites and projects are neither shown nor altered.
+        for name, choices in (("groups", group_id_choices),
+                              ("sites", site_id_choices),
+                              ("projects", project_id_choices)):
+            old[name] &= {choice[0] for choice in choices}
         
         form = UserForm(request.form if request.method=="POST" else old)
         form.groups.choices = group_id_choices
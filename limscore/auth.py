@@ -6,6 +6,7 @@ import hmac
 import os
 import pdb
 from io import BytesIO
+from functools import wraps
 from urllib.parse import quote
 
 import pytz
@@ -13,7 +14,6 @@ import pyqrcode
 from babel import Locale
 
 from sqlalchemy import (select,
-                        join,
                         or_,
                         and_)
 
@@ -23,7 +23,8 @@ from flask import (session,
                    request,
                    abort,
                    Blueprint,
-                   current_app)
+                   current_app,
+                   make_response)
 
 from werkzeug.exceptions import (Conflict,
                                  Forbidden,
@@ -33,13 +34,7 @@ from werkzeug.exceptions import (Conflict,
 from passlib.hash import bcrypt_sha256
 from itsdangerous import URLSafeTimedSerializer
 
-from .models import (users,
-                     groups,
-                     users_groups,
-                     sites,
-                     users_sites,
-                     projects,
-                     users_projects)
+from .models import users
 from .forms import (LoginForm,
                    ChangePasswordForm,
                    TwoFactorForm)
@@ -53,9 +48,11 @@ from .utils import (render_template,
                     login_required,
                     valid_groups,
                     abort,
-                    _navbars)
+                    _navbars,
+                    _history)
 from .aws import sendmail
 from . import logic
+from .permissions import permissions, discard, version
 from .i18n import _, locale_from_headers
 
 
@@ -73,6 +70,10 @@ __all__ = ("app",
 
 app = Blueprint("auth", __name__)
 
+# Distinguishes the ETags of this process from those issued before a restart,
+# when the permission versions start again from the beginning.
+_etag_prefix = token_urlsafe(8)
+
 
 
 def hotp(secret, counter, token_length=6):
@@ -108,6 +109,7 @@ def login():
         del form["authenticator"]
     
     if request.method == "POST":
+        _history().discard(session.get("history", None))
         session.clear()
 
         if form.validate():
@@ -130,6 +132,8 @@ def login():
                     
                     user_id = row["id"]
                     session["id"] = user_id
+                    discard(user_id)
+                    permissions(user_id, conn)
                     session["csrf"] = token_urlsafe(64)
                     try:
                         session["timezone"] = pytz.timezone(form.timezone.data).zone
@@ -188,19 +192,63 @@ def reset():
 
 
 
+def save_last_session(key, value):
+    """ Records value under key in the last_session of the current user, which
+        is restored at their next login, if it has changed.
+    """
+    # Called from GET requests, so must ask for the write lock up front.
+    with engine.execution_options(sqlite_begin="IMMEDIATE").begin() as conn:
+        sql = select([users.c.last_session]).where(users.c.id == session["id"])
+        last_session = conn.execute(sql).scalar()
+        if key not in last_session or last_session[key] != value:
+            last_session[key] = value
+            conn.execute(users.update().where(users.c.id == session["id"]).values(last_session=last_session))
+
+
+
+def cached_menu(function):
+    """ Decorator for the dropdown menu views, which are requested every time
+        a dropdown is opened. The rendered menu is cached per user, current
+        selection and locale until their permissions change, and is sent with
+        an ETag so that the browser can revalidate with a 304 rather than
+        the menu being sent again.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        key = (request.endpoint,
+               session["id"],
+               session.get("group", None),
+               session.get("site_id", None),
+               session.get("project_id", None),
+               session.get("locale", None),
+               version())
+        etag = _etag_prefix + hashlib.sha1(repr(key).encode()).hexdigest()
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+        else:
+            menus = current_app.extensions["menus"]
+            html = menus.get(key)
+            if html is None:
+                html = function(*args, **kwargs)
+                menus.set(key, html)
+            response = make_response(html)
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+
+
 @app.route("/logoutmenu")
 @login_required(history=False)
+@cached_menu
 def logout_menu():
     menu = []
-    with engine.connect() as conn:
-        sql = select([groups.c.id, groups.c.name]). \
-                select_from(join(groups, users_groups, 
-                                    groups.c.id == users_groups.c.group_id)). \
-                where(and_(users_groups.c.user_id == session["id"],
-                            groups.c.name != session.get("group", None),
-                            groups.c.name.in_(valid_groups))). \
-                order_by(groups.c.name)
-        rows = [{"text": name, "href": url_fwrd(".setrole", group_id=group_id)} for group_id, name in conn.execute(sql)]
+    current = session.get("group", None)
+    rows = [{"text": name, "href": url_fwrd(".setrole", group_id=group_id)}
+            for group_id, name in permissions(session["id"]).groups.items()
+            if name != current and name in valid_groups]
     if rows:
         menu += [{"text": _("Change Role")}] + rows + [{"divider": True}]
     
@@ -224,26 +272,14 @@ def logout_menu():
 @app.route("/setrole/<int:group_id>")
 @login_required()
 def setrole(group_id):
-    with engine.begin() as conn:
-        sql = select([groups.c.name, users.c.last_session]). \
-                select_from(join(groups, users_groups, 
-                                groups.c.id == users_groups.c.group_id). \
-                            join(users, users.c.id == users_groups.c.user_id)). \
-                where(and_(users_groups.c.user_id == session["id"],
-                           groups.c.id == group_id,
-                           groups.c.name.in_(valid_groups)))
-        row = conn.execute(sql).first()
-        if row:
-            group, last_session = row
-            section = group.split(".")[0]
-            same_section = session.get("section", None) == section
-            session["group"] = group
-            session["section"] = section
-            
-            if last_session.get("group_id", None) != group_id:
-                last_session["group_id"] = group_id
-                conn.execute(users.update().where(users.c.id == session["id"]).values(last_session=last_session))
-            return redirect(url_back() if same_section else url_for(".root", dir=0))
+    group = permissions(session["id"], fresh=True).groups.get(group_id, None)
+    if group in valid_groups:
+        section = group.split(".")[0]
+        same_section = session.get("section", None) == section
+        session["group"] = group
+        session["section"] = section
+        save_last_session("group_id", group_id)
+        return redirect(url_back() if same_section else url_for(".root", dir=0))
     return redirect(url_for(".logout"))
 
 
@@ -253,6 +289,8 @@ def setrole(group_id):
 def logout():
     with engine.connect() as conn:
         login_token = conn.execute(select([users.c.login_token]).where(users.c.id == session["id"])).scalar()
+    _history().discard(session.get("history", None))
+    discard(session["id"])
     session.clear()
     return redirect(url_for(".login", login_token=login_token))
 
@@ -260,18 +298,13 @@ def logout():
 
 @app.route("/sitemenu")
 @login_required(history=False)
+@cached_menu
 def site_menu():
     menu = []
-    with engine.connect() as conn:
-        sql = select([sites.c.id, sites.c.name]). \
-                select_from(join(sites, users_sites, 
-                                    sites.c.id == users_sites.c.site_id)). \
-                where(and_(users_sites.c.user_id == session["id"],
-                           sites.c.id != session.get("site_id", None),
-                           sites.c.deleted == False)). \
-                order_by(sites.c.name)
-        rows = [{"text": name, "href": url_fwrd(".setsite", site_id=site_id)}
-                for site_id, name in conn.execute(sql)]
+    current = session.get("site_id", None)
+    rows = [{"text": name, "href": url_fwrd(".setsite", site_id=site_id)}
+            for site_id, name in permissions(session["id"]).sites.items()
+            if site_id != current]
     if rows:
         menu += [{"text": _("Switch Site")}] + rows
     return render_template("dropdown.html", items=menu)
@@ -281,41 +314,24 @@ def site_menu():
 @app.route("/setsite/<int:site_id>")
 @login_required()
 def setsite(site_id):
-    with engine.begin() as conn:
-        sql = select([sites.c.name, users.c.last_session]). \
-                select_from(join(sites, users_sites, 
-                                sites.c.id == users_sites.c.site_id). \
-                            join(users, users.c.id == users_sites.c.user_id)). \
-                where(and_(users_sites.c.user_id == session["id"],
-                           sites.c.id == site_id,
-                           sites.c.deleted == False))
-        row = conn.execute(sql).first()
-        if row:
-            site, last_session = row
-            session["site_id"] = site_id
-            session["site"] = site
-            
-            if last_session.get("site_id", None) != site_id:
-                last_session["site_id"] = site_id
-                conn.execute(users.update().where(users.c.id == session["id"]).values(last_session=last_session))
+    site = permissions(session["id"], fresh=True).sites.get(site_id, None)
+    if site is not None:
+        session["site_id"] = site_id
+        session["site"] = site
+        save_last_session("site_id", site_id)
     return redirect(url_back())
 
 
 
 @app.route("/projectmenu")
 @login_required(history=False)
+@cached_menu
 def project_menu():
     menu = []
-    with engine.connect() as conn:
-        sql = select([projects.c.id, projects.c.name]). \
-                select_from(join(projects, users_projects,
-                                    projects.c.id == users_projects.c.project_id)). \
-                where(and_(users_projects.c.user_id == session["id"],
-                           projects.c.id != session.get("project_id", None),
-                           projects.c.deleted == False)). \
-                order_by(projects.c.name)
-        rows = [{"text": name, "href": url_fwrd(".setproject", project_id=project_id)}
-                for project_id, name in conn.execute(sql)]
+    current = session.get("project_id", None)
+    rows = [{"text": name, "href": url_fwrd(".setproject", project_id=project_id)}
+            for project_id, name in permissions(session["id"]).projects.items()
+            if project_id != current]
     if rows:
         menu += [{"text": _("Switch Project")},
                  {"text": _("All Projects"), "href": url_fwrd(".setproject")}] + rows
@@ -327,25 +343,14 @@ def project_menu():
 @app.route("/setproject/<int:project_id>")
 @login_required()
 def setproject(project_id):
-    with engine.begin() as conn:
-        if project_id is None:
-            sql = select([users.c.last_session]).where(users.c.id == session["id"])
-            last_session = conn.execute(sql).scalar()
-            row = [None, _("All Projects"), last_session]
-        else:
-            sql = select([projects.c.id, projects.c.name, users.c.last_session]). \
-                    select_from(join(projects, users_projects, 
-                                        projects.c.id == users_projects.c.project_id). \
-                                join(users, users.c.id == users_projects.c.user_id)). \
-                    where(and_(users_projects.c.user_id == session["id"],
-                            projects.c.id == project_id,
-                            projects.c.deleted == False))
-            row = conn.execute(sql).first()
-        if row:
-            last_session = row[2]
-            session["project_id"] = last_session["project_id"] = row[0]
-            session["project"] = row[1]
-            conn.execute(users.update().where(users.c.id == session["id"]).values(last_session=last_session))
+    if project_id is None:
+        project = _("All Projects")
+    else:
+        project = permissions(session["id"], fresh=True).projects.get(project_id, None)
+    if project is not None:
+        session["project_id"] = project_id
+        session["project"] = project
+        save_last_session("project_id", project_id)
     return redirect(url_back())
 
 
@@ -358,7 +363,7 @@ def setlocale(locale):
             session["locale"] = locale
         else:
             session["locale"] = "en_GB"
-        with engine.begin() as conn:
+        with engine.execution_options(sqlite_begin="IMMEDIATE").begin() as conn:
             sql = select([users.c.last_session]).where(users.c.id == session["id"])
             last_session = conn.execute(sql).scalar()
             if last_session.get("locale", None) != session["locale"]:
@@ -0,0 +1,249 @@
+import select as _select
+import time
+import logging
+import threading
+from collections import defaultdict, OrderedDict
+
+from sqlalchemy import select, func, false, union_all, literal_column, Integer
+from sqlalchemy.event import listens_for
+
+__all__ = ("reference_choices",
+           "reference_choices_for",
+           "configure",
+           "table_changed",
+           "invalidate",
+           "generation",
+           "cache_events",
+           "start_listener",
+           "LRUCache")
+
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "limscore_cache"
+
+# Only these tables are cached, see configure.
+cached_tables = set(["groups", "sites", "projects"])
+_ttl = 300
+
+_choices = {}
+_lock = threading.Lock()
+# Every invalidation advances _version. _changed_at holds the _version of the
+# last invalidation of each table and _cleared_at that of the last
+# invalidation of every table.
+_version = 0
+_changed_at = defaultdict(int)
+_cleared_at = 0
+_notify = False
+
+
+
+def configure(tables=(), ttl=300):
+    """ Adds tables (names) to the tables whose choices are cached, by default
+        only groups, sites and projects. Writes made other than through logic,
+        such as raw SQL, migrations or other processes when the listener is
+        not running, are not seen until the cached choices are ttl seconds
+        old, so only small, rarely edited reference tables should be added.
+    """
+    global _ttl
+    cached_tables.update(tables)
+    _ttl = ttl
+
+
+
+def reference_choices(table, conn):
+    """ Returns a list of (id, name, deleted) for every row in table ordered
+        by name. If table is in cached_tables the list is cached in process
+        until the table is written to via logic or is ttl seconds old.
+    """
+    return reference_choices_for([table], conn)[table.name]
+
+
+
+def reference_choices_for(tables, conn):
+    """ Returns a dict of table name to reference_choices for each of
+        tables. The choices of every table that is not cached, or whose
+        cache has expired, are loaded together in a single UNION ALL round
+        trip.
+    """
+    now = time.monotonic()
+    found = {}
+    missing = OrderedDict()
+    with _lock:
+        for table in tables:
+            cached = _choices.get(table.name, None)
+            if cached is not None and cached[1] > now:
+                found[table.name] = cached[0]
+            else:
+                missing[table.name] = table
+    if not missing:
+        return found
+    
+    # The snapshot of a transaction can predate invalidations that happen
+    # before the query below, so the result is only cached if table has not
+    # been invalidated since the transaction began.
+    stamp = conn.info.get("cache_version", _version)
+    selects = []
+    for index, table in enumerate(missing.values()):
+        deleted = table.c.deleted if "deleted" in table.c else false()
+        selects += [select([literal_column(str(index), Integer).label("tbl"),
+                            table.c.id.label("id"),
+                            table.c.name.label("name"),
+                            deleted.label("deleted")])]
+    if len(selects) == 1:
+        sql = selects[0].order_by(literal_column("name"))
+    else:
+        sql = union_all(*selects).order_by(literal_column("tbl"), literal_column("name"))
+    rows = defaultdict(list)
+    for row in conn.execute(sql):
+        rows[row[0]] += [tuple(row)[1:]]
+    
+    with _lock:
+        for index, (tablename, table) in enumerate(missing.items()):
+            found[tablename] = rows[index]
+            if tablename in cached_tables and \
+                    _changed_at[tablename] <= stamp and _cleared_at <= stamp:
+                _choices[tablename] = (rows[index], now + _ttl)
+    return found
+
+
+
+def invalidate(tablename=None):
+    """ Discards the cached choices for tablename, or for every table if
+        tablename is None, and advances the generation of tablename.
+    """
+    global _version, _cleared_at
+    with _lock:
+        _version += 1
+        if tablename is None:
+            _choices.clear()
+            _cleared_at = _version
+        else:
+            _choices.pop(tablename, None)
+            _changed_at[tablename] = _version
+
+
+
+def generation(*tablenames):
+    """ Returns a value that changes whenever any of tablenames is
+        invalidated, for use as the version of anything derived from them.
+    """
+    return (_cleared_at,) + tuple(_changed_at[tablename] for tablename in tablenames)
+
+
+
+def table_changed(table, conn):
+    """ Must be called whenever table is written to. Invalidates the cache
+        immediately and again when the transaction commits. Choices read by
+        a transaction that began before the commit are not cached, see
+        reference_choices. If listening is enabled, other processes are
+        notified via postgres NOTIFY, which is only delivered on commit.
+    """
+    invalidate(table.name)
+    conn.info.setdefault("changed_tables", set()).add(table.name)
+    if _notify and conn.dialect.name == "postgresql":
+        conn.execute(select([func.pg_notify(CHANNEL, table.name)]))
+
+
+
+def cache_events(engine):
+    """ Registers the listeners on engine that complete the invalidations
+        started by table_changed on commit and record the cache version at
+        the first statement of each transaction.
+    """
+    @listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("cache_version", _version)
+    
+    @listens_for(engine, "commit")
+    def commit(conn):
+        conn.info.pop("cache_version", None)
+        for tablename in conn.info.pop("changed_tables", ()):
+            invalidate(tablename)
+
+    @listens_for(engine, "rollback")
+    def rollback(conn):
+        conn.info.pop("cache_version", None)
+        conn.info.pop("changed_tables", None)
+    
+    @listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        # The transaction of a connection used without begin ends when it
+        # is returned to the pool.
+        connection_record.info.pop("cache_version", None)
+
+
+
+def start_listener(engine):
+    """ Starts a daemon thread that invalidates the cache whenever another
+        process writes to a cached table. Requires postgres, for any other
+        database the cache is only invalidated by writes in this process.
+    """
+    global _notify
+    if engine.dialect.name != "postgresql":
+        return
+    _notify = True
+
+    def listen():
+        while True:
+            dbapi_connection = None
+            try:
+                fairy = engine.raw_connection()
+                fairy.detach()
+                dbapi_connection = fairy.connection
+                dbapi_connection.set_isolation_level(0) # autocommit
+                cursor = dbapi_connection.cursor()
+                cursor.execute(f"LISTEN {CHANNEL}")
+                # Anything could have changed while we were not listening.
+                invalidate()
+                while True:
+                    _select.select([dbapi_connection], [], [], 60)
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        invalidate(notify.payload)
+            except Exception:
+                logger.exception("Cache listener failed, restarting.")
+                invalidate()
+                time.sleep(5)
+            finally:
+                if dbapi_connection is not None:
+                    try:
+                        dbapi_connection.close()
+                    except Exception:
+                        pass
+
+    thread = threading.Thread(target=listen, name="limscore-cache", daemon=True)
+    thread.start()
+
+
+
+class LRUCache(object):
+    """ Thread safe cache of at most maxsize items, discarding the least
+        recently used beyond that. For small derived values, such as rendered
+        menus, that are cheap to rebuild but requested on every page.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+    
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._items.clear()
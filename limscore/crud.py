@@ -1,20 +1,30 @@
 import pdb
+import json
+import csv
+import io
+import tempfile
 from collections import OrderedDict, defaultdict
 from inspect import signature
+from functools import partial
 
-from sqlalchemy import select, join, or_, and_
+from sqlalchemy import select, join, or_, and_, bindparam, util
 from sqlalchemy.exc import IntegrityError
 
 
-from flask import redirect, url_for, request, Blueprint, current_app, session
+from flask import redirect, url_for, request, Blueprint, current_app, session, Response, stream_with_context
 from werkzeug.exceptions import Conflict, Forbidden, BadRequest
 
-from .utils import url_fwrd, url_back, tablerow, navbar, abort, engine, login_required, surname_forename, back_exists, render_page, unique_violation_or_reraise
+from .utils import url_fwrd, url_back, tablerow, navbar, abort, engine, read_engine, login_required, surname_forename, back_exists, render_page, unique_violation_or_reraise
 from .forms import ReorderForm
-from . import logic
+from . import logic, cache
 from .models import metadata
 from .i18n import _
 
+try:
+    import openpyxl
+except ImportError: # xlsx export is optional
+    openpyxl = None
+
 __all__ = ("list_view", "reorder_view", "upsert_view", "crud_route", "app")
 
 
@@ -67,12 +77,11 @@ def make_joins(tables):
             m2m_tables += [foreign_table]
 
     for foreign_table in m2m_tables:
-        for linking_table in primary_table.metadata.sorted_tables:
+        for linking_table, primary, secondary in logic._linking_tables(primary_table, foreign_table):
             if linking_table not in tables:
-                joinplan = [make_join(linking_table, primary_table, reverse=True), make_join(linking_table, foreign_table)]
-                if None not in joinplan:
-                    joinplans += joinplan
-                    break
+                joinplans += [(linking_table, primary == tuple(primary.foreign_keys)[0].column),
+                              (foreign_table, secondary == tuple(secondary.foreign_keys)[0].column)]
+                break
     selectable = join(primary_table, *joinplans[0], isouter=True)
     for joinplan in joinplans[1:]:
         selectable = selectable.join(*joinplan, isouter=True)
@@ -80,46 +89,314 @@ def make_joins(tables):
 
 
 
-def list_view(*table_definition, title=None):#, **filters):
+def _order(table):
+    if "order" in table.c:
+        return [table.c.order]
+    elif "surname" in table.c and "forename" in table.c:
+        return [table.c.surname, table.c.forename]
+    elif "name" in table.c:
+        return [table.c.name]
+    return []
+
+
+
+def _ascending(columns, reverse=False):
+    """ Returns the order by clauses for columns, each ascending with NULLs
+        last (or descending with NULLs first if reverse) to match _seek.
+        NULLS LAST needs SQLite 3.30 so it is emulated by first ordering on
+        whether a nullable column is NULL.
+    """
+    clauses = []
+    for column in columns:
+        if column.nullable:
+            null = column.is_(None)
+            clauses += [null.desc()] if reverse else [null]
+        clauses += [column.desc()] if reverse else [column]
+    return clauses
+
+
+
+def _seek(columns, values, reverse=False, nulls=()):
+    """ Returns a where clause that selects the rows that sort after values
+        (or before values if reverse) when ordered by columns as _ascending.
+        Used for keyset pagination. nulls holds True for each of values that
+        is NULL, these are compared with IS NULL as no row compares equal to
+        a NULL bind parameter.
+    """
+    nulls = tuple(nulls) + (False,) * (len(values) - len(nulls))
+    clauses = []
+    equal = []
+    for column, value, null in zip(columns, values, nulls):
+        if null:
+            # NULLs sort last so only rows before a NULL can differ here.
+            if reverse:
+                clauses += [and_(*equal, column.isnot(None))]
+            equal += [column.is_(None)]
+        else:
+            if reverse:
+                clauses += [and_(*equal, column < value)]
+            elif column.nullable:
+                clauses += [and_(*equal, or_(column > value, column.is_(None)))]
+            else:
+                clauses += [and_(*equal, column > value)]
+            equal += [column == value]
+    return or_(*clauses)
+
+
+
+def _decode_key(key, length):
+    try:
+        values = json.loads(key)
+    except ValueError:
+        abort(BadRequest)
+    if not isinstance(values, list) or len(values) != length:
+        abort(BadRequest)
+    return values
+
+
+
+def _merged_rows(rows, fields):
+    """ Yields (row, columns) once for each primary row. Consecutive rows with
+        the same id, produced by many to many joins, are merged into
+        MergedColumns. Requires all rows for a given id to be contiguous.
+    """
+    current = None
+    for row in rows:
+        columns = [column(row) if hasattr(column, "__call__") else row[column]
+                   for column in fields]
+        if current is not None and current[0]["id"] == row["id"]:
+            if not isinstance(current[1][0], MergedColumn):
+                current = (current[0], [MergedColumn(col) for col in current[1]])
+            for prevcol, newcol in zip(current[1], columns):
+                prevcol.merge(newcol)
+        else:
+            if current is not None:
+                yield current
+            current = (row, columns)
+    if current is not None:
+        yield current
+
+
+
+def _export(sql, head, fields, name, format):
+    """ Streams the full result of a list_view query as a csv or xlsx file
+        using a server-side cursor so memory use does not depend on the size
+        of the table.
+    """
+    def rows():
+        with read_engine.connect() as conn:
+            conn = conn.execution_options(stream_results=True,
+                                          compiled_cache=_compiled)
+            results = conn.execute(sql)
+            for row, columns in _merged_rows(results, fields):
+                yield ["" if col is None else str(col) for col in columns]
+    
+    def generate_csv():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(head)
+        for i, row in enumerate(rows()):
+            writer.writerow(row)
+            if i % 1000 == 999:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+    
+    def generate_xlsx():
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet(name[:31])
+        worksheet.append(list(head))
+        for row in rows():
+            worksheet.append(row)
+        with tempfile.TemporaryFile() as f:
+            workbook.save(f)
+            f.seek(0)
+            yield from iter(lambda: f.read(65536), b"")
+    
+    if format == "csv":
+        generate = generate_csv
+        mimetype = "text/csv"
+    elif format == "xlsx" and openpyxl is not None:
+        generate = generate_xlsx
+        mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        abort(BadRequest)
+    disposition = f'attachment; filename="{name}.{format}"'
+    return Response(stream_with_context(generate()),
+                    mimetype=mimetype,
+                    headers={"Content-Disposition": disposition})
+
+
+
+class _ListPlan(object):
+    """ Everything list_view needs to query a table_definition that can be
+        derived from the definition alone. Built once per definition and
+        cached in _plans. Statements are keyed on (kind, hide_deleted), plus
+        the NULLs in the key for seek statements, and use bind parameters for
+        anything request specific so that their compiled forms can be cached
+        in _compiled.
+    """
+    def __init__(self, fields):
+        memory = MemoryDict()
+        for column in fields:
+            if hasattr(column, "__call__"):
+                column(memory)
+            else:
+                memory[column]
+        columns = list(memory.keys())
+        tables = list(OrderedDict((column.table, None) for column
+                                  in columns).keys())
+        primary_table = tables[0]
+        columns += [primary_table.c.id]
+        if "deleted" in primary_table.c:
+            columns += [primary_table.c.deleted]
+        
+        # Ordering columns of tables that can only contribute a single row to
+        # each primary row come first, followed by the primary id, so that all
+        # rows belonging to a primary row are contiguous.
+        key_tables = [primary_table]
+        key_order = _order(primary_table)
+        other_order = []
+        for table in tables[1:]:
+            if make_join(primary_table, table):
+                key_tables += [table]
+                key_order += _order(table)
+            else:
+                other_order += _order(table)
+        key_order += [primary_table.c.id]
+        
+        sql = select(columns).select_from(make_joins(tables)). \
+                order_by(*_ascending(key_order + other_order))
+        keysql = select(key_order).select_from(make_joins(key_tables)). \
+                    limit(bindparam("limit"))
+        
+        statements = {}
+        wheres = {}
+        for hide_deleted in (False, True):
+            where = []
+            if hide_deleted and "deleted" in primary_table.c:
+                where = [primary_table.c.deleted == False]
+            wheres[hide_deleted] = where
+            statements["all", hide_deleted] = sql.where(and_(*where))
+            statements["page", hide_deleted] = sql.where(and_(*where,
+                primary_table.c.id.in_(bindparam("ids", expanding=True))))
+            statements["first", hide_deleted] = keysql.where(and_(*where)). \
+                order_by(*_ascending(key_order))
+        
+        self.primary_table = primary_table
+        self.key_length = len(key_order)
+        self.statements = statements
+        self._keysql = keysql
+        self._key_order = key_order
+        self._wheres = wheres
+    
+    def seek(self, kind, hide_deleted, values):
+        """ Returns the statement that selects the keys of the page after or
+            before (kind) the key values. As NULLs are compared with IS NULL
+            there is a statement for each combination of NULLs in the key,
+            built the first time it is needed.
+        """
+        nulls = tuple(value is None for value in values)
+        try:
+            return self.statements[kind, hide_deleted, nulls]
+        except KeyError:
+            reverse = kind == "before"
+            params = [bindparam("key{}".format(i), type_=column.type)
+                      for i, column in enumerate(self._key_order)]
+            sql = self._keysql.where(and_(*self._wheres[hide_deleted],
+                    _seek(self._key_order, params, reverse, nulls))). \
+                    order_by(*_ascending(self._key_order, reverse))
+            self.statements[kind, hide_deleted, nulls] = sql
+            return sql
+
+
+
+# Plans and compiled statements are bounded as plans for callables that
+# close over per request values are rebuilt for each distinct value.
+_plans = cache.LRUCache(256)
+_compiled = util.LRUCache(1000)
+
+
+
+def _field_key(field):
+    """ Returns a hashable key for a field of a table definition. Callables
+        are frequently defined within the view function and therefore
+        recreated on every request, so are keyed on their code plus the
+        values they close over rather than their identity, which also keeps
+        apart different closures created by the same factory.
+    """
+    if isinstance(field, partial):
+        return (_field_key(field.func), field.args, tuple(sorted(field.keywords.items())))
+    code = getattr(field, "__code__", None)
+    if code is None:
+        return field
+    cells = tuple(cell.cell_contents for cell in field.__closure__ or ())
+    return (code, cells, field.__defaults__)
+
+
+
+def _plan(fields):
+    """ Returns the cached _ListPlan for fields. Fields whose key cannot be
+        hashed, such as closures over a list, get a new plan every time.
+    """
+    try:
+        key = tuple(_field_key(field) for field in fields)
+        hash(key)
+    except (TypeError, ValueError):
+        return _ListPlan(fields)
+    plan = _plans.get(key)
+    if plan is None:
+        plan = _ListPlan(fields)
+        _plans.set(key, plan)
+    return plan
+
+
+
+def list_view(*table_definition, title=None, page_size=None):#, **filters):
     """ table_definition consists of a list of tuples. Each tuple has three
         eleents (name, stupidtable datatype, contents).
+        
+        If page_size is provided, or there is a page argument in the request,
+        then only a single page of rows is rendered. Pages are selected by
+        keyset pagination on the ordering columns of the primary table and
+        any many to one tables plus the primary id, the after or before
+        argument holding the key of the last or first row of the adjacent
+        page. Many to many rows are only joined after the page of primary
+        rows has been selected so merged columns are never split between
+        pages.
+        
+        If there is an export argument in the request (csv or xlsx) then the
+        whole table is streamed as a file download instead.
     """
     head, fields = zip(*table_definition)
-    memory = MemoryDict()
-    for column in fields:
-        if hasattr(column, "__call__"):
-            column(memory)
-        else:
-            memory[column]
-    columns = list(memory.keys())
-    tables = list(OrderedDict((column.table, None) for column
-                              in columns).keys())
-    primary_table = tables[0]
-    columns += [primary_table.c.id]
-    if "deleted" in primary_table.c:
-        columns += [primary_table.c.deleted]
+    plan = _plan(fields)
+    primary_table = plan.primary_table
     upsert_endpoint = "admin.{}_upsert".format(primary_table.name)
     reorder_endpoint = "admin.{}_reorder".format(primary_table.name)
-
-    order = []
-    for table in tables:
-        if "order" in table.c:
-            order += [table.c.order]
-        elif "surname" in table.c and "forename" in table.c:
-            order += [table.c.surname, table.c.forename]
-        elif "name" in table.c:
-            order += [table.c.name]
     
-    sql = select(columns).select_from(make_joins(tables)).order_by(*order)
+    args = dict(request.args)
+    export = args.pop("export", None)
+    after = args.pop("after", None)
+    before = args.pop("before", None)
+    paginate = page_size is not None or "page" in args
+    if paginate:
+        try:
+            page = max(int(args.pop("page", 1)), 1)
+        except ValueError:
+            abort(BadRequest)
+        page_size = page_size or current_app.config.get("PAGE_SIZE", 100)
+        args["page"] = 1
     
     buttons = {}
+    hide_deleted = False
     if "deleted" in primary_table.c:
-        args = dict(request.args)
         show = args.pop("show", False)
         if show:
             buttons["info"] = (_("Hide Deleted"), url_for(request.endpoint, **request.view_args, **args))
+            args["show"] = show
         else:
-            sql = sql.where(primary_table.c.deleted == False)
+            hide_deleted = True
             buttons["info"] = (_("Show Deleted"), url_for(request.endpoint, show="True", **request.view_args, **args))
             
     #if filters:
@@ -127,30 +404,59 @@ def list_view(*table_definition, title=None):#, **filters):
                          #in filters.items()]
         #sql = sql.where(*where_clauses)
     
-    if upsert_endpoint in current_app.view_functions:
-        clickable = True
-    else:
-        href = None
-    body = OrderedDict()
-    with engine.connect() as conn:
-        for row in conn.execute(sql):
-            columns = []
-            for column in fields:
-                val = column(row) if hasattr(column, "__call__") else row[column]
-                columns += [val]
-                
-            if row["id"] in body:
-                if not isinstance(body[row["id"]][0][0], MergedColumn):
-                    body[row["id"]] = ([MergedColumn(col) for col in body[row["id"]][0]], body[row["id"]][1])
-                for prevcol, newcol in zip(body[row["id"]][0], columns):
-                    prevcol.merge(newcol)
+    if export is not None:
+        sql = plan.statements["all", hide_deleted]
+        return _export(sql, head, fields, primary_table.name, export)
+    export_args = {k: v for k, v in args.items() if k != "page"}
+    url = url_for(request.endpoint, export="csv", **request.view_args, **export_args)
+    buttons["export"] = (_("Export"), url)
+    
+    clickable = upsert_endpoint in current_app.view_functions
+    href = None
+    body = []
+    with read_engine.connect() as conn:
+        conn = conn.execution_options(compiled_cache=_compiled)
+        if paginate:
+            params = {"limit": page_size + 1}
+            if before is not None:
+                values = _decode_key(before, plan.key_length)
+                keysql = plan.seek("before", hide_deleted, values)
+            elif after is not None:
+                values = _decode_key(after, plan.key_length)
+                keysql = plan.seek("after", hide_deleted, values)
             else:
-                if clickable:
-                    href = url_fwrd(upsert_endpoint, row_id=row["id"])
-                deleted = row["deleted"] if "deleted" in row else False
-                body[row["id"]] = tablerow(*columns,
-                                           deleted=deleted,
-                                           href=href)
+                values = []
+                keysql = plan.statements["first", hide_deleted]
+            params.update(("key{}".format(i), val) for i, val
+                          in enumerate(values) if val is not None)
+            keys = [list(row) for row in conn.execute(keysql, params)]
+            more = len(keys) > page_size
+            keys = keys[:page_size]
+            if before is not None:
+                keys.reverse()
+            
+            if keys and (more or before is not None):
+                args["page"] = page + 1
+                url = url_for(request.endpoint, after=json.dumps(keys[-1]), **request.view_args, **args)
+                buttons["next"] = (_("Next"), url)
+            if keys and page > 2 and (more or before is None):
+                args["page"] = page - 1
+                url = url_for(request.endpoint, before=json.dumps(keys[0]), **request.view_args, **args)
+                buttons["previous"] = (_("Previous"), url)
+            elif page == 2:
+                args["page"] = 1
+                url = url_for(request.endpoint, **request.view_args, **args)
+                buttons["previous"] = (_("Previous"), url)
+            sql = plan.statements["page", hide_deleted]
+            rows = conn.execute(sql, ids=[key[-1] for key in keys])
+        else:
+            rows = conn.execute(plan.statements["all", hide_deleted])
+        
+        for row, columns in _merged_rows(rows, fields):
+            if clickable:
+                href = url_fwrd(upsert_endpoint, row_id=row["id"])
+            deleted = row["deleted"] if "deleted" in row else False
+            body += [tablerow(*columns, deleted=deleted, href=href)]
     
     if upsert_endpoint in current_app.view_functions:
         function = current_app.view_functions[upsert_endpoint]
@@ -163,7 +469,7 @@ def list_view(*table_definition, title=None):#, **filters):
         #buttons += [("Reorder", {"href": url_fwrd(reorder_endpoint), "class": "float-right"})]
     return render_page("table.html",
                        title=title or primary_table.name.title(),
-                       table={"head": head, "body": body.values()},
+                       table={"head": head, "body": body},
                        buttons=buttons)
 
 
@@ -212,45 +518,38 @@ def upsert_view(row_id, primary_table, FormClass):
         if "deleted" in primary_table.c:
             columns += [primary_table.c.deleted]
 
+        # The row and its many to many links are loaded in a single round
+        # trip and the choices of every select field in another, or none if
+        # they all come from the reference data cache.
+        links = [name for name, field in form.items()
+                 if hasattr(field, "choices") and name not in primary_table.c]
         if row_id is not None:
-            sql = select(columns).where(primary_table.c.id == row_id)
-            old_data = dict(conn.execute(sql).first() or abort(BadRequest))
+            old_data = logic.select_row(primary_table, columns, row_id, links, conn) or abort(BadRequest)
         else:
             old_data = {}
-            
+        
+        foreign_tables = {}
         for name, field in form.items():
-            if hasattr(field, "choices"):
-
-                # Many to one relationship
-                if name in primary_table.c:
-                    column = primary_table.c[name]
-                    foreign_table = tuple(column.foreign_keys)[0].column.table
-                    sql = select([foreign_table.c.id, foreign_table.c.name]). \
-                            order_by(foreign_table.c.name)
-                    if "deleted" in foreign_table.c:
-                        where = (foreign_table.c.deleted == False)
-                        if row_id is not None:
-                            where = or_(where, foreign_table.c.id == old_data[name])
-                        sql = sql.where(where)
-                    rows = [tuple(row) for row in conn.execute(sql)]
-                
-                # Many to many relationship
-                else:
-                    foreign_table = metadata.tables[name]
-                    m2mtable, primary, secondary = logic._linking_table(primary_table, foreign_table)
-                    sql = select([foreign_table.c.id, foreign_table.c.name, primary]). \
-                            select_from(join(foreign_table, m2mtable, and_(foreign_table.c.id == secondary, primary == row_id), isouter=True)). \
-                            order_by(foreign_table.c.name)
-                    if "deleted" in foreign_table.c:
-                        where = (foreign_table.c.deleted == False)
-                        if row_id is not None:
-                            where = or_(where, primary_col == row_id)
-                        sql = sql.where(where)
-                    rows = [tuple(row) for row in conn.execute(sql)]
-                    if row_id is not None:
-                        old_data[name] = [row[0] for row in rows if row[2]]
-                   
-                choices[name] = field.choices = [tuple(row)[:2] for row in conn.execute(sql)]
+            if not hasattr(field, "choices"):
+                continue
+            
+            # Many to one relationship
+            if name in primary_table.c:
+                column = primary_table.c[name]
+                foreign_tables[name] = tuple(column.foreign_keys)[0].column.table
+            
+            # Many to many relationship
+            else:
+                foreign_tables[name] = metadata.tables[name]
+        
+        reference = cache.reference_choices_for(foreign_tables.values(), conn)
+        for name, foreign_table in foreign_tables.items():
+            if name in primary_table.c:
+                selected = {old_data.get(name, None)}
+            else:
+                selected = old_data.get(name, set())
+            choices[name] = form[name].choices = [choice[:2] for choice in reference[foreign_table.name]
+                                                  if not choice[2] or choice[0] in selected]
  
         form.fill(request.form if request.method == "POST" else old_data)
 
@@ -1,19 +1,31 @@
-from logging import Handler
-from datetime import datetime, now
-from sqlalchemy import create_engine, event, MetaData, Table,Column, Integer, String, DateTime, select, and_
-from flask import has_request_context, current_app, request, session
+import queue
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, DateTime
+from flask import has_request_context, request, g
 
 _engines = {}
+_engines_lock = threading.Lock()
+
 
-def engine():
-    db_url = current_app().config["LOG_URL"]
-    try:
-        return _engines[db_url]
-    except KeyError:
-        engine = create_engine(db_url)
-        metadata.create_all()
-        _engines[db_url] = engine
-        return engine
+
+def engine(db_url):
+    """ Returns the engine for db_url, creating it and the dblog table the
+        first time it is requested.
+    """
+    with _engines_lock:
+        try:
+            return _engines[db_url]
+        except KeyError:
+            engine = create_engine(db_url)
+            metadata.create_all(engine)
+            _engines[db_url] = engine
+            return engine
 
 
 convention = {"ix": "ix_%(column_0_label)s",
@@ -31,7 +43,7 @@ dblog = Table("dblog", metadata,
     Column("logger", String, nullable=False),
     Column("level", String, nullable=False),
     Column("level_numeric", Integer, nullable=False),
-    Column("datetime", DateTime, default=now, nullable=False),
+    Column("datetime", DateTime(timezone=True), nullable=False),
     Column("user_id", Integer),
     Column("user_agent", String),
     Column("remote_addr", String),
@@ -40,70 +52,179 @@ dblog = Table("dblog", metadata,
     Column("args", String),
     Column("form", String),
     Column("sql", String),
-    Column("paramaters", String),
+    Column("parameters", String),
     Column("message", String))
 
+# dblog columns taken from the request_* attributes added to each record.
+_context = ("user_id", "user_agent", "remote_addr", "path", "method", "args", "form")
 
 
 
-class DatabaseHandler(Handler):
-    
-    def emit(record):
-        values = {"logger": record.name,
-                  "level": record.levelname,
-                  "level_numeric": record.level,
-                  "message": record.getMessage(),
-                 }
-        
+class RequestQueueHandler(QueueHandler):
+    """ QueueHandler that adds the details of the current request to each
+        record, as they are only available in the thread that logged it. If
+        the queue is full the record is dropped and counted rather than
+        blocking the caller.
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = super().prepare(record)
         if has_request_context():
-            values["user_id"] = session["user_id"]
-            values["user_agent"] = request.user_agent
-            values["remote_addr"] = request.remote_addr
-            values["path"] = request.path
-            values["method"] = request.method
-            values["args"] = repr(request.args.to_dict())
-            values["form"] = repr(request.form.to_dict())
-
-        if 
-        
-        
-        
-        with engine().connect() as conn:
-        
-        
-        
-        
+            # Only gathered once per request.
+            context = g.get("log_context", None)
+            if context is None:
+                form = {k: "****" if "password" in k else v
+                        for k, v in request.form.to_dict().items()}
+                context = {"request_user_id": g.get("user_id", None),
+                           "request_user_agent": str(request.user_agent),
+                           "request_remote_addr": request.remote_addr,
+                           "request_path": request.path,
+                           "request_method": request.method,
+                           "request_args": repr(request.args.to_dict()),
+                           "request_form": repr(form)}
+                g.log_context = context
+            record.__dict__.update(context)
+        return record
+
+    def enqueue(self, record):
         try:
-            msg = self.format(record)
-            stream = self.stream
-            # issue 35046: merged two stream.writes into one.
-            stream.write(msg + self.terminator)
-            self.flush()
-
-        except Exception:
-            self.handleError(record)
-
-
-
-root_logger = logging.getLogger()
-root_logger.addHandler(DatabaseHandler())
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
 
 
+class DatabaseHandler(logging.Handler):
+    """ Writes records to the dblog table of the database at db_url. Is
+        intended to be used from a BatchQueueListener, which calls
+        emit_batch, so that records are written in a single executemany.
+    """
+    def __init__(self, db_url, level=logging.NOTSET):
+        super().__init__(level)
+        self.db_url = db_url
 
+    def values(self, record):
+        values = {"logger": record.name,
+                  "level": record.levelname,
+                  "level_numeric": record.levelno,
+                  "datetime": datetime.fromtimestamp(record.created, tz=timezone.utc),
+                  "message": record.getMessage(),
+                  "sql": getattr(record, "sql", None),
+                  "parameters": getattr(record, "parameters", None)}
+        for name in _context:
+            values[name] = getattr(record, f"request_{name}", None)
+        if values["parameters"] is not None:
+            values["parameters"] = repr(values["parameters"])
+        return values
+
+    def emit_batch(self, records):
+        records = [record for record in records if record.levelno >= self.level]
+        if not records:
+            return
+        try:
+            with engine(self.db_url).begin() as conn:
+                conn.execute(dblog.insert(), [self.values(record) for record in records])
+        except Exception:
+            self.handleError(records[0])
+
+    def emit(self, record):
+        self.emit_batch([record])
+
+
+
+class BatchQueueListener(QueueListener):
+    """ QueueListener that passes records to its handlers in batches of up to
+        batch_size records. Once a record arrives the listener waits at most
+        interval seconds for the rest of its batch. Batching only uses the
+        public dequeue and handle hooks, dequeue returning a list of records
+        which handle then passes to each handler's emit_batch if it has one.
+    """
+    def __init__(self, queue, *handlers, batch_size=500, interval=1.0):
+        super().__init__(queue, *handlers, respect_handler_level=False)
+        self.batch_size = batch_size
+        self.interval = interval
+        self._stopping = False
+        self._running = False
+
+    def start(self):
+        super().start()
+        self._running = True
+
+    def stop(self):
+        # Safe to call more than once, eg explicitly and then at exit.
+        if self._running:
+            self._running = False
+            super().stop()
+
+    def enqueue_sentinel(self):
+        # Blocks rather than failing if the queue is full.
+        self.queue.put(self._sentinel)
+
+    def dequeue(self, block):
+        if self._stopping:
+            # The sentinel arrived part way through the previous batch.
+            self._stopping = False
+            return self._sentinel
+        record = self.queue.get(block)
+        if record is self._sentinel:
+            return record
+        records = [record]
+        deadline = time.monotonic() + self.interval
+        while len(records) < self.batch_size:
+            try:
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    record = self.queue.get(timeout=timeout)
+                else:
+                    record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is self._sentinel:
+                self._stopping = True
+                break
+            records += [record]
+        return records
+
+    def handle(self, records):
+        records = [self.prepare(record) for record in records]
+        for handler in self.handlers:
+            if hasattr(handler, "emit_batch"):
+                handler.emit_batch(records)
+            else:
+                for record in records:
+                    handler.handle(record)
+
+
+
+def initialise(app, logger=None):
+    """ Sends records of LOG_DB_LEVEL (default WARNING) and above from logger
+        (default the root logger) to the dblog table of the database at
+        LOG_URL. Records are queued in the calling thread and written by a
+        background listener in batches, see LOG_DB_QUEUE_SIZE (default
+        10000), LOG_DB_BATCH_SIZE (default 500) and LOG_DB_INTERVAL (default
+        1 second). Does nothing if LOG_URL is not configured. The listener
+        is stored in app.extensions["log_listener"]. Returns the queue
+        handler.
+    """
+    config = app.config
+    db_url = config.get("LOG_URL", None)
+    if db_url is None:
+        return None
+
+    level = getattr(logging, config.get("LOG_DB_LEVEL", "WARNING"), logging.WARNING)
+    records = queue.Queue(config.get("LOG_DB_QUEUE_SIZE", 10000))
+    handler = RequestQueueHandler(records)
+    handler.setLevel(level)
+    listener = BatchQueueListener(records,
+                                  DatabaseHandler(db_url),
+                                  batch_size=config.get("LOG_DB_BATCH_SIZE", 500),
+                                  interval=config.get("LOG_DB_INTERVAL", 1.0))
+    listener.start()
+    atexit.register(listener.stop)
+    app.extensions["log_listener"] = listener
+
+    (logger or logging.getLogger()).addHandler(handler)
+    return handler
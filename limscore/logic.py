@@ -1,13 +1,19 @@
 import pdb
 from datetime import timedelta
+from collections import defaultdict
+from contextlib import contextmanager
 
-from flask import session
+from flask import session, g, current_app
 
-from sqlalchemy import select, join, outerjoin, or_, and_
+from sqlalchemy import select, join, outerjoin, or_, and_, bindparam, func
+from sqlalchemy import MetaData, Table, Column, ForeignKeyConstraint, PrimaryKeyConstraint, UniqueConstraint
+from sqlalchemy.event import listens_for
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 
-from .models import users, users_groups, editlogs, metadata
+from .models import users, users_groups, editlogs, editlog_changes, metadata
 from.utils import utcnow
+from .cache import table_changed
 
 
 def update_table(table, old_data, new_data, primary_keys, conn):
@@ -35,18 +41,49 @@ def update_table(table, old_data, new_data, primary_keys, conn):
         identifiers = tuple(row.pop(key) for key in primary_keys)
         try:
             if deletes.pop(identifiers) != row:
-                updates += [([getattr(table.c, key) == val for key, val in zip(primary_keys, identifiers)], row)]
+                updates += [(identifiers, row)]
         except KeyError:
             inserts += [unmodified_row]
     
-    for identifiers, values in updates:
-        conn.execute(table.update().where(and_(*identifiers)).values(**values))
+    if updates or inserts or deletes:
+        table_changed(table, conn)
+    _bulk_update(table, primary_keys, updates, conn)
         
     if inserts:
         conn.execute(table.insert(), inserts)
 
-    for identifiers in deletes:
-        conn.execute(table.delete().where(and_(*[getattr(table.c, key) == val for key, val in zip(primary_keys, identifiers)])))
+    if deletes:
+        where = and_(*[getattr(table.c, key) == bindparam(f"pk_{key}") for key in primary_keys])
+        conn.execute(table.delete().where(where),
+                     [{f"pk_{key}": val for key, val in zip(primary_keys, identifiers)} for identifiers in deletes])
+
+
+
+def _bulk_update(table, primary_keys, updates, conn):
+    """Performs updates grouped by the set of columns being changed so that each group is sent as a single executemany.
+
+    Args:
+        table (Table): Table object to be updated.
+        primary_keys (list): Keys to uniquely identify each row, does not have to be the true primary key
+        updates (list): List of (identifiers, values) tuples where identifiers are the values of primary_keys and values is a dict of columns to update.
+        conn (Connection): Sqlalchemy connection.
+        
+    Returns:
+        None
+    """
+    grouped = defaultdict(list)
+    for identifiers, values in updates:
+        if values:
+            params = {f"pk_{key}": val for key, val in zip(primary_keys, identifiers)}
+            params.update((f"set_{key}", val) for key, val in values.items())
+            grouped[tuple(sorted(values))] += [params]
+    
+    where = and_(*[getattr(table.c, key) == bindparam(f"pk_{key}") for key in primary_keys])
+    for columns, params in grouped.items():
+        sql = table.update(). \
+                where(where). \
+                values({column: bindparam(f"set_{column}") for column in columns})
+        conn.execute(sql, params)
 
 
 
@@ -61,7 +98,7 @@ def update_o2m(table, old_data, new_data, primary_key, selected_key, default_dat
         selected_key (str): Name of the key in both old_data and new_data that uniquely identifies the row.
         default_data (dict): additional value pairs to be set during inserts.
         conn (Connection): Sqlalchemy connection.
-        return_pks (bool): If True then return pks of all inserted and updated rows, a bulk insert is used instead of multiple separate inserts if False.
+        return_pks (bool): If True then return pks of all inserted and updated rows, updated rows first then inserted rows, each in the order of new_data. Inserts are a single INSERT ... RETURNING on databases that support it, otherwise an insert per row.
         update (bool): If False then only perform insertions and deletions and do not update entries that already exist in the database.
         
     Returns:
@@ -83,13 +120,22 @@ def update_o2m(table, old_data, new_data, primary_key, selected_key, default_dat
         except KeyError:
             inserts += [{**default_data, **row}]
     
+    updates = [((pk,), {**values, **default_data}) for pk, values in updates]
+    if inserts or old_selected_keys or (update and any(values for pk, values in updates)):
+        table_changed(table, conn)
+    
     if update:
-        for pk, values in updates:
-            conn.execute(table.update().where(table.c.id == pk).values(**values, **default_data))
-            pks += [pk]
+        _bulk_update(table, ["id"], updates, conn)
+        pks += [pk for (pk,), values in updates]
         
     if inserts:
-        if return_pks:
+        if return_pks and _insert_returning(conn):
+            # RETURNING does not guarantee the order of the rows so they are
+            # matched back to inserts by their selected key.
+            sql = table.insert().values(inserts).returning(table.c[selected_key], table.c.id)
+            inserted = dict(tuple(row) for row in conn.execute(sql))
+            pks += [inserted[values[selected_key]] for values in inserts]
+        elif return_pks:
             pks += [conn.execute(table.insert().values(**values)).inserted_primary_key[0] for values in inserts]
         else:
             conn.execute(table.insert().values(inserts))
@@ -99,9 +145,20 @@ def update_o2m(table, old_data, new_data, primary_key, selected_key, default_dat
 
 
 
+def _insert_returning(conn):
+    """ Returns True if the database supports INSERT ... RETURNING with
+        multiple rows in a single statement.
+    """
+    dialect = conn.dialect
+    return getattr(dialect, "insert_returning", dialect.name == "postgresql")
+
+
+
 def upsert(table, unique_data, other_data, conn):
     """Performs an insert of unique_data+other_data into table, if this violates a unique constraint then an update of other_data will be performed instead.
 
+    On PostgreSQL, rows whose unique_data keys are exactly the columns of a primary key, unique constraint or unique index of table are sent as multi-row INSERT ... ON CONFLICT statements. Any other rows, and every row on other databases, fall back to an insert within a savepoint per row.
+
     Args:
         table (Table): Table object to be updated.
         unique_data (dict): Data that could potentially violate a unique constraint in table.
@@ -112,17 +169,68 @@ def upsert(table, unique_data, other_data, conn):
         None.
         
     Raises:
-        Should not raise any exceptions.
+        IntegrityError with ON CONFLICT if a row violates any other constraint, eg a foreign key or NOT NULL, as only the unique constraint on unique_data is handled. The savepoint fallback instead treats every IntegrityError as a conflict, so such rows are updated if they exist and otherwise skipped.
     """
+    table_changed(table, conn)
+    insert = _conflict_insert(conn)
+    unique = _unique_keys(table) if insert is not None else ()
+    grouped = defaultdict(dict)
     for row in unique_data:
-        trans = conn.begin_nested()
-        try:
-            conn.execute(table.insert().values(**row, **other_data))
-            trans.commit()
-        except IntegrityError:
-            trans.rollback()
-            if other_data:
-                conn.execute(table.update().where(and_(*[getattr(table.c, key) == val for key, val in row.items()])).values(**other_data))
+        keys = tuple(sorted(row))
+        grouped[keys][tuple(row[key] for key in keys)] = row
+    
+    for keys, rows in grouped.items():
+        rows = list(rows.values())
+        if frozenset(keys) in unique:
+            rows = [{**row, **other_data} for row in rows]
+            batch_size = max(1, 999 // len(rows[0]))
+            for i in range(0, len(rows), batch_size):
+                sql = insert(table).values(rows[i:i+batch_size])
+                if other_data:
+                    sql = sql.on_conflict_do_update(index_elements=keys,
+                                                    set_=other_data)
+                else:
+                    sql = sql.on_conflict_do_nothing(index_elements=keys)
+                conn.execute(sql)
+            continue
+        
+        for row in rows:
+            trans = conn.begin_nested()
+            try:
+                conn.execute(table.insert().values(**row, **other_data))
+                trans.commit()
+            except IntegrityError:
+                trans.rollback()
+                if other_data:
+                    conn.execute(table.update().where(and_(*[getattr(table.c, key) == val for key, val in row.items()])).values(**other_data))
+
+
+
+def _conflict_insert(conn):
+    """ Returns the dialect specific insert construct that supports
+        ON CONFLICT clauses, or None if the database does not support them.
+        sqlalchemy only has an ON CONFLICT construct for SQLite from 1.4 so
+        SQLite always uses the fallback.
+    """
+    if conn.dialect.name == "postgresql":
+        return postgresql_insert
+
+
+
+def _unique_keys(table):
+    """ Returns the set of frozensets of column names of every primary key,
+        unique constraint and unique index of table, the only column sets
+        that ON CONFLICT can infer an arbiter index from. Partial indexes
+        are excluded as they need their predicate repeated.
+    """
+    keys = set()
+    for constraint in table.constraints:
+        if isinstance(constraint, (PrimaryKeyConstraint, UniqueConstraint)):
+            keys.add(frozenset(column.name for column in constraint.columns))
+    for index in table.indexes:
+        if index.unique and index.dialect_options["postgresql"]["where"] is None:
+            keys.add(frozenset(column.name for column in index.columns))
+    return keys
 
 
 
@@ -268,12 +376,54 @@ def upsert(table, unique_data, other_data, conn):
 
 
 
+
+
+
+def select_row(table, columns, row_id, links=(), conn=None):
+    """ Returns a dict of columns for the row of table with id row_id plus,
+        for each table name in links, a set of the ids of the rows in that
+        table linked to row_id by a many to many linking table, all in a
+        single round trip. The sets are in the format expected for old by
+        crud. Returns None if the row does not exist.
+    """
+    if conn.dialect.name == "postgresql":
+        aggregate = func.array_agg
+    else:
+        aggregate = func.group_concat
+    
+    columns = list(columns)
+    for name in links:
+        m2mtable, primary, secondary = _linking_table(table, metadata.tables[name])
+        columns += [select([aggregate(secondary)]). \
+                        where(primary == table.c.id). \
+                        label(name)]
+    sql = select(columns).where(table.c.id == row_id)
+    row = conn.execute(sql).first()
+    if row is None:
+        return None
+    
+    row = dict(row)
+    for name in links:
+        ids = row[name]
+        if ids is None:
+            row[name] = set()
+        elif isinstance(ids, str):
+            row[name] = set(int(sec_id) for sec_id in ids.split(","))
+        else:
+            row[name] = set(ids)
+    return row
 
 
 
 def crud(table, new, old={}, conn=None, **choices):
+    with batch_crudlog(conn):
+        return _crud(table, new, old, conn, **choices)
+
+
+
+def _crud(table, new, old={}, conn=None, **choices):
     deleted = None
-    changed = {k: v for k, v in new.items() if not isinstance(v, list) and v != old.get(k, None)}
+    changed = {k: v for k, v in new.items() if not isinstance(v, (list, set)) and v != old.get(k, None)}
     if "id" in old:
         row_id = old["id"]
         if changed:
@@ -281,10 +431,12 @@ def crud(table, new, old={}, conn=None, **choices):
                     where(table.c.id == row_id). \
                     values(**changed)
             conn.execute(sql)
+            table_changed(table, conn)
             action = "Edited"
     else:
         sql = table.insert().values(**changed)
         row_id = conn.execute(sql).inserted_primary_key[0]
+        table_changed(table, conn)
         action = "Created"
 
     deleted = changed.pop("deleted", None)
@@ -299,27 +451,30 @@ def crud(table, new, old={}, conn=None, **choices):
         crudlog(table.name, row_id, action, loggable, conn)
     
     for k, v in new.items():
-        if isinstance(v, list):
-            new_ids = set(v)
-            old_ids = set(old.get(k, ()))
+        if isinstance(v, (list, set)):
+            new_ids = v if isinstance(v, set) else set(v)
+            old_ids = old.get(k, set())
+            if not isinstance(old_ids, set):
+                old_ids = set(old_ids)
             to_ins = new_ids - old_ids
             to_del = old_ids - new_ids
             if to_ins or to_del:
                 m2mtable, primary, secondary = _linking_table(table, metadata.tables[k])
                 names = dict(choice[:2] for choice in choices[k])
+                table_changed(m2mtable, conn)
                 
                 if to_ins:
                     data = [{primary.name: row_id, secondary.name: sec_id}
                             for sec_id in to_ins]
                     conn.execute(m2mtable.insert(), data)
-                    items = ", ".join(names[sec_id] for sec_id in to_ins)
+                    items = sorted(names[sec_id] for sec_id in to_ins)
                     crudlog(table.name, row_id, "Added", {k: items}, conn)
                 
                 if to_del:
                     sql = m2mtable.delete().where(and_(primary == row_id,
                                                     secondary.in_(to_del)))
                     conn.execute(sql)
-                    items = ", ".join(names[sec_id] for sec_id in to_del)
+                    items = sorted(names[sec_id] for sec_id in to_del)
                     crudlog(table.name, row_id, "Removed", {k: items}, conn)
         
     if deleted is not None:
@@ -336,35 +491,156 @@ def crud(table, new, old={}, conn=None, **choices):
 
 
 
+def _json_value(value):
+    if isinstance(value, (list, tuple)):
+        return [_json_value(item) for item in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+
+def _changes(entries):
+    """ Returns the editlog_changes rows for a list of editlogs rows, one per
+        field or one per item if the value of the field is a list.
+    """
+    changes = []
+    for entry in entries:
+        for field, value in entry["details"].items():
+            for item in (value if isinstance(value, list) else [value]):
+                changes += [{"tablename": entry["tablename"],
+                             "row_id": entry["row_id"],
+                             "field": field,
+                             "value": None if item is None else str(item),
+                             "action": entry["action"],
+                             "user_id": entry["user_id"],
+                             "datetime": entry["datetime"]}]
+    return changes
+
+
+
+def _write_editlogs(entries, conn):
+    conn.execute(editlogs.insert(), entries)
+    if current_app.config.get("EDITLOG_CHANGES", False):
+        changes = _changes(entries)
+        if changes:
+            conn.execute(editlog_changes.insert(), changes)
+
+
+
+def details_has_field(field, dialect):
+    """ Returns a where clause selecting the editlogs rows whose details
+        contain field. Uses the gin index on details with postgres.
+    """
+    if dialect.name == "postgresql":
+        return editlogs.c.details.op("?")(field)
+    path = '$."{}"'.format(field.replace('"', '\\"'))
+    return func.json_type(editlogs.c.details, path).isnot(None)
+
+
+
 def crudlog(tablename, row_id, action, details={}, conn=None):
-    details = "\t".join(f"{k}={v}" for k, v in sorted(details.items()))
-    conn.execute(editlogs.insert().values(tablename=str(tablename),
-                                             row_id=row_id,
-                                             action=action,
-                                             details=details,
-                                             user_id=session.get("id", None),
-                                             datetime=utcnow()))
+    """ Writes an entry to editlogs. Details is a dict of field name to value
+        and is stored as JSON, lists of names are used for many to many
+        fields. If EDITLOG_CHANGES is set in the config then each field is
+        also written to editlog_changes so that changes can be found by field
+        and value using an index. If called within a batch_crudlog block then
+        the entry is added to the batch rather than being inserted
+        immediately.
+    """
+    values = {"tablename": str(tablename),
+              "row_id": row_id,
+              "action": action,
+              "details": {k: _json_value(v) for k, v in details.items()}}
+    batch = g.get("crudlog_batch", None)
+    if batch is not None:
+        batch += [values]
+    else:
+        _write_editlogs([{"user_id": session.get("id", None),
+                          "datetime": utcnow(),
+                          **values}], conn)
+
+
+
+@contextmanager
+def batch_crudlog(conn):
+    """ Context manager that collects all editlogs entries written by crud or
+        crudlog within the block and inserts them with a single executemany
+        on exit, all with the same user and timestamp. Blocks can be nested,
+        in which case entries are only inserted on exit from the outermost
+        block. Use around a loop of crud calls when saving many rows in one
+        transaction.
+    """
+    if g.get("crudlog_batch", None) is not None:
+        yield
+        return
+    
+    g.crudlog_batch = batch = []
+    try:
+        yield
+    finally:
+        g.crudlog_batch = None
+    if batch:
+        user_id = session.get("id", None)
+        now = utcnow()
+        _write_editlogs([{"user_id": user_id,
+                          "datetime": now,
+                          **values} for values in batch], conn)
+
+
+
+_linking_index = {}
+# Advanced for a metadata whenever a table is attached to it or a column or
+# foreign key constraint is attached to one of its tables, so that
+# redefined tables are re-indexed. Column proxies of aliases and selects
+# are not attached to a Table so do not count.
+_schema_versions = defaultdict(int)
+
+
+
+@listens_for(Table, "after_parent_attach")
+def _table_attached(table, metadata):
+    if isinstance(metadata, MetaData):
+        _schema_versions[metadata] += 1
+
+
+
+@listens_for(Column, "after_parent_attach")
+@listens_for(ForeignKeyConstraint, "after_parent_attach")
+def _table_extended(target, table):
+    if isinstance(table, Table) and table.metadata is not None:
+        _schema_versions[table.metadata] += 1
+
+
+
+def _linking_tables(table1, table2):
+    """ Returns a list of (linking_table, column1, column2) for every table
+        with foreign keys to both table1 and table2 in metadata.sorted_tables
+        order, column1 referencing table1 and column2 table2. The foreign key
+        graph is indexed once per metadata and only re-indexed if tables are
+        added to, replaced in or removed from the metadata or tables are
+        extended.
+    """
+    metadata = table1.metadata
+    version = (len(metadata.tables), _schema_versions[metadata])
+    current, index = _linking_index.get(metadata, (None, None))
+    if current != version:
+        index = defaultdict(list)
+        for table in metadata.sorted_tables:
+            foreign = [(tuple(col.foreign_keys)[0].column.table, col)
+                       for col in table.c
+                       if col.foreign_keys]
+            for foreign1, col1 in foreign:
+                for foreign2, col2 in foreign:
+                    if foreign1 is not foreign2:
+                        index[foreign1, foreign2] += [(table, col1, col2)]
+        _linking_index[metadata] = (version, index)
+    return index.get((table1, table2), [])
 
 
 
 def _linking_table(table1, table2):
-    found = 0
-    for table in metadata.sorted_tables:
-        if table == table1 or table == table2:
-            found += 1
+    for table, primary, secondary in _linking_tables(table1, table2):
         # Is len == 2 really the best way of identifying a linking table?
-        elif found == 2 and len(table.c) == 2:
-            joined = [tuple(col.foreign_keys)[0].column.table
-                      for col in table.c 
-                      if col.foreign_keys]
-            
-            if table1 in joined and table2 in joined:
-                for col in table.c:
-                    if col.foreign_keys:
-                        thistable = tuple(col.foreign_keys)[0].column.table
-                        if thistable == table1:
-                            primary = col
-                        elif thistable == table2:
-                            secondary = col
-                return (table, primary, secondary)
-    
+        if len(table.c) == 2:
+            return (table, primary, secondary)
@@ -4,13 +4,17 @@ import sys
 from passlib.hash import bcrypt_sha256
 
 from alembic.config import CommandLine
-from sqlalchemy import select
+from sqlalchemy import select, func, bindparam, type_coerce, inspect, text, String
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.exc import IntegrityError
 
 from .utils import valid_groups
 from .models import (users,
-                     groups)
-from . import logic, auth
+                     groups,
+                     editlogs,
+                     editlog_changes,
+                     editlogs_details_gin)
+from . import logic, auth, partitions
 
 
 def run_alembic(package):
@@ -28,6 +32,13 @@ def run_alembic(package):
     
     if sys.argv[1] == "upgrade":
         with app.extensions["engine"].begin() as conn:
+            partition_logs(conn)
+            partitions.maintain(conn, app.config)
+            convert_editlogs(conn)
+            if app.config.get("EDITLOG_CHANGES", False) and \
+                    conn.execute(select([editlog_changes.c.id])).first() is None:
+                backfill_editlog_changes(conn)
+            
             for name in valid_groups:
                 trans = conn.begin_nested()
                 try:
@@ -55,3 +66,107 @@ def run_alembic(package):
                         logic.crud(users, new, conn=conn, groups=group_id_choices)
                         auth.send_setpassword_email(email, conn)
                     print(f"Admin login emailed to {email}.")
+
+
+
+def _parse_details(text):
+    """ Parses the tab separated k=v format previously used for editlogs
+        details.
+    """
+    details = {}
+    for item in text.split("\t"):
+        if item:
+            k, _, v = item.partition("=")
+            details[k] = v
+    return details
+
+
+
+def convert_editlogs(conn, batch_size=1000):
+    """ Converts any editlogs details still in the old tab separated k=v text
+        format to JSON, a batch at a time. With postgres the column is first
+        altered to jsonb, if an autogenerated alembic revision contains an
+        alter_column for editlogs.details it should be removed in favour of
+        this. Can safely be run repeatedly.
+    """
+    if conn.dialect.name == "postgresql":
+        column = [column for column in inspect(conn).get_columns("editlogs")
+                  if column["name"] == "details"][0]
+        if not isinstance(column["type"], JSONB):
+            conn.execute("ALTER TABLE editlogs ALTER COLUMN details "
+                         "TYPE jsonb USING to_jsonb(details)")
+            editlogs_details_gin.execute(conn)
+        old_format = func.jsonb_typeof(editlogs.c.details) == "string"
+    else:
+        old_format = func.substr(type_coerce(editlogs.c.details, String), 1, 1) != "{"
+    
+    select_sql = select([editlogs.c.id, type_coerce(editlogs.c.details, String)]). \
+                    where(old_format). \
+                    order_by(editlogs.c.id). \
+                    limit(batch_size)
+    update_sql = editlogs.update(). \
+                    where(editlogs.c.id == bindparam("pk")). \
+                    values(details=bindparam("new_details"))
+    while True:
+        rows = conn.execute(select_sql).fetchall()
+        if not rows:
+            break
+        conn.execute(update_sql, [{"pk": row_id, "new_details": _parse_details(text)}
+                                  for row_id, text in rows])
+
+
+
+def backfill_editlog_changes(conn, batch_size=1000):
+    """ Populates editlog_changes from every existing editlogs row.
+    """
+    sql = select([editlogs]). \
+            where(editlogs.c.id > bindparam("last")). \
+            order_by(editlogs.c.id). \
+            limit(batch_size)
+    last = 0
+    while True:
+        rows = [dict(row) for row in conn.execute(sql, last=last)]
+        if not rows:
+            break
+        changes = logic._changes(rows)
+        if changes:
+            conn.execute(editlog_changes.insert(), changes)
+        last = rows[-1]["id"]
+
+
+
+def partition_logs(conn):
+    """ Postgres only. Converts any of the log tables that were created before
+        they were partitioned into partitioned tables. The old table is
+        renamed, the partitioned table created with partitions for every
+        month that has rows, the rows copied across and the old table
+        dropped. Can safely be run repeatedly.
+    """
+    if conn.dialect.name != "postgresql":
+        return
+    sql = text("SELECT relkind FROM pg_class WHERE relname = :name "
+               "AND relnamespace = 'public'::regnamespace")
+    for table in partitions.partitioned_tables:
+        if conn.execute(sql, name=table.name).scalar() != "r":
+            continue
+        old = f"{table.name}_unpartitioned"
+        for index in inspect(conn).get_indexes(table.name):
+            conn.execute(f"DROP INDEX {index['name']}")
+        conn.execute(f"ALTER TABLE {table.name} RENAME CONSTRAINT pk_{table.name} TO pk_{old}")
+        conn.execute(f"ALTER TABLE {table.name} RENAME TO {old}")
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:name, 'id')"),
+                                name=old).scalar()
+        if sequence is not None:
+            conn.execute(f"ALTER SEQUENCE {sequence} RENAME TO {old}_id_seq")
+        table.create(conn)
+        
+        months = conn.execute(f"SELECT DISTINCT date_trunc('month', datetime AT TIME ZONE 'UTC') FROM {old}")
+        for (month,) in months.fetchall():
+            partitions.ensure_partitions(conn, months_ahead=0, now=month)
+        # The old table may predate columns added since, such as duration.
+        old_columns = set(column["name"] for column in inspect(conn).get_columns(old))
+        columns = ", ".join(column.name for column in table.c if column.name in old_columns)
+        conn.execute(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old}")
+        conn.execute(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                     f"COALESCE((SELECT max(id) FROM {table.name}), 0) + 1, false)")
+        conn.execute(f"DROP TABLE {old}")
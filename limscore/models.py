@@ -10,20 +10,38 @@ from sqlalchemy import (MetaData,
                         UniqueConstraint,
                         Date,
                         CheckConstraint,
-                        ForeignKeyConstraint)
+                        ForeignKeyConstraint,
+                        Index,
+                        Float,
+                        JSON,
+                        DDL)
 
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.event import listens_for
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import DBAPIError
+from flask import has_request_context, request
 import sqlalchemy
+import os
+import time
+import threading
+import itertools
+
+from .profiling import instrument
+from .cache import cache_events
 
 __all__ = ("metadata",
            "create_engine",
+           "create_read_engine",
+           "pool_status",
            "users",
            "users_groups",
            "groups",
            "configurations",
            "editlogs",
+           "editlog_changes",
+           "sessions",
            "requestlogs")
 
 
@@ -37,49 +55,223 @@ metadata = MetaData(naming_convention=conv)
 
 
 
-def create_engine(db_url, *args, **kwargs):
+# Instance config keys and the create_engine arguments they map to, the
+# second group only apply to QueuePool so are not used with SQLite.
+_engine_config = {"DB_POOL_RECYCLE": "pool_recycle",
+                  "DB_POOL_PRE_PING": "pool_pre_ping"}
+_queue_pool_config = {"DB_POOL_SIZE": "pool_size",
+                      "DB_MAX_OVERFLOW": "max_overflow",
+                      "DB_POOL_TIMEOUT": "pool_timeout"}
+# The statement cache was only added in sqlalchemy 1.4.
+if tuple(int(n) for n in sqlalchemy.__version__.split(".")[:2]) >= (1, 4):
+    _engine_config["DB_STATEMENT_CACHE_SIZE"] = "query_cache_size"
+
+
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool that also records how many checkouts have had to wait for
+        a connection to become available, because the pool and its overflow
+        were exhausted, and for how long.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._timing_lock = threading.Lock()
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+    
+    def _do_get(self):
+        if self.checkedin() > 0 or self._max_overflow < 0 or \
+                self._overflow < self._max_overflow:
+            return super()._do_get()
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._timing_lock:
+                self.waits += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+
+
+def _sqlite_begin(conn):
+    """ Returns the BEGIN statement for a transaction of the SQLite WAL
+        profile. BEGIN IMMEDIATE takes the write lock at the start of the
+        transaction, waiting up to the busy timeout, rather than failing
+        when a read lock cannot be upgraded part way through, but it
+        serializes the transaction against every writer. Transactions of GET
+        and HEAD requests are assumed to be read only and use a deferred
+        BEGIN so that they run alongside writers, everything else is
+        IMMEDIATE. A transaction can choose with the sqlite_begin execution
+        option, eg engine.execution_options(sqlite_begin="IMMEDIATE").begin()
+        for a GET request that writes after reading.
+    """
+    mode = conn.get_execution_options().get("sqlite_begin", None)
+    if mode is None:
+        read_only = has_request_context() and request.method in ("GET", "HEAD")
+        mode = "DEFERRED" if read_only else "IMMEDIATE"
+    return f"BEGIN {mode}"
+
+
+
+def create_engine(db_url, *args, config={}, **kwargs):
     """ Simple wrapper around sqlalchemy.create_engine with a few database
-        specifc settings.
+        specifc settings. Pool settings are read from the DB_* keys in
+        config, if the pool size is not set it defaults to the number of
+        waitress threads. Setting DB_SQLITE_WAL enables WAL mode and tuned
+        pragmas for SQLite, see _sqlite_begin and DB_SQLITE_BUSY_TIMEOUT (ms),
+        DB_SQLITE_MMAP_SIZE (bytes) and DB_SQLITE_CACHE_SIZE (pages, or KiB
+        if negative).
     """
     if db_url.startswith("postgresql"):
-        kwargs["isolation_level"] = "SERIALIZABLE"
+        kwargs.setdefault("isolation_level", "SERIALIZABLE")
+    for key, option in _engine_config.items():
+        if key in config:
+            kwargs.setdefault(option, config[key])
+    if not db_url.startswith("sqlite://"):
+        for key, option in _queue_pool_config.items():
+            if key in config:
+                kwargs.setdefault(option, config[key])
+        kwargs.setdefault("poolclass", TimedQueuePool)
+        threads = int(os.environ.get("WAITRESS_THREADS", 0))
+        if threads:
+            kwargs.setdefault("pool_size", threads)
     engine = sqlalchemy.create_engine(db_url, *args, **kwargs)
 
     if db_url.startswith("sqlite://"):
+        # Opt-in profile for single node deployments. WAL allows readers to
+        # continue while a write is in progress, see _sqlite_begin for when
+        # the write lock is taken.
+        pragmas = []
+        wal = config.get("DB_SQLITE_WAL", False)
+        if wal:
+            pragmas = ["journal_mode=WAL",
+                       "synchronous=NORMAL",
+                       "busy_timeout={}".format(int(config.get("DB_SQLITE_BUSY_TIMEOUT", 5000))),
+                       "mmap_size={}".format(int(config.get("DB_SQLITE_MMAP_SIZE", 268435456))),
+                       "cache_size={}".format(int(config.get("DB_SQLITE_CACHE_SIZE", -65536)))]
+        
         @listens_for(engine, "connect")
         def do_connect(dbapi_connection, connection_record):
             # disable pysqlite's emitting of the BEGIN statement entirely.
             # also stops it from emitting COMMIT before any DDL.
             dbapi_connection.isolation_level = None
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(f"PRAGMA {pragma}")
+            cursor.close()
 
         @listens_for(engine, "begin")
         def do_begin(conn):
             # emit our own BEGIN
-            conn.execute("BEGIN")
+            conn.execute(_sqlite_begin(conn) if wal else "BEGIN")
 
     # Requires postgres version >= 10
     if db_url.startswith("postgresql"):
         @compiles(sqlalchemy.schema.CreateColumn, 'postgresql')
         def use_identity(element, compiler, **kw):
             text = compiler.visit_create_column(element, **kw)
-            text = text.replace("SERIAL",
-                                "INT GENERATED BY DEFAULT AS IDENTITY")
+            # Identity columns are not supported on partitioned tables
+            # before postgres 17.
+            if element.element.table.dialect_options["postgresql"]["partition_by"] is None:
+                text = text.replace("SERIAL",
+                                    "INT GENERATED BY DEFAULT AS IDENTITY")
+            return text
+        
+        @compiles(sqlalchemy.schema.PrimaryKeyConstraint, 'postgresql')
+        def partition_key(element, compiler, **kw):
+            text = compiler.visit_primary_key_constraint(element, **kw)
+            partition_by = element.table.dialect_options["postgresql"]["partition_by"]
+            if partition_by is not None:
+                key = partition_by.split("(")[1].split(")")[0]
+                text = "{}, {})".format(text.rstrip()[:-1], key)
             return text
         
-    #@listens_for(engine, 'before_cursor_execute')
-    #def receive_before_cursor_execute(conn,
-                                      #cursor,
-                                      #statement,
-                                      #parameters,
-                                      #context,
-                                      #executemany):
-        #if not statement.startswith("SELECT"):
-            #print(statement, repr(parameters))
+    instrument(engine, config)
+    cache_events(engine)
     
     return engine
 
 
 
+class ReadEngine(object):
+    """ Engine for read only queries that hands out connections to a set of
+        read replicas in round-robin order. A replica that fails to connect
+        is skipped for retry_after seconds and if no replica is available
+        the primary engine is used instead. All other attributes are those
+        of the primary engine.
+    """
+    def __init__(self, primary, replicas, retry_after=30):
+        self.primary = primary
+        self.replicas = replicas
+        self.retry_after = retry_after
+        self._counter = itertools.count()
+        self._down = {}
+    
+    def connect(self):
+        start = next(self._counter)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            down = self._down.get(replica, None)
+            if down is not None and time.monotonic() - down < self.retry_after:
+                continue
+            try:
+                conn = replica.connect()
+            except DBAPIError:
+                self._down[replica] = time.monotonic()
+            else:
+                self._down.pop(replica, None)
+                return conn
+        return self.primary.connect()
+    
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+
+
+def create_read_engine(primary, replica_urls, config={}):
+    """ Returns a ReadEngine for replica_urls, or primary itself if there
+        are no replicas. Hot standbys cannot run serializable transactions
+        so replicas use repeatable read instead. Replicas may lag behind the
+        primary so should only be used for views that can tolerate slightly
+        stale data. Replica connections are pinged on checkout so that a
+        replica that has gone away is detected when connecting. utils.read_engine uses the primary for the request after
+        a write so that users still see their own changes.
+    """
+    if not replica_urls:
+        return primary
+    replicas = []
+    for url in replica_urls:
+        # A stale pooled connection, eg after a replica restarts, would only
+        # fail once a statement is executed, too late to use the primary.
+        kwargs = {"pool_pre_ping": True}
+        if url.startswith("postgresql"):
+            kwargs["isolation_level"] = "REPEATABLE READ"
+        replicas += [create_engine(url, config=config, **kwargs)]
+    return ReadEngine(primary, replicas)
+
+
+
+def pool_status(engine):
+    """ Returns a dict of live connection pool statistics for monitoring.
+    """
+    pool = engine.pool
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(size=pool.size(),
+                      checked_in=pool.checkedin(),
+                      checked_out=pool.checkedout(),
+                      overflow=max(pool.overflow(), 0))
+    if isinstance(pool, TimedQueuePool):
+        status.update(waits=pool.waits,
+                      wait_time=pool.wait_time,
+                      max_wait=pool.max_wait)
+    return status
+
+
+
 users = Table("users", metadata,
     Column("id", Integer, primary_key=True),
     Column("email", String, unique=True, nullable=False, info={"log": True}),
@@ -148,15 +340,49 @@ configurations = Table("configurations", metadata,
 
 editlogs = Table("editlogs", metadata,
     Column("id", Integer, primary_key=True, nullable=False),
-    Column("tablename", String, nullable=False, index=True),
+    Column("tablename", String, nullable=False),
     Column("row_id", Integer, nullable=False, index=True),
     Column("action", String, nullable=False),
-    Column("details", String, nullable=False),
+    Column("details", JSON().with_variant(JSONB, "postgresql"), default={}, nullable=False),
     Column("user_id", Integer, ForeignKey("users.id"), nullable=True),
-    Column("datetime", DateTime(timezone=True), nullable=False))
+    Column("datetime", DateTime(timezone=True), nullable=False),
+    Index("ix_editlogs_tablename_row_id_datetime_id", "tablename", "row_id", "datetime", "id"))
+
+# Supports key and containment queries on details, eg details ? 'email' or
+# details @> '{"email": "x"}'.
+editlogs_details_gin = DDL("CREATE INDEX IF NOT EXISTS ix_editlogs_details "
+                           "ON editlogs USING gin (details)")
+sqlalchemy.event.listen(editlogs, "after_create",
+                        editlogs_details_gin.execute_if(dialect="postgresql"))
+
+
+
+# One row per field per editlogs entry, only written if EDITLOG_CHANGES is
+# set in the config. Many to many changes have one row per item.
+editlog_changes = Table("editlog_changes", metadata,
+    Column("id", Integer, primary_key=True, nullable=False),
+    Column("tablename", String, nullable=False),
+    Column("row_id", Integer, nullable=False),
+    Column("field", String, nullable=False),
+    Column("value", String, nullable=True),
+    Column("action", String, nullable=False),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=True),
+    Column("datetime", DateTime(timezone=True), nullable=False),
+    Index("ix_editlog_changes_tablename_field_value", "tablename", "field", "value"),
+    Index("ix_editlog_changes_tablename_row_id", "tablename", "row_id"))
+
+
+
+# Used by sessions.DatabaseStore when SESSION_BACKEND is "database".
+sessions = Table("sessions", metadata,
+    Column("id", String, primary_key=True, nullable=False),
+    Column("data", String, nullable=False),
+    Column("expires", DateTime(timezone=True), nullable=False, index=True))
 
 
 
+# Partitioned by month with postgres, see partitions.py. The partition key
+# must be part of the primary key so it is added when the table is created.
 requestlogs = Table("requestlogs", metadata,
     Column("id", Integer, primary_key=True, nullable=False),
     Column("ip_address", String, nullable=False, index=True),
@@ -164,7 +390,9 @@ requestlogs = Table("requestlogs", metadata,
     Column("method", String, nullable=False),
     Column("response", String, nullable=False),
     Column("user_id", Integer, ForeignKey("users.id"), nullable=True),
-    Column("datetime", DateTime(timezone=True), nullable=False))
+    Column("duration", Float, nullable=True),
+    Column("datetime", DateTime(timezone=True), nullable=False),
+    postgresql_partition_by="RANGE (datetime)")
 
 
 
@@ -175,6 +403,7 @@ accesslogs = Table("accesslogs", metadata,
     Column("method", String, nullable=False),
     Column("response", String, nullable=False),
     Column("user_id", Integer, ForeignKey("users.id"), nullable=True),
-    Column("datetime", DateTime(timezone=True), nullable=False))
+    Column("datetime", DateTime(timezone=True), nullable=False),
+    postgresql_partition_by="RANGE (datetime)")
 
 
@@ -0,0 +1,215 @@
+import re
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+
+from sqlalchemy import select, func, text, table as table_clause, column
+
+from .models import requestlogs, accesslogs
+
+__all__ = ("partitioned_tables",
+           "ensure_partitions",
+           "rotate",
+           "expire",
+           "maintain",
+           "start_maintenance",
+           "include_object")
+
+
+
+logger = logging.getLogger(__name__)
+
+partitioned_tables = (requestlogs, accesslogs)
+
+# Arbitrary key for the postgres advisory lock that stops two processes
+# maintaining the partitions at the same time.
+_LOCK_KEY = 7264310
+
+# Names of the monthly, default and archived tables of partitioned_tables.
+_monthly_name = re.compile(r"({})_(\d{{4}}_\d{{2}}|default)$".format(
+                           "|".join(re.escape(table.name) for table in partitioned_tables)))
+
+
+
+def _month(dt, months=0):
+    """ Returns the start of the month months after the month containing dt.
+    """
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+
+def _partition_name(table, month):
+    return "{}_{:04d}_{:02d}".format(table.name, month.year, month.month)
+
+
+
+def _monthly_tables(table, conn):
+    """ Returns a dict of the start of the month to table name of every
+        monthly partition or archive table of table.
+    """
+    if conn.dialect.name == "postgresql":
+        sql = text("SELECT child.relname FROM pg_inherits "
+                   "JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid "
+                   "JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent "
+                   "WHERE parent.relname = :name")
+    else:
+        sql = text("SELECT name FROM sqlite_master "
+                   "WHERE type = 'table' AND name LIKE :name || '_%'")
+    pattern = re.compile(r"{}_(\d{{4}})_(\d{{2}})$".format(re.escape(table.name)))
+    tables = {}
+    for (name,) in conn.execute(sql, name=table.name):
+        match = pattern.match(name)
+        if match:
+            month = datetime(int(match[1]), int(match[2]), 1, tzinfo=timezone.utc)
+            tables[month] = name
+    return tables
+
+
+
+def ensure_partitions(conn, months_ahead=2, now=None):
+    """ Postgres only. Creates the monthly partitions of every partitioned
+        table from the current month to months_ahead months in the future,
+        plus a default partition to catch any rows outside these ranges.
+        Rows already in the default partition for a month that is being
+        created are moved into the new partition, as postgres refuses to add
+        a partition whose range overlaps rows held by the default.
+    """
+    now = now or datetime.now(tz=timezone.utc)
+    for table in partitioned_tables:
+        default = "{}_default".format(table.name)
+        conn.execute("CREATE TABLE IF NOT EXISTS {} "
+                     "PARTITION OF {} DEFAULT".format(default, table.name))
+        existing = _monthly_tables(table, conn)
+        for i in range(months_ahead + 1):
+            month = _month(now, i)
+            if month in existing:
+                continue
+            name = _partition_name(table, month)
+            start = month.isoformat()
+            end = _month(month, 1).isoformat()
+            conn.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS "
+                         "INCLUDING CONSTRAINTS)".format(name, table.name))
+            conn.execute("WITH moved AS (DELETE FROM {0} WHERE datetime >= '{2}' "
+                         "AND datetime < '{3}' RETURNING *) "
+                         "INSERT INTO {1} SELECT * FROM moved".format(default, name, start, end))
+            conn.execute("ALTER TABLE {} ATTACH PARTITION {} "
+                         "FOR VALUES FROM ('{}') TO ('{}')".format(table.name, name, start, end))
+
+
+
+def rotate(conn, now=None):
+    """ SQLite fallback for partitioning. Moves every row from before the
+        current month into a table for the month that it belongs to, so the
+        live table only ever holds the current month.
+    """
+    now = now or datetime.now(tz=timezone.utc)
+    current = _month(now)
+    for table in partitioned_tables:
+        # Maintenance may start before the tables have been created.
+        if not conn.dialect.has_table(conn, table.name):
+            continue
+        oldest = select([func.min(table.c.datetime)])
+        while True:
+            month = conn.execute(oldest).scalar()
+            if month is None or _month(month) >= current:
+                break
+            month = _month(month)
+            where = (table.c.datetime >= month) & (table.c.datetime < _month(month, 1))
+            name = _partition_name(table, month)
+            conn.execute("CREATE TABLE IF NOT EXISTS {} AS "
+                         "SELECT * FROM {} WHERE 0".format(name, table.name))
+            archive = table_clause(name, *(column(col.name) for col in table.c))
+            conn.execute(archive.insert().from_select([col.name for col in table.c],
+                                                      select(list(table.c)).where(where)))
+            conn.execute(table.delete().where(where))
+
+
+
+def expire(conn, keep_months, archive=False, now=None):
+    """ Removes the monthly tables of every partitioned table that are older
+        than the current month plus keep_months previous months. With
+        postgres, if archive is True then expired partitions are detached
+        rather than dropped so that they can be backed up and dropped by
+        hand. Archiving is not supported with SQLite.
+    """
+    postgres = conn.dialect.name == "postgresql"
+    if archive and not postgres:
+        raise RuntimeError("LOG_ARCHIVE is only supported with postgres.")
+    cutoff = _month(now or datetime.now(tz=timezone.utc), -keep_months)
+    for table in partitioned_tables:
+        for month, name in sorted(_monthly_tables(table, conn).items()):
+            if month >= cutoff:
+                break
+            if not archive:
+                conn.execute("DROP TABLE {}".format(name))
+            else:
+                conn.execute("ALTER TABLE {} DETACH PARTITION {}".format(table.name, name))
+            logger.info("%s %s.", "Archived" if archive else "Dropped", name)
+
+
+
+def maintain(conn, config={}, now=None):
+    """ Creates upcoming partitions (postgres) or rotates the live tables
+        (SQLite) then applies the retention policy. LOG_PARTITIONS_AHEAD
+        (default 2) is the number of months of future partitions to create,
+        LOG_RETENTION_MONTHS (default None, keep forever) the number of
+        complete months to keep and LOG_ARCHIVE whether expired postgres
+        partitions are detached rather than dropped.
+        
+        Must be run regularly. migration.run_alembic runs it on every
+        upgrade and init_app starts a daily thread if LOG_MAINTENANCE is
+        True, which should only be set for one long running process as the
+        thread runs DDL. Without it postgres rows are written to the default
+        partition once the months ahead run out and SQLite tables grow
+        without limit.
+    """
+    if conn.dialect.name == "postgresql":
+        if not conn.execute(select([func.pg_try_advisory_xact_lock(_LOCK_KEY)])).scalar():
+            return
+        ensure_partitions(conn, config.get("LOG_PARTITIONS_AHEAD", 2), now=now)
+    else:
+        rotate(conn, now=now)
+
+    keep_months = config.get("LOG_RETENTION_MONTHS", None)
+    if keep_months is not None:
+        expire(conn, keep_months, config.get("LOG_ARCHIVE", False), now=now)
+
+
+
+def start_maintenance(engine, config={}, interval=86400):
+    """ Starts a daemon thread that runs maintain immediately and then every
+        interval seconds.
+    """
+    def run():
+        while True:
+            try:
+                with engine.begin() as conn:
+                    maintain(conn, config)
+            except Exception:
+                logger.exception("Log table maintenance failed.")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="limscore-partitions", daemon=True)
+    thread.start()
+
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """ Alembic include_object hook that hides the monthly, default and
+        archived tables of the partitioned tables, and their indexes, from
+        autogenerate as they are not in the metadata and would otherwise be
+        dropped. Pass it to context.configure in the alembic env.py, eg
+        context.configure(connection=connection,
+                          target_metadata=target_metadata,
+                          include_object=limscore.partitions.include_object)
+    """
+    if not reflected or compare_to is not None:
+        return True
+    if type_ == "table":
+        return not _monthly_name.match(name)
+    table = getattr(object, "table", None)
+    if table is not None:
+        return not _monthly_name.match(table.name)
+    return True
@@ -0,0 +1,93 @@
+import time
+import threading
+from collections import namedtuple
+
+from flask import current_app
+
+from .models import users, groups, sites, projects
+from .logic import select_row
+from . import cache
+
+__all__ = ("Permissions",
+           "permissions",
+           "version",
+           "discard")
+
+
+
+Permissions = namedtuple("Permissions", ["groups", "sites", "projects", "restricted"])
+Permissions.__doc__ = """ The groups, sites and projects held by a user, each a dict of
+    id to name in name order, with deleted sites and projects excluded,
+    plus the restricted flag of the user.
+"""
+
+# Tables that a snapshot is derived from. logic.crud calls
+# cache.table_changed for each of these whenever it writes to them, which
+# advances their generation and so expires every snapshot, in this process
+# immediately and in others via DB_CACHE_NOTIFY.
+_tables = ("users", "users_groups", "users_sites", "users_projects",
+           "groups", "sites", "projects")
+
+_snapshots = {}
+_lock = threading.Lock()
+
+
+
+def _load(user_id, conn):
+    row = select_row(users, [users.c.restricted], user_id,
+                     ("groups", "sites", "projects"), conn)
+    if row is None:
+        return Permissions({}, {}, {}, False)
+    held = {}
+    reference = cache.reference_choices_for((groups, sites, projects), conn)
+    for table in (groups, sites, projects):
+        held[table.name] = {row_id: name for row_id, name, deleted
+                            in reference[table.name]
+                            if row_id in row[table.name] and not deleted}
+    return Permissions(held["groups"], held["sites"], held["projects"], bool(row["restricted"]))
+
+
+
+def version():
+    """ Returns a value that changes whenever any snapshot may have changed,
+        for use in the key of anything derived from a snapshot.
+    """
+    return cache.generation(*_tables)
+
+
+
+def permissions(user_id, conn=None, fresh=False):
+    """ Returns the Permissions of user_id. The snapshot is cached in process
+        and reloaded, from the primary database, once one of the tables it is
+        derived from has changed or it is DB_CACHE_TTL (default 300) seconds
+        old, so in the common case this is a dictionary lookup. Changes made
+        by other processes are only seen immediately with DB_CACHE_NOTIFY.
+        If fresh is True the snapshot is always reloaded, for checks that
+        must not be stale such as those guarding writes.
+    """
+    current = version()
+    now = time.monotonic()
+    if not fresh:
+        with _lock:
+            cached = _snapshots.get(user_id, None)
+        if cached is not None and cached[0] == current and cached[1] > now:
+            return cached[2]
+    
+    if conn is None:
+        with current_app.extensions["engine"].connect() as conn:
+            snapshot = _load(user_id, conn)
+    else:
+        snapshot = _load(user_id, conn)
+    expires = now + current_app.config.get("DB_CACHE_TTL", 300)
+    with _lock:
+        _snapshots[user_id] = (current, expires, snapshot)
+    return snapshot
+
+
+
+def discard(user_id):
+    """ Drops the cached snapshot of user_id, called on login and logout so
+        that a fresh snapshot is taken at the start of every session.
+    """
+    with _lock:
+        _snapshots.pop(user_id, None)
@@ -0,0 +1,171 @@
+import re
+import time
+import logging
+import threading
+from collections import defaultdict, Counter
+
+from flask import has_request_context, request, g
+from sqlalchemy.event import listens_for
+
+__all__ = ("instrument",
+           "query_stats",
+           "query_check_init",
+           "fingerprint",
+           "QueryBudgetExceeded")
+
+
+
+logger = logging.getLogger(__name__)
+
+# Applied in order to reduce a statement to its shape.
+_normalise = [(re.compile(r"'(?:[^']|'')*'"), "?"),
+              (re.compile(r"%\(\w+\)s|%s|\$\d+|(?<!:):\w+"), "?"),
+              (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+              (re.compile(r"\s+"), " "),
+              (re.compile(r"\(\?(?: ?, ?\?)*\)"), "(?)"),
+              (re.compile(r"\(\?\)(?: ?, ?\(\?\))+"), "(?)")]
+
+_counted = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+_check_modes = ("warn", "fail")
+
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+
+class QueryStats(object):
+    """ Thread safe per endpoint aggregate of the number of statements
+        executed and the time spent executing them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = defaultdict(lambda: {"queries": 0,
+                                                   "time": 0.0,
+                                                   "max": 0.0,
+                                                   "slow": 0})
+
+    def record(self, endpoint, duration, slow):
+        with self._lock:
+            stats = self._endpoints[endpoint]
+            stats["queries"] += 1
+            stats["time"] += duration
+            stats["max"] = max(stats["max"], duration)
+            stats["slow"] += slow
+
+    def snapshot(self):
+        with self._lock:
+            return {str(endpoint): dict(stats) for endpoint, stats
+                    in self._endpoints.items()}
+
+
+
+query_stats = QueryStats()
+
+
+
+def instrument(engine, config={}):
+    """ Times every cursor execution on engine. Each statement is attributed
+        to the current Flask endpoint and user, aggregated in query_stats and
+        added to g.queries for the current request. Statements that take
+        longer than DB_SLOW_QUERY_MS (default 500) are logged as warnings.
+        Only enabled if DB_QUERY_STATS is True, or DB_QUERY_CHECK is set as
+        the check needs g.queries, as it adds overhead to every statement.
+    """
+    if not config.get("DB_QUERY_STATS", False) and \
+            config.get("DB_QUERY_CHECK", None) not in _check_modes:
+        return
+    threshold = config.get("DB_SLOW_QUERY_MS", 500) / 1000
+
+    @listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_start"].pop()
+        slow = duration >= threshold
+        # Number of parameter sets if executemany, otherwise parameters.
+        params = len(parameters) if parameters else 0
+        rows = cursor.rowcount if cursor.rowcount >= 0 else None
+
+        endpoint = user_id = None
+        if has_request_context():
+            endpoint = request.endpoint
+            if slow:
+                user_id = g.get("user_id", None)
+            g.setdefault("queries", []).append({"statement": statement,
+                                                "params": params,
+                                                "duration": duration,
+                                                "rows": rows})
+        query_stats.record(endpoint, duration, slow)
+
+        if slow:
+            logger.warning("Slow query %.1f ms, endpoint %s, user %s, "
+                           "%d params, %s rows: %s", duration * 1000,
+                           endpoint, user_id, params, rows, statement)
+
+    @listens_for(engine, "handle_error")
+    def handle_error(context):
+        # Discard the start time of a statement that failed.
+        if context.connection is not None:
+            starts = context.connection.info.get("query_start", None)
+            if starts:
+                starts.pop()
+
+
+
+def fingerprint(statement):
+    """ Returns statement with literals, bind parameters and IN/VALUES lists
+        replaced so that statements differing only in their values have the
+        same fingerprint.
+    """
+    for pattern, replacement in _normalise:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+
+def query_check_init(app):
+    """ Development and CI aid that checks the statements recorded in
+        g.queries at the end of every request. If DB_QUERY_CHECK is "warn" or
+        "fail" then a request that executes more than DB_QUERY_BUDGET
+        statements, or that executes statements with the same fingerprint
+        more than DB_QUERY_REPEAT (default 3) times, is either logged as a
+        warning or raises QueryBudgetExceeded. Transaction control statements
+        are not counted and an executemany counts as one statement. Setting
+        DB_QUERY_CHECK also enables the statement collection of instrument.
+    """
+    mode = app.config.get("DB_QUERY_CHECK", None)
+    if mode is None:
+        return
+    if mode not in _check_modes:
+        raise RuntimeError(f"Invalid DB_QUERY_CHECK {mode}, must be warn or fail.")
+    budget = app.config.get("DB_QUERY_BUDGET", None)
+    repeat = app.config.get("DB_QUERY_REPEAT", 3)
+    
+    @app.after_request
+    def check_queries(response):
+        statements = [query["statement"] for query in g.get("queries", ())
+                      if query["statement"].lstrip()[:6].upper().startswith(_counted)]
+        problems = []
+        if budget is not None and len(statements) > budget:
+            problems += [f"{len(statements)} statements exceeds budget of {budget}"]
+        for shape, count in Counter(map(fingerprint, statements)).items():
+            if count > repeat:
+                problems += [f"{count} executions of {shape}"]
+        
+        if problems:
+            msg = "{} {}: {}".format(request.method,
+                                     request.endpoint,
+                                     "; ".join(problems))
+            if mode == "fail":
+                raise QueryBudgetExceeded(msg)
+            logger.warning(msg)
+        return response
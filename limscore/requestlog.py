@@ -0,0 +1,148 @@
+import time
+import queue
+import atexit
+import logging
+import threading
+
+from flask import request, g
+
+from .models import requestlogs
+from .utils import utcnow
+
+__all__ = ("RequestLogger",
+           "request_log_init")
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class RequestLogger(object):
+    """ Writes requestlogs rows from a background thread. Records are added
+        to a bounded in memory queue and written in batches of up to
+        batch_size rows with a single executemany at most every interval
+        seconds. If the queue is full, because the database is slow or
+        unavailable, records are dropped and counted rather than blocking
+        the request.
+    """
+    def __init__(self, engine, maxsize=10000, batch_size=500, interval=1.0):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name="limscore-requestlog", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def record(self, values):
+        try:
+            self._queue.put_nowait(values)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def stats(self):
+        with self._lock:
+            return {"queued": self._queue.qsize(),
+                    "written": self.written,
+                    "dropped": self.dropped,
+                    "failed": self.failed}
+
+    def stop(self, timeout=5):
+        """ Writes any queued records and stops the background thread.
+        """
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def _batch(self):
+        """ Blocks until there is at least one record or until interval has
+            elapsed, then returns up to batch_size records.
+        """
+        batch = []
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0 and not self._stopping.is_set():
+                    batch += [self._queue.get(timeout=timeout)]
+                else:
+                    batch += [self._queue.get_nowait()]
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(requestlogs.insert(), batch)
+        except Exception:
+            logger.exception("Unable to write %d request logs.", len(batch))
+            with self._lock:
+                self.failed += len(batch)
+        else:
+            with self._lock:
+                self.written += len(batch)
+
+    def _run(self):
+        while True:
+            batch = self._batch()
+            if batch:
+                self._write(batch)
+            elif self._stopping.is_set():
+                break
+
+
+
+def request_log_init(app):
+    """ If REQUEST_LOG is set then every request, apart from static files, is
+        logged to requestlogs with its ip address, path, method, status,
+        user and duration in seconds. See RequestLogger for the queue
+        settings REQUEST_LOG_QUEUE_SIZE (default 10000),
+        REQUEST_LOG_BATCH_SIZE (default 500) and REQUEST_LOG_INTERVAL
+        (default 1 second).
+    """
+    config = app.config
+    if not config.get("REQUEST_LOG", False):
+        return
+    request_logger = RequestLogger(app.extensions["engine"],
+                                   maxsize=config.get("REQUEST_LOG_QUEUE_SIZE", 10000),
+                                   batch_size=config.get("REQUEST_LOG_BATCH_SIZE", 500),
+                                   interval=config.get("REQUEST_LOG_INTERVAL", 1.0))
+    app.extensions["request_logger"] = request_logger
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_status(response):
+        g.request_status = response.status_code
+        return response
+
+    # Logged on teardown rather than after_request so that requests that
+    # fail with an unhandled exception, and so never produce a response
+    # for after_request, are still logged as 500s.
+    @app.teardown_request
+    def log_request(exception):
+        endpoint = request.endpoint or ""
+        status = 500 if exception is not None else g.get("request_status", None)
+        # No status means the context was never dispatched, eg a test
+        # request context.
+        if status is not None and endpoint != "static" and not endpoint.endswith(".static"):
+            start = g.get("request_start", None)
+            duration = time.perf_counter() - start if start is not None else None
+            # Taken from g, set by login_required, so that logging never
+            # loads a server side session that the request did not use.
+            request_logger.record({"ip_address": request.remote_addr or "",
+                                   "path": request.path,
+                                   "method": request.method,
+                                   "response": str(status),
+                                   "user_id": g.get("user_id", None),
+                                   "duration": duration,
+                                   "datetime": utcnow()})
@@ -1,6 +1,7 @@
 import waitress
 import importlib
 import sys
+import os
 
 
 
@@ -15,6 +16,10 @@ def main():
     if len(keys) != len(values):
         raise RuntimeError("Missing argument value.")
 
+    # Allows create_engine to size the connection pool to match.
+    kwargs = dict(zip(keys, values))
+    os.environ.setdefault("WAITRESS_THREADS", kwargs.get("threads", "4"))
+
     colon_index = target.find(":")
     module_name = target[:colon_index]
     entry_point = target[colon_index+1:]
@@ -23,7 +28,7 @@ def main():
     module = importlib.import_module(module_name)
     app = eval(entry_point, vars(module))
     
-    waitress.serve(app, **dict(zip(keys, values)))
+    waitress.serve(app, **kwargs)
     
 
 
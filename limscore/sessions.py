@@ -0,0 +1,346 @@
+import json
+import time
+import threading
+from secrets import token_urlsafe
+from collections import OrderedDict
+from datetime import timezone
+
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from itsdangerous import Signer, BadSignature
+from sqlalchemy import select, and_
+
+from .models import sessions
+from .utils import utcnow
+
+try:
+    import redis
+except ImportError: # redis backend is optional
+    redis = None
+
+__all__ = ("ServerSession",
+           "ServerSessionInterface",
+           "MemoryStore",
+           "DatabaseStore",
+           "RedisStore",
+           "StoreHistory",
+           "session_init")
+
+
+
+class MemoryStore(object):
+    """ Holds sessions in process, discarding the least recently used beyond
+        max_sessions. Only suitable for a single process deployment.
+    """
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            try:
+                data, expires = self._sessions[sid]
+            except KeyError:
+                return None, None
+            if expires < time.time():
+                del self._sessions[sid]
+                return None, None
+            self._sessions.move_to_end(sid)
+            return data, expires
+
+    def save(self, sid, data, lifetime):
+        with self._lock:
+            self._sessions[sid] = (data, time.time() + lifetime.total_seconds())
+            self._sessions.move_to_end(sid)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def touch(self, sid, lifetime):
+        with self._lock:
+            if sid in self._sessions:
+                data = self._sessions[sid][0]
+                self._sessions[sid] = (data, time.time() + lifetime.total_seconds())
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+
+
+class DatabaseStore(object):
+    """ Holds sessions in the sessions table of the database. Expired rows are
+        deleted once every purge_every saves.
+    """
+    def __init__(self, engine, purge_every=1000):
+        self.engine = engine
+        self.purge_every = purge_every
+        self._saves = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = self.engine.connect()
+        # Session writes must not fail with serialization errors when two
+        # requests from the same browser overlap.
+        if conn.dialect.name == "postgresql":
+            conn = conn.execution_options(isolation_level="READ COMMITTED")
+        return conn
+
+    def load(self, sid):
+        sql = select([sessions.c.data, sessions.c.expires]). \
+                where(and_(sessions.c.id == sid,
+                           sessions.c.expires > utcnow()))
+        with self._connect() as conn:
+            row = conn.execute(sql).first()
+        if row is None:
+            return None, None
+        data, expires = row
+        if expires.tzinfo is None:
+            expires = expires.replace(tzinfo=timezone.utc)
+        return data, expires.timestamp()
+
+    def save(self, sid, data, lifetime):
+        now = utcnow()
+        values = {"data": data, "expires": now + lifetime}
+        with self._connect() as conn:
+            with conn.begin():
+                sql = sessions.update().where(sessions.c.id == sid).values(**values)
+                if conn.execute(sql).rowcount == 0:
+                    conn.execute(sessions.insert().values(id=sid, **values))
+                with self._lock:
+                    self._saves += 1
+                    purge = self._saves % self.purge_every == 0
+                if purge:
+                    conn.execute(sessions.delete().where(sessions.c.expires <= now))
+
+    def touch(self, sid, lifetime):
+        sql = sessions.update(). \
+                where(sessions.c.id == sid). \
+                values(expires=utcnow() + lifetime)
+        with self._connect() as conn:
+            conn.execute(sql)
+
+    def delete(self, sid):
+        with self._connect() as conn:
+            conn.execute(sessions.delete().where(sessions.c.id == sid))
+
+
+
+class RedisStore(object):
+    """ Holds sessions in redis, which expires them itself.
+    """
+    def __init__(self, url, prefix="session:"):
+        if redis is None:
+            raise RuntimeError("The redis session backend requires the redis "
+                               "package, install limscore[redis].")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def load(self, sid):
+        pipeline = self.client.pipeline()
+        pipeline.get(self.prefix + sid)
+        pipeline.ttl(self.prefix + sid)
+        data, ttl = pipeline.execute()
+        if data is None:
+            return None, None
+        return data.decode(), time.time() + max(ttl, 0)
+
+    def save(self, sid, data, lifetime):
+        self.client.setex(self.prefix + sid, lifetime, data)
+
+    def touch(self, sid, lifetime):
+        self.client.expire(self.prefix + sid, lifetime)
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+
+
+class ServerSession(SessionMixin):
+    """ Session whose data is only loaded from the store the first time it is
+        accessed, so requests that never touch the session never touch the
+        store either.
+    """
+    def __init__(self, interface, sid=None):
+        self.interface = interface
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        self.rotate = False
+        self.expires = None
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self.accessed = True
+            self._data = self.interface.load(self)
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        # A new id is issued after the session is cleared, as happens on
+        # login, to prevent session fixation.
+        self.data.clear()
+        self.modified = True
+        self.rotate = True
+
+
+
+class ServerSessionInterface(SessionInterface):
+    """ Keeps only a signed opaque id in the session cookie with the session
+        data itself held in store, serialized with the same tagged JSON as
+        the default cookie sessions. Sessions expire from the store after
+        PERMANENT_SESSION_LIFETIME.
+    """
+    salt = "limscore-session"
+
+    def __init__(self, store):
+        self.store = store
+        self.serializer = TaggedJSONSerializer()
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        sid = None
+        cookie = request.cookies.get(app.session_cookie_name, None)
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                pass
+        return ServerSession(self, sid)
+
+    def load(self, session):
+        if session.sid is not None:
+            data, session.expires = self.store.load(session.sid)
+            if data is not None:
+                return self.serializer.loads(data)
+            # Never reuse an id that the store does not know about.
+            session.sid = None
+            session.new = True
+        return {}
+
+    def _set_cookie(self, app, session, response):
+        response.set_cookie(app.session_cookie_name,
+                            self._signer(app).sign(session.sid).decode(),
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=self.get_cookie_domain(app),
+                            path=self.get_cookie_path(app),
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+    def save_session(self, app, session, response):
+        if session._data is None:
+            return
+        response.vary.add("Cookie")
+
+        if not session.data:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=self.get_cookie_domain(app),
+                                       path=self.get_cookie_path(app))
+            return
+        if not session.modified:
+            # Sessions are rarely modified so the expiry in the store is
+            # extended separately, on every request for permanent sessions
+            # if SESSION_REFRESH_EACH_REQUEST is set (the flask default),
+            # otherwise once it is past half its lifetime.
+            lifetime = app.permanent_session_lifetime
+            if session.permanent and app.config["SESSION_REFRESH_EACH_REQUEST"]:
+                self.store.touch(session.sid, lifetime)
+                self._set_cookie(app, session, response)
+            elif session.expires is not None and \
+                    session.expires - time.time() < lifetime.total_seconds() / 2:
+                self.store.touch(session.sid, lifetime)
+            return
+
+        if session.rotate and session.sid is not None:
+            self.store.delete(session.sid)
+            session.sid = None
+        set_cookie = session.sid is None or session.permanent
+        if session.sid is None:
+            session.sid = token_urlsafe(32)
+        self.store.save(session.sid,
+                        self.serializer.dumps(dict(session.data)),
+                        app.permanent_session_lifetime)
+
+        if set_cookie:
+            self._set_cookie(app, session, response)
+
+
+
+class StoreHistory(object):
+    """ Navigation history kept in a session store rather than in process, so
+        that back navigation works whichever worker serves the request. Each
+        history is saved as JSON under "history:" + key with the same lifetime
+        as the session. Has the same interface as utils.HistoryStore.
+    """
+    def __init__(self, store, lifetime, length=20):
+        self.store = store
+        self.lifetime = lifetime
+        self.length = length
+
+    def get(self, key):
+        if key is None:
+            return []
+        data, expires = self.store.load("history:" + key)
+        if data is None:
+            return []
+        return [(endpoint, args) for endpoint, args in json.loads(data)]
+
+    def set(self, key, endpoints):
+        self.store.save("history:" + key,
+                        json.dumps(endpoints[-self.length:]),
+                        self.lifetime)
+
+    def discard(self, key):
+        self.store.delete("history:" + key)
+
+
+
+def session_init(app):
+    """ Replaces the default signed cookie sessions with server side sessions
+        if SESSION_BACKEND is "memory", "database" or "redis". The redis
+        backend connects to SESSION_REDIS_URL (default
+        redis://localhost:6379/0). Navigation history is then kept in the
+        same store.
+    """
+    config = app.config
+    backend = config.get("SESSION_BACKEND", None)
+    if backend is None or backend == "cookie":
+        return
+    if backend == "memory":
+        store = MemoryStore(config.get("SESSION_MAX_SESSIONS", 10000))
+    elif backend == "database":
+        store = DatabaseStore(app.extensions["engine"])
+    elif backend == "redis":
+        store = RedisStore(config.get("SESSION_REDIS_URL", "redis://localhost:6379/0"))
+    else:
+        raise RuntimeError(f"Unknown session backend {backend}.")
+    app.session_interface = ServerSessionInterface(store)
+    app.extensions["history"] = StoreHistory(store,
+                                             app.permanent_session_lifetime,
+                                             config.get("HISTORY_LENGTH", 20))
@@ -1,12 +1,14 @@
 import pdb
 import datetime
+import threading
+from secrets import token_urlsafe
 from functools import wraps
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from dateutil import parser
 import pytz
 
-from flask import session, request, url_for, current_app, redirect
+from flask import session, request, url_for, current_app, redirect, g, has_request_context
 from flask.sessions import SecureCookieSessionInterface
 import flask
 from werkzeug.exceptions import Conflict, Forbidden, BadRequest, InternalServerError
@@ -19,6 +21,7 @@ from .i18n import _
 __all__ = ["utcnow",
            "login_required",
            "engine",
+           "read_engine",
            "abort",
            "tablerow",
            "is_valid_nhs_number",
@@ -29,6 +32,7 @@ __all__ = ["utcnow",
            "render_template",
            "render_page",
            "navbar",
+           "HistoryStore",
            "sign_cookie",
            "unique_violation_or_reraise",
            "iso8601_to_utc"]
@@ -72,24 +76,34 @@ def render_page(name, active=None, **context):
     if "id" not in session:
         navbar = {"app": application}
     else:
+        # The navbar only depends on these so is built once per combination
+        # rather than on every page, the active item is added afterwards.
         section = session.get("section", "")
-
-        right = [{"text": _("Help"),
-                  "href": url_for("auth.site_menu")},
-                 {"text": session.get("project", ""),
-                  "href": url_for("auth.project_menu"),
-                  "dropdown": True},
-                 {"text": session.get("site", ""),
-                  "href": url_for("auth.site_menu"),
-                  "dropdown": True},
-                 {"text": "",
-                  "href": url_for("auth.logout_menu"),
-                  "dropdown": True}]
-        navbar = {"app": application,
-                  "section": section,
-                  "active": active,
-                  "left": _navbars[section](),
-                  "right": right}
+        key = (section,
+               session.get("group", None),
+               session.get("locale", None),
+               session.get("site", ""),
+               session.get("project", ""))
+        navbars = current_app.extensions["navbars"]
+        navbar = navbars.get(key)
+        if navbar is None:
+            right = [{"text": _("Help"),
+                      "href": url_for("auth.site_menu")},
+                     {"text": session.get("project", ""),
+                      "href": url_for("auth.project_menu"),
+                      "dropdown": True},
+                     {"text": session.get("site", ""),
+                      "href": url_for("auth.site_menu"),
+                      "dropdown": True},
+                     {"text": "",
+                      "href": url_for("auth.logout_menu"),
+                      "dropdown": True}]
+            navbar = {"app": application,
+                      "section": section,
+                      "left": _navbars[section](),
+                      "right": right}
+            navbars.set(key, navbar)
+        navbar = dict(navbar, active=active)
     return render_template(name, navbar=navbar, **context)
 
 
@@ -113,6 +127,20 @@ def navbar(section):
 
 
 
+def _holds_group(group_names):
+    """ Returns True if the current group of the user is one of group_names
+        and is still held by them according to their permissions snapshot,
+        which is reloaded from the database for anything other than a GET.
+    """
+    # Imported here as permissions depends on logic which depends on utils.
+    from .permissions import permissions
+    group = session.get("group", None)
+    fresh = request.method not in ("GET", "HEAD")
+    return group in group_names and \
+        group in permissions(session["id"], fresh=fresh).groups.values()
+
+
+
 def login_required(*groups, history=True):
     """Decorator to protect every view function (except login, set_password,
         etc that are called before user is logged in). Group names are in the
@@ -169,8 +197,9 @@ def login_required(*groups, history=True):
         def wrapper(*args, **kwargs):
             if "id" not in session:
                 return redirect(url_for("auth.login"))
+            g.user_id = session["id"]
             
-            if group_names and session["group"] not in group_names:
+            if group_names and not _holds_group(group_names):
                 if request.method == "POST":
                     abort(Forbidden)
                 
@@ -180,6 +209,12 @@ def login_required(*groups, history=True):
             if history:
                 store_history()
             
+            if request.method not in ("GET", "HEAD") and _replicated():
+                # Replicas may lag so this request and the next, usually the
+                # redirect after a write, read from the primary.
+                g.read_primary = True
+                session["read_primary"] = True
+            
             try:
                 return function(*args, **kwargs)
             except IntegrityError:
@@ -194,6 +229,30 @@ class _ProxyEngine(object):
         return getattr(current_app.extensions["engine"], name)
 engine = _ProxyEngine()
 
+
+
+def _replicated():
+    extensions = current_app.extensions
+    return extensions.get("read_engine", extensions["engine"]) is not extensions["engine"]
+
+
+
+class _ProxyReadEngine(object):
+    """ The read engine, except that requests flagged by a write in
+        login_required read from the primary so users see their own writes.
+    """
+    def __getattr__(self, name):
+        extensions = current_app.extensions
+        if not _replicated():
+            return getattr(extensions["engine"], name)
+        if has_request_context() and "read_primary" not in g:
+            # Checked before popping to avoid marking the session modified.
+            g.read_primary = "read_primary" in session and session.pop("read_primary")
+        if has_request_context() and g.read_primary:
+            return getattr(extensions["engine"], name)
+        return getattr(extensions["read_engine"], name)
+read_engine = _ProxyReadEngine()
+
     
     
 def abort(exc):
@@ -216,6 +275,49 @@ def tablerow(*args, **kwargs):
 
 
 
+class HistoryStore(object):
+    """ Server side store of the navigation history of each session, keeping
+        it out of the signed session cookie so that the cookie only has to be
+        re-signed and re-sent when the session actually changes. Each history
+        is a stack of at most length (endpoint, args) tuples and the least
+        recently used histories are discarded beyond max_sessions. Histories
+        are held in process so are lost on restart, in which case back
+        navigation returns to the navbar. When SESSION_BACKEND is set
+        sessions.StoreHistory is used instead so that histories are shared
+        between processes.
+    """
+    def __init__(self, length=20, max_sessions=10000):
+        self.length = length
+        self.max_sessions = max_sessions
+        self._histories = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            try:
+                self._histories.move_to_end(key)
+            except KeyError:
+                return []
+            return list(self._histories[key])
+    
+    def set(self, key, endpoints):
+        with self._lock:
+            self._histories[key] = endpoints[-self.length:]
+            self._histories.move_to_end(key)
+            while len(self._histories) > self.max_sessions:
+                self._histories.popitem(last=False)
+    
+    def discard(self, key):
+        with self._lock:
+            self._histories.pop(key, None)
+
+
+
+def _history():
+    return current_app.extensions["history"]
+
+
+
 def store_history():
     """Stores navigation history to allow back button functionality. Is called
         before every view by the login_required decorator unless 
@@ -226,6 +328,8 @@ def store_history():
         dir = 0 to reset the navigation stack to the top level ie navbar.
         dir omitted for sideways navigation.
         dir <= -1 for backwards navigation.
+        The history is kept in the HistoryStore under session["history"], so
+        the session itself is only modified the first time.
 
     Args:
         None
@@ -237,7 +341,10 @@ def store_history():
         Will never raise an exception
         
     """
-    endpoints = session.get("endpoints", [])
+    key = session.get("history", None)
+    if key is None:
+        key = session["history"] = token_urlsafe(16)
+    endpoints = _history().get(key)
     request_args = request.args.to_dict()
     direction = request_args.get("dir", None)
     
@@ -256,16 +363,16 @@ def store_history():
                 break
             
     endpoint = (request.endpoint, {**request.view_args, **request_args})
-    session["endpoints"] = endpoints + [endpoint]
+    _history().set(key, endpoints + [endpoint])
     
     
     
 def url_back(steps=-1):
     try:
-        endpoint, args = session["endpoints"][steps-1]
+        endpoint, args = _history().get(session["history"])[steps-1]
     except (KeyError, IndexError):
         return url_for("auth.root", dir=0)
-    args["dir"] = steps
+    args = dict(args, dir=steps)
     return url_for(endpoint, **args)
 
 
@@ -276,7 +383,7 @@ def url_fwrd(*args, **kwargs):
 
 
 def back_exists():
-    return len(session["endpoints"]) > 1
+    return len(_history().get(session.get("history", None))) > 1
     
     
 
@@ -17,6 +17,8 @@ setup(name="limscore",
                       "Babel",
                       "pyqrcode",
                       "bcrypt"],
+    extras_require={"xlsx": ["openpyxl"],
+                    "redis": ["redis"]},
     entry_points = { "console_scripts":
         ["waitress_serve=limscore.scripts.waitress_serve:main",
          "limscore_babel=limscore.scripts.limscore_babel:main"] },
@@ -0,0 +1,84 @@
+import pytest
+from flask import Flask
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.dialects.postgresql import JSONB
+
+import limscore
+from limscore import models
+
+
+# users.last_session is postgres JSONB, which SQLite can store as JSON.
+@compiles(JSONB, "sqlite")
+def _jsonb_sqlite(element, compiler, **kw):
+    return "JSON"
+
+
+
+CONFIG = """import datetime
+DB_URL = "sqlite:///test.db"
+SECRET_KEY = b"0123456789abcdef"
+NAME = "Test"
+STYLE = "bulma"
+"""
+
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """ Returns a function that creates an app with a fresh SQLite database
+        and any extra config, given as keyword arguments.
+    """
+    def make_app(**config):
+        instance = tmp_path / "instance"
+        instance.mkdir(exist_ok=True)
+        lines = [CONFIG] + [f"{k} = {v!r}\n" for k, v in config.items()]
+        (instance / "app.cfg").write_text("".join(lines))
+        app = Flask(__name__, instance_path=str(instance))
+        app.testing = True
+        limscore.init_app(app)
+        from limscore.admin import app as admin
+        app.register_blueprint(admin)
+        app.extensions["locales"] = {"en_GB": {}}
+        models.metadata.create_all(app.extensions["engine"])
+        return app
+    return make_app
+
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+
+@pytest.fixture
+def engine(app):
+    return app.extensions["engine"]
+
+
+
+def login(client, user_id=1, group="Admin.Administrator"):
+    """ Logs client in as user_id without going through the login form.
+    """
+    with client.session_transaction() as session:
+        session["id"] = user_id
+        session["group"] = group
+        session["section"] = group.split(".")[0]
+        session["locale"] = "en_GB"
+        session["timezone"] = "UTC"
+
+
+
+def seed(engine, n=5):
+    """ Adds two groups, sites and projects and n users who all hold the
+        first group.
+    """
+    with engine.begin() as conn:
+        conn.execute(models.groups.insert(), [{"name": "Admin.Administrator"}, {"name": "Lab.Tech"}])
+        conn.execute(models.sites.insert(), [{"name": "SiteA"}, {"name": "SiteB"}])
+        conn.execute(models.projects.insert(), [{"name": "P1"}, {"name": "P2"}])
+        conn.execute(models.users.insert(),
+                     [{"email": f"u{i}@example.com", "name": f"U{i}", "forename": "F",
+                       "surname": f"S{i}", "last_session": {}} for i in range(n)])
+        conn.execute(models.users_groups.insert(),
+                     [{"user_id": i + 1, "group_id": 1} for i in range(n)])
@@ -0,0 +1,123 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from limscore import models, utils
+
+from conftest import login, seed
+
+
+BASE = datetime(2026, 3, 1, 12, tzinfo=timezone.utc)
+
+
+
+@pytest.fixture(params=["UTC", "Europe/Paris", "America/New_York"])
+def local_timezone(request, monkeypatch):
+    monkeypatch.setenv("TZ", request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+
+def add_editlogs(engine, n):
+    with engine.begin() as conn:
+        conn.execute(models.editlogs.insert(),
+                     [{"tablename": "users", "row_id": 2, "action": "Edited",
+                       "details": {"name": f"U{i}"}, "user_id": 1,
+                       # Pairs of entries share a datetime to exercise the id tie break.
+                       "datetime": BASE + timedelta(hours=i // 2)} for i in range(n)])
+
+
+
+def names(data):
+    return [row["details"]["name"] for row in data["rows"]]
+
+
+
+def test_editlog_pages_forward_and_back(make_app, local_timezone):
+    app = make_app(PAGE_SIZE=3)
+    seed(app.extensions["engine"])
+    add_editlogs(app.extensions["engine"], 10)
+    client = app.test_client()
+    login(client)
+    
+    pages = []
+    url = "/audit/users/2/json"
+    while url:
+        data = client.get(url).get_json()
+        pages += [names(data)]
+        url = data["older"]
+        assert len(pages) <= 4
+    assert sum(pages, []) == [f"U{i}" for i in range(9, -1, -1)]
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+    
+    newer = []
+    url = data["newer"]
+    while url:
+        data = client.get(url).get_json()
+        newer += [names(data)]
+        url = data["newer"]
+        assert len(newer) <= 3
+    assert newer == pages[-2::-1]
+
+
+
+def test_editlog_filters(make_app, local_timezone):
+    app = make_app()
+    seed(app.extensions["engine"])
+    add_editlogs(app.extensions["engine"], 10)
+    client = app.test_client()
+    login(client)
+    
+    # Naive datetimes are UTC.
+    data = client.get("/audit/users/2/json?since=2026-03-01T13:00:00&until=2026-03-01T15:00:00").get_json()
+    assert names(data) == ["U5", "U4", "U3", "U2"]
+    data = client.get("/audit/users/2/json?since=2026-03-01T14:00:00%2B01:00").get_json()
+    assert names(data) == [f"U{i}" for i in range(9, 1, -1)]
+    data = client.get("/audit/users/2/json?field=name&action=Deleted").get_json()
+    assert names(data) == []
+    assert client.get("/audit/users/2/json?since=yesterday").status_code == 400
+    assert client.get("/audit/users/2").status_code == 200
+
+
+
+def test_navbar_built_once_per_session_state(app, engine, monkeypatch):
+    seed(engine)
+    calls = []
+    
+    def admin_navbar():
+        calls.append(1)
+        return [{"text": "Menu item", "href": "/menu"}]
+    
+    monkeypatch.setitem(utils._navbars, "Admin", admin_navbar)
+    client = app.test_client()
+    login(client)
+    assert b"Menu item" in client.get("/groups").data
+    client.get("/groups")
+    assert len(calls) == 1
+    
+    with client.session_transaction() as session:
+        session["site"] = "SiteA"
+    response = client.get("/groups")
+    assert b"SiteA" in response.data
+    assert len(calls) == 2
+
+
+
+def test_navbar_cache_is_bounded(make_app, monkeypatch):
+    app = make_app(NAVBAR_CACHE_SIZE=2)
+    seed(app.extensions["engine"])
+    calls = []
+    monkeypatch.setitem(utils._navbars, "Admin", lambda: calls.append(1) or [])
+    client = app.test_client()
+    login(client)
+    for site in ("SiteA", "SiteB", "SiteC", "SiteA"):
+        with client.session_transaction() as session:
+            session["site"] = site
+        client.get("/groups")
+    # SiteA was discarded by SiteC so had to be rebuilt.
+    assert len(calls) == 4
+    assert len(app.extensions["navbars"]._items) == 2
@@ -0,0 +1,88 @@
+import pytest
+
+from limscore import cache, models
+
+from conftest import seed
+
+
+@pytest.fixture(autouse=True)
+def reset_cache():
+    yield
+    cache.configure((), ttl=300)
+    cache.cached_tables.discard("users")
+
+
+
+def test_choices_cached_until_invalidated(engine):
+    seed(engine)
+    with engine.connect() as conn:
+        first = cache.reference_choices(models.sites, conn)
+        assert first == [(1, "SiteA", False), (2, "SiteB", False)]
+        conn.execute(models.sites.update().where(models.sites.c.id == 1).values(name="SiteC"))
+        assert cache.reference_choices(models.sites, conn) is first
+        cache.table_changed(models.sites, conn)
+        assert [name for id, name, deleted in cache.reference_choices(models.sites, conn)] == ["SiteB", "SiteC"]
+
+
+
+def test_only_opted_in_tables_are_cached(engine):
+    seed(engine)
+    with engine.connect() as conn:
+        cache.reference_choices(models.users, conn)
+        assert "users" not in cache._choices
+        cache.configure(["users"])
+        cache.reference_choices(models.users, conn)
+        assert "users" in cache._choices
+
+
+
+def test_choices_expire(engine):
+    seed(engine)
+    cache.configure(ttl=0)
+    with engine.connect() as conn:
+        first = cache.reference_choices(models.sites, conn)
+        assert cache.reference_choices(models.sites, conn) is not first
+
+
+
+def test_older_transaction_does_not_repopulate(engine):
+    seed(engine)
+    cache.invalidate()
+    with engine.connect() as conn:
+        with conn.begin():
+            conn.execute("SELECT 1")
+            # Another connection commits a change after this transaction's
+            # snapshot was taken.
+            with engine.begin() as writer:
+                cache.table_changed(models.sites, writer)
+            cache.reference_choices(models.sites, conn)
+            assert "sites" not in cache._choices
+        cache.reference_choices(models.sites, conn)
+        assert "sites" in cache._choices
+
+
+
+def test_generation_advances(engine):
+    before = cache.generation("sites")
+    cache.invalidate("sites")
+    middle = cache.generation("sites")
+    assert middle != before
+    cache.invalidate("groups")
+    assert cache.generation("sites") == middle
+    cache.invalidate()
+    assert cache.generation("sites") != middle
+
+
+
+def test_lru_cache():
+    lru = cache.LRUCache(2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+    # b was the least recently used.
+    assert lru.get("b") is None
+    assert lru.get("a") == 1 and lru.get("c") == 3
+    assert lru.get("b", 0) == 0
+    lru.clear()
+    assert lru.get("a") is None
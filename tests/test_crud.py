@@ -0,0 +1,275 @@
+import re
+import io
+import csv
+import html
+import json
+from functools import partial
+
+import pytest
+from flask import redirect, g
+from sqlalchemy import MetaData, Table, Column, Integer, String, ForeignKey, create_engine, select
+
+from limscore import crud
+from limscore.forms import Form, TextInput, SelectInput
+from limscore.utils import login_required
+
+from conftest import login
+
+
+metadata = MetaData()
+
+categories = Table("categories", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String, nullable=True))
+
+things = Table("things", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String, nullable=True),
+    Column("category_id", Integer, ForeignKey("categories.id"), nullable=True))
+
+
+
+def cells(response):
+    return re.findall(r"<td>(.*?)</td>", response.data.decode())
+
+
+
+def link(response, text):
+    match = re.search(r'<a class="button" href="([^"]*)">{}'.format(text), response.data.decode())
+    return html.unescape(match.group(1)) if match else None
+
+
+
+def make_things(app):
+    engine = app.extensions["engine"]
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(categories.insert(), [{"name": "x"}, {"name": None}])
+        conn.execute(things.insert(),
+                     [{"name": "a", "category_id": None},
+                      {"name": "a", "category_id": 1},
+                      {"name": "a", "category_id": None},
+                      {"name": "a", "category_id": 2},
+                      {"name": None, "category_id": 1},
+                      {"name": None, "category_id": None},
+                      {"name": "b", "category_id": None},
+                      {"name": "b", "category_id": 1}])
+    
+    def things_view():
+        return crud.list_view(("Name", things.c.name),
+                              ("Category", categories.c.name),
+                              ("Id", things.c.id))
+    app.add_url_rule("/things", "things", things_view)
+
+
+
+def test_seek_null_values():
+    sql = str(crud._seek([things.c.name, things.c.id], ["a", 1], nulls=(True,)))
+    assert "things.name IS NULL" in sql and "things.name >" not in sql
+    sql = str(crud._seek([things.c.name, things.c.id], ["a", 1], reverse=True, nulls=(True,)))
+    assert "things.name IS NOT NULL" in sql
+
+
+
+def test_order_without_nulls_last():
+    # NULLS LAST needs SQLite 3.30.
+    sql = str(select([things.c.id]).order_by(*crud._ascending([things.c.name, things.c.id])))
+    assert "NULLS" not in sql
+    assert sql.endswith("ORDER BY things.name IS NULL, things.name, things.id")
+    sql = str(select([things.c.id]).order_by(*crud._ascending([things.c.name, things.c.id], reverse=True)))
+    assert sql.endswith("ORDER BY things.name IS NULL DESC, things.name DESC, things.id DESC")
+
+
+
+def test_keyset_paging_with_null_keys(make_app):
+    app = make_app(PAGE_SIZE=3)
+    make_things(app)
+    client = app.test_client()
+    login(client)
+    
+    everything = cells(client.get("/things"))
+    assert len(everything) == 8 * 3
+    
+    pages = []
+    url = "/things?page=1"
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        pages += [cells(response)]
+        url = link(response, "Next")
+    assert sum(pages, []) == everything
+    assert [len(page) for page in pages] == [9, 9, 6]
+    
+    # Back from the last page.
+    previous = link(response, "Previous")
+    assert cells(client.get(previous)) == pages[1]
+
+
+
+def test_nulls_sort_last(make_app):
+    app = make_app()
+    make_things(app)
+    client = app.test_client()
+    login(client)
+    names = cells(client.get("/things"))[::3]
+    assert names[:6] == ["a"] * 4 + ["b"] * 2
+    assert len(set(names[6:])) == 1 and names[6] not in ("a", "b")
+
+
+
+def column_of(column):
+    def field(row):
+        return row[column]
+    return field
+
+
+
+def test_plan_cache_keeps_closures_apart(make_app):
+    app = make_app()
+    make_things(app)
+    app.add_url_rule("/a", "a", lambda: crud.list_view(("Name", column_of(things.c.name))))
+    app.add_url_rule("/b", "b", lambda: crud.list_view(("Name", column_of(categories.c.name))))
+    client = app.test_client()
+    login(client)
+    assert client.get("/a").status_code == 200
+    response = client.get("/b")
+    assert response.status_code == 200
+    assert len(cells(response)) == 2
+
+
+
+def test_plan_cache_reuses_per_request_callables(make_app):
+    app = make_app()
+    make_things(app)
+    
+    def view():
+        return crud.list_view(("Name", lambda row: row[things.c.name]),
+                              ("Id", partial(lambda column, row: row[column], things.c.id)))
+    app.add_url_rule("/c", "c", view)
+    client = app.test_client()
+    login(client)
+    before = len(crud._plans._items)
+    for i in range(5):
+        assert client.get("/c").status_code == 200
+    assert len(crud._plans._items) == before + 1
+
+
+
+def test_read_after_write_uses_primary(make_app, tmp_path):
+    # The "replica" is a separate empty database that never catches up.
+    replica = f"sqlite:///{tmp_path / 'replica.db'}"
+    metadata.create_all(create_engine(replica))
+    app = make_app(DB_REPLICA_URLS=[replica])
+    make_things(app)
+    
+    @login_required()
+    def add_thing():
+        with app.extensions["engine"].begin() as conn:
+            conn.execute(things.insert().values(name="new"))
+        return redirect("/things")
+    app.add_url_rule("/add", "add", add_thing, methods=["POST"])
+    client = app.test_client()
+    login(client)
+    
+    assert cells(client.get("/things")) == []
+    assert client.post("/add").status_code == 302
+    assert "new" in cells(client.get("/things"))
+    assert cells(client.get("/things")) == []
+
+
+
+colours = Table("colours", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String))
+
+widgets = Table("widgets", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String),
+    Column("category_id", Integer, ForeignKey("categories.id")),
+    Column("colour_id", Integer, ForeignKey("colours.id")))
+
+
+
+class WidgetForm(Form):
+    def definition(self):
+        self.name = TextInput("Name")
+        self.category_id = SelectInput("Category")
+        self.colour_id = SelectInput("Colour")
+
+
+
+def test_upsert_view_loads_choices_in_one_query(make_app):
+    app = make_app(DB_QUERY_STATS=True)
+    make_things(app)
+    with app.extensions["engine"].begin() as conn:
+        conn.execute(colours.insert(), [{"name": "red"}, {"name": "blue"}])
+        conn.execute(widgets.insert(), [{"name": "w", "category_id": 1, "colour_id": 2}])
+    
+    def widgets_upsert(row_id=None):
+        return crud.upsert_view(row_id, widgets, WidgetForm)
+    # Endpoints in the admin blueprint, where the history link points.
+    app.add_url_rule("/widgets/<int:row_id>", "admin.widgets_upsert", widgets_upsert)
+    app.add_url_rule("/widgets/new", "admin.widgets_new", widgets_upsert)
+    
+    selects = []
+    @app.after_request
+    def record_selects(response):
+        selects[:] = [query["statement"] for query in g.queries
+                      if query["statement"].lstrip().upper().startswith("SELECT")]
+        return response
+    client = app.test_client()
+    login(client)
+    
+    response = client.get("/widgets/1")
+    assert response.status_code == 200
+    assert "blue" in response.data.decode()
+    # The row, then the choices of both (uncached) select fields.
+    assert len(selects) == 2
+    assert "UNION ALL" in selects[1]
+    
+    assert client.get("/widgets/new").status_code == 200
+    assert len(selects) == 1
+
+
+
+def test_export_csv(make_app):
+    app = make_app()
+    make_things(app)
+    client = app.test_client()
+    login(client)
+    html_rows = cells(client.get("/things"))
+    response = client.get("/things?export=csv")
+    assert response.is_streamed
+    assert response.mimetype == "text/csv"
+    assert response.headers["Content-Disposition"] == 'attachment; filename="things.csv"'
+    rows = list(csv.reader(io.StringIO(response.data.decode())))
+    assert rows[0] == ["Name", "Category", "Id"]
+    # Same rows in the same order as the page, with nulls left empty.
+    assert [cell for row in rows[1:] for cell in row][::3] == \
+           [name if name != "None" else "" for name in html_rows[::3]]
+    assert len(rows) == 9
+
+
+
+def test_export_xlsx(make_app):
+    openpyxl = pytest.importorskip("openpyxl")
+    app = make_app()
+    make_things(app)
+    client = app.test_client()
+    login(client)
+    response = client.get("/things?export=xlsx")
+    worksheet = openpyxl.load_workbook(io.BytesIO(response.data)).active
+    rows = list(worksheet.values)
+    assert rows[0] == ("Name", "Category", "Id")
+    assert len(rows) == 9
+    assert client.get("/things?export=pdf").status_code == 400
+
+
+
+def test_merged_rows():
+    rows = [{"id": 1, "name": "a", "tag": "x"},
+            {"id": 1, "name": "a", "tag": "y"},
+            {"id": 2, "name": "b", "tag": None}]
+    merged = [[str(column) for column in columns]
+              for row, columns in crud._merged_rows(rows, ["name", "tag"])]
+    assert merged == [["a", "x, y"], ["b", "None"]]
@@ -0,0 +1,68 @@
+import time
+import queue
+import logging
+
+from sqlalchemy import select
+
+from limscore.dev import _logger
+
+
+
+class Recorder(object):
+    def __init__(self):
+        self.batches = []
+
+    def emit_batch(self, records):
+        self.batches += [[record.getMessage() for record in records]]
+
+
+
+def record(msg):
+    return logging.LogRecord("test", logging.WARNING, __file__, 1, msg, (), None)
+
+
+
+def test_listener_batches_records():
+    records = queue.Queue()
+    recorder = Recorder()
+    listener = _logger.BatchQueueListener(records, recorder, batch_size=2, interval=0)
+    for i in range(5):
+        records.put(record(str(i)))
+    listener.start()
+    listener.stop()
+    assert sum(recorder.batches, []) == ["0", "1", "2", "3", "4"]
+    assert all(len(batch) <= 2 for batch in recorder.batches)
+
+
+
+def test_listener_flushes_batch_interrupted_by_stop():
+    records = queue.Queue()
+    recorder = Recorder()
+    listener = _logger.BatchQueueListener(records, recorder, batch_size=10, interval=5)
+    records.put(record("a"))
+    listener.start()
+    start = time.monotonic()
+    listener.stop()
+    listener.stop()
+    assert time.monotonic() - start < 5
+    assert recorder.batches == [["a"]]
+
+
+
+def test_init_app_logs_to_database(make_app, tmp_path):
+    log_url = f"sqlite:///{tmp_path / 'log.db'}"
+    logger = logging.getLogger()
+    before = list(logger.handlers)
+    app = make_app(LOG_URL=log_url)
+    try:
+        with app.test_request_context("/somewhere"):
+            logging.getLogger("limscore.test").warning("Something %s", "happened")
+        app.extensions["log_listener"].stop()
+    finally:
+        for handler in logger.handlers[:]:
+            if handler not in before:
+                logger.removeHandler(handler)
+    
+    with _logger.engine(log_url).connect() as conn:
+        rows = conn.execute(select([_logger.dblog])).fetchall()
+    assert [(row["message"], row["path"]) for row in rows] == [("Something happened", "/somewhere")]
@@ -0,0 +1,296 @@
+import pytest
+from flask import session
+from sqlalchemy import MetaData, Table, Column, Integer, String, UniqueConstraint, ForeignKey, select, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql
+
+from limscore import logic, cache, models
+
+
+metadata = MetaData()
+
+settings = Table("settings", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("value", String, nullable=False),
+    UniqueConstraint("name"))
+
+lines = Table("lines", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("parent_id", Integer, nullable=False),
+    Column("code", String, nullable=False),
+    Column("quantity", Integer))
+
+
+
+def values(conn):
+    return dict(conn.execute(select([settings.c.name, settings.c.value]).order_by(settings.c.name)).fetchall())
+
+
+
+def test_upsert_inserts_and_updates(engine):
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        logic.upsert(settings, [{"name": "a"}, {"name": "b"}], {"value": "1"}, conn)
+        assert values(conn) == {"a": "1", "b": "1"}
+        logic.upsert(settings, [{"name": "b"}, {"name": "c"}], {"value": "2"}, conn)
+        assert values(conn) == {"a": "1", "b": "2", "c": "2"}
+
+
+
+def test_upsert_without_other_data_ignores_conflicts(engine):
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        logic.upsert(settings, [{"name": "a"}], {"value": "1"}, conn)
+        conn.execute(settings.update().values(value="x"))
+        logic.upsert(settings, [{"name": "a"}], {}, conn)
+        assert values(conn) == {"a": "x"}
+
+
+
+def test_upsert_other_integrity_errors(engine):
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        if logic._conflict_insert(conn) is None:
+            # The savepoint fallback skips the row.
+            logic.upsert(settings, [{"name": "a"}], {"value": None}, conn)
+            assert values(conn) == {}
+        else:
+            with pytest.raises(IntegrityError):
+                logic.upsert(settings, [{"name": "a"}], {"value": None}, conn)
+
+
+
+class PostgresRecorder(object):
+    """ Stands in for a postgres connection, recording the SQL executed.
+    """
+    dialect = postgresql.dialect()
+    
+    def __init__(self, *results):
+        self.info = {}
+        self.statements = []
+        self.results = list(results)
+    
+    def execute(self, sql, *args):
+        self.statements += [str(sql.compile(dialect=self.dialect))]
+        return self.results.pop(0) if self.results else None
+    
+    def begin_nested(self):
+        self.statements += ["SAVEPOINT"]
+        return self
+    
+    def commit(self):
+        pass
+
+
+
+def test_upsert_on_conflict_needs_matching_unique_key():
+    conn = PostgresRecorder()
+    logic.upsert(settings, [{"name": "a"}, {"name": "b"}], {"value": "1"}, conn)
+    assert len(conn.statements) == 1
+    assert "ON CONFLICT (name) DO UPDATE" in conn.statements[0]
+    
+    # No unique constraint on value alone.
+    conn = PostgresRecorder()
+    logic.upsert(settings, [{"value": "a"}, {"value": "b"}], {}, conn)
+    assert conn.statements[0] == "SAVEPOINT"
+    assert not any("ON CONFLICT" in sql for sql in conn.statements)
+
+
+
+def lines_of(conn):
+    sql = select([lines.c.id, lines.c.code, lines.c.quantity]).order_by(lines.c.id)
+    return [tuple(row) for row in conn.execute(sql)]
+
+
+
+def test_update_table(engine):
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        old = [{"parent_id": 1, "code": "a", "quantity": 1},
+               {"parent_id": 1, "code": "b", "quantity": 2},
+               {"parent_id": 1, "code": "c", "quantity": 3}]
+        conn.execute(lines.insert(), old)
+        new = [{"parent_id": 1, "code": "a", "quantity": 1},
+               {"parent_id": 1, "code": "b", "quantity": 5},
+               {"parent_id": 1, "code": "d", "quantity": 4}]
+        logic.update_table(lines, [dict(row) for row in old], [dict(row) for row in new], ["parent_id", "code"], conn)
+        assert lines_of(conn) == [(1, "a", 1), (2, "b", 5), (4, "d", 4)]
+        
+        version = cache.generation("lines")
+        logic.update_table(lines, [dict(row) for row in new], [dict(row) for row in new], ["parent_id", "code"], conn)
+        assert cache.generation("lines") == version
+
+
+
+def test_update_o2m(engine):
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(lines.insert(), [{"parent_id": 1, "code": "a", "quantity": 1},
+                                      {"parent_id": 1, "code": "b", "quantity": 2}])
+        old = [{"id": 1, "code": "a"}, {"id": 2, "code": "b"}]
+        new = [{"code": "a", "quantity": 7}, {"code": "c", "quantity": 3}, {"code": "d", "quantity": 4}]
+        pks = logic.update_o2m(lines, old, new, "id", "code", {"parent_id": 1}, conn, return_pks=True)
+        assert lines_of(conn) == [(1, "a", 7), (3, "c", 3), (4, "d", 4)]
+        assert pks == [1, 3, 4]
+        
+        version = cache.generation("lines")
+        old = [{"id": 1, "code": "a"}, {"id": 3, "code": "c"}, {"id": 4, "code": "d"}]
+        logic.update_o2m(lines, old, [{"code": "a"}, {"code": "c"}, {"code": "d"}], "id", "code", {}, conn)
+        assert cache.generation("lines") == version
+        assert lines_of(conn) == [(1, "a", 7), (3, "c", 3), (4, "d", 4)]
+
+
+
+def test_update_o2m_matches_returned_pks_by_key():
+    # RETURNING rows may come back in any order.
+    conn = PostgresRecorder([("c", 11), ("b", 10)])
+    new = [{"code": "b", "quantity": 1}, {"code": "c", "quantity": 2}]
+    assert logic.update_o2m(lines, [], new, "id", "code", {"parent_id": 1}, conn, return_pks=True) == [10, 11]
+    assert "RETURNING lines.code, lines.id" in conn.statements[0]
+
+
+
+def test_linking_tables_reindexed_when_table_replaced():
+    metadata = MetaData()
+    left = Table("left", metadata, Column("id", Integer, primary_key=True))
+    right = Table("right", metadata, Column("id", Integer, primary_key=True))
+    other = Table("other", metadata, Column("id", Integer, primary_key=True))
+    link = Table("link", metadata,
+        Column("left_id", Integer, ForeignKey("left.id")),
+        Column("right_id", Integer, ForeignKey("right.id")))
+    assert logic._linking_tables(left, right) == [(link, link.c.left_id, link.c.right_id)]
+
+    # Same number of tables, different foreign keys.
+    metadata.remove(link)
+    link = Table("link", metadata,
+        Column("left_id", Integer, ForeignKey("left.id")),
+        Column("other_id", Integer, ForeignKey("other.id")))
+    assert logic._linking_tables(left, right) == []
+    assert logic._linking_tables(left, other) == [(link, link.c.left_id, link.c.other_id)]
+
+    Table("link", metadata,
+        Column("right_id", Integer, ForeignKey("right.id")),
+        extend_existing=True)
+    assert logic._linking_tables(left, right) == [(link, link.c.left_id, link.c.right_id)]
+
+
+
+def test_linking_tables_index_survives_aliases():
+    metadata = MetaData()
+    left = Table("left", metadata, Column("id", Integer, primary_key=True))
+    right = Table("right", metadata, Column("id", Integer, primary_key=True))
+    link = Table("link", metadata,
+        Column("left_id", Integer, ForeignKey("left.id")),
+        Column("right_id", Integer, ForeignKey("right.id")))
+    logic._linking_tables(left, right)
+    version = logic._linking_index[metadata][0]
+    
+    link.alias()
+    select([link, left]).where(link.c.left_id == left.c.id).alias().c.id
+    other = MetaData()
+    Table("other", other, Column("id", Integer, primary_key=True))
+    
+    logic._linking_tables(left, right)
+    assert logic._linking_index[metadata][0] == version
+
+
+
+def crud_user(app, engine):
+    """ Creates a user with two groups through logic.crud, then edits their
+        surname and removes a group.
+    """
+    choices = {"groups": [(1, "Admin.Administrator"), (2, "Lab.Tech")]}
+    with app.test_request_context("/"):
+        session["id"] = 1
+        with engine.begin() as conn:
+            conn.execute(models.groups.insert(), [{"name": "Admin.Administrator"}, {"name": "Lab.Tech"}])
+            new = {"email": "a@example.com", "name": "A", "forename": "Ann", "surname": "Smith", "groups": [1, 2]}
+            row_id = logic.crud(models.users, new, conn=conn, **choices)
+            old = dict(new, id=row_id)
+            logic.crud(models.users, dict(new, surname="Jones", groups=[1]), old, conn=conn, **choices)
+    return row_id
+
+
+
+def editlogs_of(conn):
+    sql = select([models.editlogs.c.action, models.editlogs.c.details]).order_by(models.editlogs.c.id)
+    return [tuple(row) for row in conn.execute(sql)]
+
+
+
+def test_crud_writes_details_as_json(make_app):
+    app = make_app()
+    engine = app.extensions["engine"]
+    crud_user(app, engine)
+    with engine.connect() as conn:
+        assert editlogs_of(conn) == [
+            ("Created", {"email": "a@example.com", "forename": "Ann", "surname": "Smith"}),
+            ("Added", {"groups": ["Admin.Administrator", "Lab.Tech"]}),
+            ("Edited", {"surname": "Jones"}),
+            ("Removed", {"groups": ["Lab.Tech"]})]
+        assert conn.execute(select([models.editlog_changes.c.id])).first() is None
+        
+        sql = select([models.editlogs.c.action]). \
+                where(logic.details_has_field("groups", engine.dialect)). \
+                order_by(models.editlogs.c.id)
+        assert [row[0] for row in conn.execute(sql)] == ["Added", "Removed"]
+
+
+
+def test_crud_writes_editlog_changes(make_app):
+    app = make_app(EDITLOG_CHANGES=True)
+    engine = app.extensions["engine"]
+    row_id = crud_user(app, engine)
+    changes = models.editlog_changes
+    sql = select([changes.c.tablename, changes.c.row_id, changes.c.action,
+                  changes.c.field, changes.c.value, changes.c.user_id]). \
+            order_by(changes.c.id)
+    with engine.connect() as conn:
+        rows = [tuple(row) for row in conn.execute(sql)]
+    # One row per field, or per item of a many to many field.
+    assert [row[2:5] for row in rows] == [
+        ("Created", "email", "a@example.com"),
+        ("Created", "forename", "Ann"),
+        ("Created", "surname", "Smith"),
+        ("Added", "groups", "Admin.Administrator"),
+        ("Added", "groups", "Lab.Tech"),
+        ("Edited", "surname", "Jones"),
+        ("Removed", "groups", "Lab.Tech")]
+    assert {row[:2] for row in rows} == {("users", row_id)}
+    assert {row[5] for row in rows} == {1}
+
+
+
+def test_crud_batches_editlogs(make_app):
+    app = make_app()
+    engine = app.extensions["engine"]
+    inserts = []
+    
+    @event.listens_for(engine, "before_cursor_execute")
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO editlogs"):
+            inserts.append(len(parameters) if executemany else 1)
+    
+    choices = {"groups": [(1, "Admin.Administrator"), (2, "Lab.Tech")]}
+    with app.test_request_context("/"):
+        session["id"] = 1
+        with engine.begin() as conn:
+            conn.execute(models.groups.insert(), [{"name": "Admin.Administrator"}, {"name": "Lab.Tech"}])
+            new = {"email": "a@example.com", "name": "A", "forename": "Ann", "surname": "Smith", "groups": [1, 2]}
+            logic.crud(models.users, new, conn=conn, **choices)
+            # Created and Added in one insert.
+            assert inserts == [2]
+            
+            with logic.batch_crudlog(conn):
+                for i in range(3):
+                    new = {"email": f"{i}@example.com", "name": str(i), "forename": "F", "surname": "S", "groups": [1]}
+                    logic.crud(models.users, new, conn=conn, **choices)
+                    logic.crudlog("users", i, "Edited", {"note": i}, conn)
+                assert inserts == [2]
+            assert inserts == [2, 9]
+            
+            rows = conn.execute(select([models.editlogs.c.user_id, models.editlogs.c.datetime])).fetchall()
+    assert {row[0] for row in rows} == {1}
+    assert len({row[1] for row in rows[:2]}) == 1
+    assert len({row[1] for row in rows[2:]}) == 1
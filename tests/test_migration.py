@@ -0,0 +1,49 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import select, text
+
+from limscore import migration
+from limscore.models import editlogs, editlog_changes
+
+
+
+def add_old_editlogs(conn, details):
+    # Inserted as raw text, as the column held before it became JSON.
+    sql = text("INSERT INTO editlogs (tablename, row_id, action, details, datetime) "
+               "VALUES ('users', :row_id, 'Edited', :details, :datetime)")
+    conn.execute(sql, [{"row_id": i + 1,
+                        "details": text_details,
+                        "datetime": datetime(2020, 1, 1, tzinfo=timezone.utc)}
+                       for i, text_details in enumerate(details)])
+
+
+
+def test_parse_details():
+    assert migration._parse_details("") == {}
+    assert migration._parse_details("a=1\tb=x=y\tc=") == {"a": "1", "b": "x=y", "c": ""}
+
+
+
+def test_convert_editlogs(engine):
+    with engine.begin() as conn:
+        add_old_editlogs(conn, ["name=Bob\temail=b@example.com", "", '{"name": "Al"}'])
+        migration.convert_editlogs(conn, batch_size=1)
+        # Safe to run again.
+        migration.convert_editlogs(conn)
+        details = [row[0] for row in conn.execute(select([editlogs.c.details]).order_by(editlogs.c.id))]
+    assert details == [{"name": "Bob", "email": "b@example.com"}, {}, {"name": "Al"}]
+
+
+
+def test_backfill_editlog_changes(engine):
+    with engine.begin() as conn:
+        add_old_editlogs(conn, ["name=Bob\temail=b@example.com", "name=Al"])
+        migration.convert_editlogs(conn)
+        migration.backfill_editlog_changes(conn, batch_size=1)
+        changes = conn.execute(select([editlog_changes.c.row_id,
+                                       editlog_changes.c.field,
+                                       editlog_changes.c.value]).
+                               order_by(editlog_changes.c.row_id, editlog_changes.c.field)).fetchall()
+    assert [tuple(row) for row in changes] == [(1, "email", "b@example.com"),
+                                               (1, "name", "Bob"),
+                                               (2, "name", "Al")]
@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from limscore import models
+
+
+CONFIG = {"DB_POOL_SIZE": 1,
+          "DB_MAX_OVERFLOW": 0,
+          "DB_POOL_TIMEOUT": 5,
+          "DB_POOL_RECYCLE": 3600,
+          "DB_POOL_PRE_PING": True,
+          "DB_STATEMENT_CACHE_SIZE": 100}
+
+
+
+def test_sqlite_ignores_queue_pool_config(tmp_path):
+    engine = models.create_engine(f"sqlite:///{tmp_path}/test.db", config=CONFIG)
+    with engine.connect() as conn:
+        assert conn.execute("SELECT 1").scalar() == 1
+    assert "waits" not in models.pool_status(engine)
+
+
+
+def test_only_blocked_checkouts_are_waits(tmp_path):
+    engine = models.create_engine(f"sqlite:///{tmp_path}/test.db",
+                                  poolclass=models.TimedQueuePool,
+                                  pool_size=1,
+                                  max_overflow=0,
+                                  pool_timeout=5)
+    for i in range(3):
+        engine.connect().close()
+    assert models.pool_status(engine)["waits"] == 0
+    
+    conn = engine.connect()
+    waiter = threading.Thread(target=lambda: engine.connect().close())
+    waiter.start()
+    waiter.join(0.2)
+    conn.close()
+    waiter.join()
+    status = models.pool_status(engine)
+    assert status["waits"] == 1
+    assert status["max_wait"] >= 0.1
+
+
+
+def test_sqlite_wal_only_reads_of_get_requests_are_deferred(tmp_path):
+    engine = models.create_engine(f"sqlite:///{tmp_path / 'wal.db'}",
+                                  config={"DB_SQLITE_WAL": True, "DB_SQLITE_BUSY_TIMEOUT": 100})
+    begins = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: begins.append(statement) if statement.startswith("BEGIN") else None)
+    with engine.begin() as conn:
+        conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY)")
+    app = Flask(__name__)
+    
+    with engine.begin() as writer:
+        # Holds the write lock.
+        writer.execute("INSERT INTO items (id) VALUES (1)")
+        with app.test_request_context(method="GET"):
+            with engine.begin() as conn:
+                assert conn.execute("SELECT count(*) FROM items").scalar() == 0
+        with app.test_request_context(method="POST"):
+            with pytest.raises(OperationalError):
+                with engine.begin() as conn:
+                    pass
+    assert begins == ["BEGIN IMMEDIATE", "BEGIN IMMEDIATE", "BEGIN DEFERRED", "BEGIN IMMEDIATE"]
+    
+    with app.test_request_context(method="GET"):
+        with engine.execution_options(sqlite_begin="IMMEDIATE").begin() as conn:
+            pass
+    assert begins[-1] == "BEGIN IMMEDIATE"
+
+
+
+def test_read_engine_pings_replicas_and_falls_back(tmp_path):
+    primary = models.create_engine(f"sqlite:///{tmp_path / 'primary.db'}")
+    replica = f"sqlite:///{tmp_path / 'replica.db'}"
+    missing = f"sqlite:///{tmp_path / 'missing' / 'replica.db'}"
+    read_engine = models.create_read_engine(primary, [missing, replica])
+    assert all(engine.pool._pre_ping for engine in read_engine.replicas)
+    
+    # The missing replica cannot be opened so is skipped.
+    for i in range(3):
+        with read_engine.connect() as conn:
+            assert conn.engine is read_engine.replicas[1]
+    
+    read_engine = models.create_read_engine(primary, [missing])
+    with read_engine.connect() as conn:
+        assert conn.engine is primary
+    assert models.create_read_engine(primary, []) is primary
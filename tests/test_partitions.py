@@ -0,0 +1,84 @@
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import MetaData, Table, Column, DateTime, Index
+
+from limscore import models, partitions
+
+
+NOW = datetime(2026, 10, 18, tzinfo=timezone.utc)
+
+
+
+def tables(conn):
+    sql = "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'requestlogs%'"
+    return sorted(name for (name,) in conn.execute(sql))
+
+
+
+def add_logs(engine, *months):
+    with engine.begin() as conn:
+        conn.execute(models.requestlogs.insert(),
+                     [{"ip_address": "127.0.0.1", "path": "/", "method": "GET", "response": "200",
+                       "datetime": datetime(2026, month, 15, tzinfo=timezone.utc)} for month in months])
+
+
+
+def test_month():
+    assert partitions._month(datetime(2026, 12, 5), 1) == datetime(2027, 1, 1, tzinfo=timezone.utc)
+    assert partitions._month(NOW, -10) == datetime(2025, 12, 1, tzinfo=timezone.utc)
+
+
+
+def test_rotate_moves_old_months(engine):
+    add_logs(engine, 6, 7, 7, 9, 10)
+    with engine.begin() as conn:
+        partitions.maintain(conn, {}, now=NOW)
+        assert tables(conn) == ["requestlogs", "requestlogs_2026_06",
+                                "requestlogs_2026_07", "requestlogs_2026_09"]
+        assert conn.execute("SELECT count(*) FROM requestlogs").scalar() == 1
+        assert conn.execute("SELECT count(*) FROM requestlogs_2026_07").scalar() == 2
+    
+    # Running again is a no-op.
+    with engine.begin() as conn:
+        partitions.maintain(conn, {}, now=NOW)
+        assert conn.execute("SELECT count(*) FROM requestlogs_2026_07").scalar() == 2
+
+
+
+def test_expire_drops_old_months(engine):
+    add_logs(engine, 6, 7, 9, 10)
+    with engine.begin() as conn:
+        partitions.maintain(conn, {"LOG_RETENTION_MONTHS": 2}, now=NOW)
+        assert tables(conn) == ["requestlogs", "requestlogs_2026_09"]
+
+
+
+def test_archive_rejected_with_sqlite(engine):
+    add_logs(engine, 6)
+    with engine.begin() as conn:
+        with pytest.raises(RuntimeError):
+            partitions.maintain(conn, {"LOG_RETENTION_MONTHS": 1, "LOG_ARCHIVE": True}, now=NOW)
+
+
+
+def test_maintenance_is_opt_in(make_app, monkeypatch):
+    started = []
+    monkeypatch.setattr(partitions, "start_maintenance", lambda engine, config: started.append(engine))
+    make_app()
+    assert started == []
+    app = make_app(LOG_MAINTENANCE=True)
+    assert started == [app.extensions["engine"]]
+
+
+
+def test_include_object_hides_monthly_tables():
+    def included(name, type_="table", reflected=True, compare_to=None):
+        return partitions.include_object(None, name, type_, reflected, compare_to)
+    assert not included("requestlogs_2026_07")
+    assert not included("accesslogs_default")
+    assert included("requestlogs")
+    assert included("requestlogs_2026_07", reflected=False)
+    assert included("users_2026_07")
+    index = Index("ix_requestlogs_2026_07_datetime", Table("requestlogs_2026_07", MetaData(), Column("datetime", DateTime)).c.datetime)
+    assert not partitions.include_object(index, index.name, "index", True, None)
@@ -0,0 +1,117 @@
+from sqlalchemy import and_
+
+from limscore import models, permissions, cache
+from limscore.utils import login_required
+
+from conftest import login, seed
+
+
+
+def setup(app):
+    engine = app.extensions["engine"]
+    seed(engine)
+    with engine.begin() as conn:
+        conn.execute(models.users_sites.insert(), [{"user_id": 1, "site_id": 1}, {"user_id": 1, "site_id": 2}])
+    return engine
+
+
+
+def revoke(engine, table, **where):
+    # Raw SQL, as made by another process, is not seen by the cache.
+    with engine.begin() as conn:
+        conn.execute(table.delete().where(and_(*(table.c[k] == v for k, v in where.items()))))
+
+
+
+def test_snapshot_expires_after_ttl(make_app):
+    app = make_app()
+    engine = setup(app)
+    with app.app_context():
+        assert set(permissions.permissions(1).sites) == {1, 2}
+        revoke(engine, models.users_sites, user_id=1, site_id=2)
+        assert set(permissions.permissions(1).sites) == {1, 2}
+        assert set(permissions.permissions(1, fresh=True).sites) == {1}
+    
+    app = make_app(DB_CACHE_TTL=0)
+    with app.app_context():
+        permissions.permissions(1)
+        revoke(engine, models.users_sites, user_id=1)
+        assert permissions.permissions(1).sites == {}
+
+
+
+def test_revoked_site_cannot_be_selected(make_app):
+    app = make_app()
+    engine = setup(app)
+    client = app.test_client()
+    login(client)
+    assert client.get("/sitemenu").status_code == 200
+    revoke(engine, models.users_sites, user_id=1, site_id=2)
+    
+    client.get("/setsite/2")
+    with client.session_transaction() as session:
+        assert "site_id" not in session
+    client.get("/setsite/1")
+    with client.session_transaction() as session:
+        assert session["site_id"] == 1
+
+
+
+def test_revoked_group_cannot_write(make_app):
+    app = make_app()
+    engine = setup(app)
+    
+    @login_required("Admin.Administrator")
+    def admin_only():
+        return "ok"
+    app.add_url_rule("/admin-only", "admin_only", admin_only, methods=["GET", "POST"])
+    client = app.test_client()
+    login(client)
+    assert client.post("/admin-only").status_code == 200
+    revoke(engine, models.users_groups, user_id=1)
+    assert client.post("/admin-only").status_code == 403
+
+
+
+def test_menu_revalidates_with_etag(make_app):
+    app = make_app()
+    setup(app)
+    client = app.test_client()
+    login(client)
+    response = client.get("/sitemenu")
+    etag = response.headers["ETag"]
+    assert response.cache_control.private and response.cache_control.no_cache
+    assert b"SiteA" in response.data and b"SiteB" in response.data
+    
+    response = client.get("/sitemenu", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.headers["ETag"] == etag
+    
+    # Each menu has its own ETag.
+    assert client.get("/logoutmenu").headers["ETag"] != etag
+
+
+
+def test_menu_cached_until_selection_or_membership_changes(make_app):
+    app = make_app()
+    engine = setup(app)
+    client = app.test_client()
+    login(client)
+    menus = app.extensions["menus"]
+    first = client.get("/sitemenu")
+    assert len(menus._items) == 1
+    assert client.get("/sitemenu").headers["ETag"] == first.headers["ETag"]
+    assert len(menus._items) == 1
+    
+    client.get("/setsite/1")
+    response = client.get("/sitemenu")
+    assert response.headers["ETag"] != first.headers["ETag"]
+    assert b"SiteA" not in response.data and b"SiteB" in response.data
+    
+    with engine.begin() as conn:
+        conn.execute(models.users_sites.delete().where(models.users_sites.c.site_id == 2))
+        cache.table_changed(models.users_sites, conn)
+    changed = client.get("/sitemenu")
+    assert changed.headers["ETag"] != response.headers["ETag"]
+    assert b"SiteB" not in changed.data
@@ -0,0 +1,66 @@
+import pytest
+from flask import g
+
+from limscore import profiling
+
+from conftest import login, seed
+
+
+
+def queries_app(make_app, **config):
+    app = make_app(**config)
+    seed(app.extensions["engine"])
+    
+    def count():
+        with app.extensions["engine"].connect() as conn:
+            for i in range(5):
+                conn.execute("SELECT id FROM users WHERE id = {}".format(i))
+        return str(len(g.get("queries", ())))
+    app.add_url_rule("/count", "count", count)
+    return app
+
+
+
+def test_stats_off_by_default(make_app):
+    app = queries_app(make_app)
+    assert app.test_client().get("/count").data == b"0"
+
+
+
+def test_stats_enabled(make_app):
+    app = queries_app(make_app, DB_QUERY_STATS=True)
+    profiling.query_stats.reset()
+    assert app.test_client().get("/count").data == b"5"
+    assert profiling.query_stats.snapshot()["count"]["queries"] == 5
+
+
+
+def test_fingerprint():
+    assert profiling.fingerprint("SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'x'") == \
+        "SELECT * FROM t WHERE id IN (?) AND name = ?"
+
+
+
+def test_check_enables_collection(make_app):
+    app = queries_app(make_app, DB_QUERY_CHECK="fail", DB_QUERY_REPEAT=10)
+    assert app.test_client().get("/count").data == b"5"
+
+
+
+def test_check_repeated_statements(make_app):
+    app = queries_app(make_app, DB_QUERY_CHECK="fail", DB_QUERY_REPEAT=3)
+    with pytest.raises(profiling.QueryBudgetExceeded):
+        app.test_client().get("/count")
+
+
+
+def test_check_budget_warns(make_app, caplog):
+    app = queries_app(make_app, DB_QUERY_CHECK="warn", DB_QUERY_BUDGET=2)
+    assert app.test_client().get("/count").status_code == 200
+    assert "exceeds budget of 2" in caplog.text
+
+
+
+def test_invalid_check_mode(make_app):
+    with pytest.raises(RuntimeError):
+        queries_app(make_app, DB_QUERY_CHECK="raise")
@@ -0,0 +1,62 @@
+import pytest
+
+from limscore import models
+
+from conftest import login, seed
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app(REQUEST_LOG=True, REQUEST_LOG_INTERVAL=0.05, SESSION_BACKEND="memory")
+    seed(app.extensions["engine"])
+    
+    def fail():
+        raise RuntimeError("failed")
+    
+    app.add_url_rule("/fail", "fail", fail)
+    app.add_url_rule("/plain", "plain", lambda: "plain")
+    return app
+
+
+
+def logged(app):
+    app.extensions["request_logger"].stop()
+    with app.extensions["engine"].connect() as conn:
+        sql = models.requestlogs.select().order_by(models.requestlogs.c.id)
+        return [dict(row) for row in conn.execute(sql)]
+
+
+
+def test_requests_logged_in_batches(app):
+    client = app.test_client()
+    login(client)
+    for i in range(3):
+        assert client.get("/users").status_code == 200
+    client.get("/core/static/limscore.js")
+    rows = logged(app)
+    assert [(row["path"], row["response"], row["user_id"]) for row in rows] == [("/users", "200", 1)] * 3
+    assert all(row["duration"] > 0 for row in rows)
+
+
+
+def test_unhandled_exceptions_logged(app):
+    client = app.test_client()
+    with pytest.raises(RuntimeError):
+        client.get("/fail")
+    app.testing = False
+    assert client.get("/fail").status_code == 500
+    assert [row["response"] for row in logged(app)] == ["500", "500"]
+
+
+
+def test_logging_does_not_load_session(app):
+    store = app.session_interface.store
+    loads = []
+    load = store.load
+    store.load = lambda sid: loads.append(sid) or load(sid)
+    client = app.test_client()
+    login(client)
+    loads.clear()
+    client.get("/plain")
+    assert loads == []
+    assert logged(app)[-1]["user_id"] is None
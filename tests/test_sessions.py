@@ -0,0 +1,183 @@
+import json
+import time
+from datetime import timedelta
+
+import pytest
+from flask import session
+
+from limscore.sessions import MemoryStore, DatabaseStore, ServerSessionInterface, StoreHistory
+from limscore.utils import store_history, url_back, back_exists
+
+
+def make_session_app(make_app, backend):
+    app = make_app(SESSION_BACKEND=backend,
+                   PERMANENT_SESSION_LIFETIME=timedelta(seconds=100))
+    
+    def write():
+        session["value"] = "x"
+        return ""
+    
+    def read():
+        return session.get("value", "")
+    
+    app.add_url_rule("/write", "write", write)
+    app.add_url_rule("/read", "read", read)
+    return app
+
+
+
+@pytest.mark.parametrize("backend", ["memory", "database"])
+def test_round_trip(make_app, backend):
+    app = make_session_app(make_app, backend)
+    assert isinstance(app.session_interface, ServerSessionInterface)
+    client = app.test_client()
+    response = client.get("/write")
+    cookie = response.headers["Set-Cookie"]
+    assert "value" not in cookie
+    response = client.get("/read")
+    assert response.data == b"x"
+    # Unmodified sessions are not resent.
+    assert "Set-Cookie" not in response.headers
+
+
+
+@pytest.mark.parametrize("backend", ["memory", "database"])
+def test_unknown_id_is_not_reused(make_app, backend):
+    app = make_session_app(make_app, backend)
+    client = app.test_client()
+    client.set_cookie("localhost", "session", "forged.id")
+    assert client.get("/read").data == b""
+
+
+
+@pytest.mark.parametrize("backend", ["memory", "database"])
+def test_expiry_extended_after_half_lifetime(make_app, backend):
+    app = make_session_app(make_app, backend)
+    store = app.session_interface.store
+    client = app.test_client()
+    client.get("/write")
+    
+    touched = []
+    touch = store.touch
+    store.touch = lambda sid, lifetime: touched.append(sid) or touch(sid, lifetime)
+    
+    # Fresh sessions are not touched on every request.
+    client.get("/read")
+    assert touched == []
+    
+    # Once past half its lifetime the expiry is extended.
+    real_time = time.time
+    try:
+        time.time = lambda: real_time() + 60
+        client.get("/read")
+    finally:
+        time.time = real_time
+    assert len(touched) == 1
+    data, expires = store.load(touched[0])
+    assert data is not None and expires > time.time() + 90
+
+
+
+def test_permanent_sessions_refreshed_each_request(make_app):
+    app = make_session_app(make_app, "memory")
+    
+    def permanent():
+        session.permanent = True
+        return ""
+    app.add_url_rule("/permanent", "permanent", permanent)
+    client = app.test_client()
+    client.get("/write")
+    client.get("/permanent")
+    response = client.get("/read")
+    assert "Set-Cookie" in response.headers
+
+
+
+def test_memory_store_expires():
+    store = MemoryStore(max_sessions=2)
+    store.save("a", "1", timedelta(seconds=-1))
+    assert store.load("a") == (None, None)
+    store.save("b", "2", timedelta(seconds=10))
+    store.save("c", "3", timedelta(seconds=10))
+    store.save("d", "4", timedelta(seconds=10))
+    assert store.load("b") == (None, None)
+    assert store.load("d")[0] == "4"
+
+
+
+def test_database_store_purges(engine):
+    store = DatabaseStore(engine, purge_every=2)
+    store.save("old", "1", timedelta(seconds=-1))
+    store.save("new", "2", timedelta(seconds=10))
+    with engine.connect() as conn:
+        assert [sid for (sid,) in conn.execute("SELECT id FROM sessions")] == ["new"]
+    assert store.load("old") == (None, None)
+    store.touch("new", timedelta(seconds=1000))
+    assert store.load("new")[1] > time.time() + 900
+
+
+
+def make_history_app(make_app, **config):
+    app = make_app(**config)
+    
+    def page():
+        store_history()
+        return url_back()
+    
+    # History is keyed on endpoint so each page needs its own.
+    for name in "abcd":
+        app.add_url_rule(f"/{name}", name, page)
+    app.add_url_rule("/key", "key", lambda: session["history"])
+    return app
+
+
+
+@pytest.mark.parametrize("backend", ["cookie", "memory", "database"])
+def test_back_navigation(make_app, backend):
+    # Session cookies are secure so are only sent back over https.
+    app = make_history_app(make_app, SESSION_BACKEND=backend)
+    client = app.test_client()
+    response = client.get("https://localhost/a?dir=0")
+    assert "Set-Cookie" in response.headers
+    assert client.get("https://localhost/b?dir=1").data == b"/a?dir=-1"
+    response = client.get("https://localhost/c?dir=1")
+    assert response.data == b"/b?dir=-1"
+    # History lives outside the session so the cookie is not resent.
+    assert "Set-Cookie" not in response.headers
+    # Going back pops the stack.
+    assert client.get("https://localhost/b?dir=-1").data == b"/a?dir=-1"
+    # Sideways navigation replaces the current page.
+    assert client.get("https://localhost/d").data == b"/a?dir=-1"
+
+
+
+def test_back_navigation_without_history(app):
+    with app.test_request_context("/"):
+        assert url_back() == "/?dir=0"
+        assert not back_exists()
+
+
+
+@pytest.mark.parametrize("backend", ["memory", "database"])
+def test_history_kept_in_session_store(make_app, backend):
+    app = make_history_app(make_app, SESSION_BACKEND=backend)
+    assert isinstance(app.extensions["history"], StoreHistory)
+    client = app.test_client()
+    client.get("https://localhost/a?dir=0")
+    client.get("https://localhost/b?dir=1")
+    store = app.session_interface.store
+    key = client.get("https://localhost/key").data.decode()
+    data, expires = store.load("history:" + key)
+    assert json.loads(data) == [["a", {"dir": "0"}], ["b", {"dir": "1"}]]
+
+
+
+def test_history_shared_between_processes(make_app):
+    first = make_history_app(make_app, SESSION_BACKEND="database")
+    client = first.test_client()
+    client.get("https://localhost/a?dir=0")
+    client.get("https://localhost/b?dir=1")
+    # Another worker sharing the database.
+    second = make_history_app(make_app, SESSION_BACKEND="database")
+    client.application = second
+    assert client.get("https://localhost/c?dir=1").data == b"/b?dir=-1"